@@ -15,6 +15,7 @@ import sys
 import os
 import os.path
 import logging
+import multiprocessing
 import re
 import javabridge
 import bioformats
@@ -546,6 +547,9 @@ class CPAnalyst(wx.App):
 
 
 if __name__ == "__main__":    
+    # Classifier may score with worker processes, which frozen Windows
+    # builds can only start once this has been called.
+    multiprocessing.freeze_support()
     # Initialize the app early because the fancy exception handler
     # depends on it in order to show a 
     app = CPAnalyst(redirect=False)
@@ -1,6 +1,7 @@
 from dbconnect import DBConnect, UniqueImageClause, image_key_columns
 from multiclasssql import filter_table_prefix
 from properties import Properties
+from queryexecutor import QueryExecutor
 import datamodel
 import guiutils as ui 
 from wx.combo import OwnerDrawnComboBox as ComboBox
@@ -132,20 +133,27 @@ class DataSourcePanel(wx.Panel):
         types = db.GetColumnTypes(table)
         return [m for m,t in zip(measurements, types) if t in [float, int, long]]
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, wait=False):
+        '''Redraws the box plots once their queries have run in the
+        background, or right away if wait is true.'''
         table = self.table_choice.Value
         fltr = self.filter_choice.get_filter_or_none()
         grouping = self.group_choice.Value
         if self.x_choice.Value == SELECT_MULTIPLE:
+            columns = [(col, NO_GROUP) for col in self.x_columns]
+        else:
+            columns = [(self.x_choice.Value, grouping)]
+        def load():
             points_dict = {}
-            for col in self.x_columns:
-                pts = self.loadpoints(table, col, fltr, NO_GROUP)
+            for col, col_grouping in columns:
+                pts = self.loadpoints(table, col, fltr, col_grouping)
                 for k in pts.keys(): assert k not in points_dict.keys()
                 points_dict.update(pts)
-        else:
-            col = self.x_choice.Value
-            points_dict = self.loadpoints(table, col, fltr, grouping)
-        
+            return points_dict
+        QueryExecutor.getInstance().redraw(
+            self, load, lambda points_dict: self._show_points(points_dict, grouping), wait)
+
+    def _show_points(self, points_dict, grouping):
         # Check if the user is creating a plethora of plots by accident
         if 100 >= len(points_dict) > 25:
             res = wx.MessageDialog(self, 'Are you sure you want to show %s box '
@@ -162,7 +170,7 @@ class DataSourcePanel(wx.Panel):
             return
 
         self.figpanel.setpoints(points_dict)
-        if self.group_choice.Value != NO_GROUP:
+        if grouping != NO_GROUP:
             self.figpanel.set_x_axis_label(grouping)
             self.figpanel.set_y_axis_label(self.x_choice.Value)
         self.figpanel.draw()
@@ -189,7 +197,7 @@ class DataSourcePanel(wx.Panel):
                 row[0] = np.nan
         
         points_dict = {}
-        if self.group_choice.Value != NO_GROUP:
+        if grouping != NO_GROUP:
             for row in res:
                 groupkey = tuple(row[1:])
                 points_dict[groupkey] = points_dict.get(groupkey, []) + [row[0]]
@@ -236,7 +244,7 @@ class DataSourcePanel(wx.Panel):
                 self.x_columns = cols
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
+        self.update_figpanel(wait=True)
         if 'x-lim' in settings:
             self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
         if 'y-lim' in settings:
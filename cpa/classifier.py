@@ -20,6 +20,7 @@ from time import time
 import icons
 import dbconnect
 import dirichletintegrate
+import imagepanel
 import imagetools
 import polyafit
 import sortbin
@@ -1634,6 +1635,15 @@ class Classifier(wx.Frame):
             logging.info('time to fit beta binomial: %.3fs' % (t4 - t3))
             self.PostMessage('Computing enrichment scores for each group...')
 
+            # Score all of the groups at once; the rows of scores line up
+            # with groupedKeysAndCounts.
+            if not np.isnan(alpha).any():
+                if p.area_scoring_column is not None:
+                    scoredCounts = groupedKeysAndCounts[:, -nClasses:]
+                else:
+                    scoredCounts = groupedKeysAndCounts[:, nKeyCols:nKeyCols + nClasses]
+                allScores = dirichletintegrate.score_all(alpha, np.array(scoredCounts.tolist(), dtype=int))
+
         # CONSTRUCT ARRAY OF TABLE DATA
         tableData = []
         fraction = 0.0
@@ -1662,7 +1672,7 @@ class Classifier(wx.Frame):
                 if not np.isnan(alpha).any():
                     # Append the scores:
                     #   compute enrichment probabilities of each class for this image OR group
-                    scores = np.array(dirichletintegrate.score(alpha, np.array(countsRow)))
+                    scores = allScores[i].copy()
                     #   clamp to [0,1] to
                     scores[scores > 1.] = 1.
                     scores[scores < 0.] = 0.
@@ -1996,7 +2006,10 @@ class Classifier(wx.Frame):
     def SetBrightness(self, brightness):
         ''' Updates the global image brightness across all tiles. '''
         self.brightness = brightness
-        [t.SetBrightness(brightness) for bin in self.all_sort_bins() for t in bin.tiles]
+        tiles = [t for bin in self.all_sort_bins() for t in bin.tiles]
+        for t in tiles:
+            t.brightness = brightness
+        imagepanel.UpdateBitmaps(tiles)
 
     def SetScale(self, scale):
         ''' Updates the global image scaling across all tiles. '''
@@ -2006,7 +2019,10 @@ class Classifier(wx.Frame):
 
     def SetContrastMode(self, mode):
         self.contrast = mode
-        [t.SetContrastMode(mode) for bin in self.all_sort_bins() for t in bin.tiles]
+        tiles = [t for bin in self.all_sort_bins() for t in bin.tiles]
+        for t in tiles:
+            t.contrast = mode
+        imagepanel.UpdateBitmaps(tiles)
 
     def PostMessage(self, message):
         ''' Updates the status bar text and logs to info. '''
@@ -0,0 +1,439 @@
+'''
+Bulk loading of CellProfiler CSV files into an SQLite database.
+
+Each CSV file is split into byte ranges that a pool of worker processes
+parse in parallel, converting every field to the type of its destination
+column (int, float or str) as SQLite's column affinity would. The calling
+process inserts the parsed rows with executemany() in a single transaction.
+When a new database is built, journaling and syncing are turned off for the
+load and the primary key indexes are only built once all of the rows are in.
+
+Ranges are split at line ends, so fields may not contain newlines.
+
+Each loaded file is recorded in the FILES_TABLE table along with its size,
+modification time, a digest of its contents and the range of rowids its
+rows were given, so that CSVImporter.sync can later load just the files
+that are new or have changed and delete the rows of files that are gone.
+Rowids are only stable as long as the database isn't VACUUMed.
+'''
+
+import csv
+import os
+import hashlib
+import re
+import time
+import logging
+import itertools
+import collections
+import multiprocessing
+
+# Size of the byte ranges handed to the workers
+CHUNK_BYTES = 16 * 2**20
+# SQLite page cache used during the load, in KiB
+LOAD_CACHE_KiB = 256 * 1024
+# Records which rows were loaded from which file
+FILES_TABLE = '_cpa_csv_files'
+
+
+def split_csv(filename, chunk_bytes=CHUNK_BYTES, header=True):
+    '''
+    Returns a list of (start, stop) byte ranges that together cover the
+    rows of a CSV file, skipping the header line if it has one. Each range
+    starts at the beginning of a line.
+    '''
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as f:
+        if header:
+            f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            if f.tell() < size:
+                # finish the line we landed in
+                f.readline()
+            stop = f.tell()
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+
+def read_header(filename):
+    '''Returns the column labels on the first line of a CSV file.'''
+    with open(filename, 'rU') as f:
+        return [lbl.strip() for lbl in csv.reader(f).next()]
+
+
+def _read_range(filename, start, stop):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return f.read(stop - start)
+
+def _read_rows(filename, start, stop, data=None):
+    if data is None:
+        data = _read_range(filename, start, stop)
+    return (row for row in csv.reader(data.splitlines()) if len(row) > 0)
+
+
+def _to_int(s):
+    try:
+        return int(s)
+    except ValueError:
+        val = _to_float(s)
+        if isinstance(val, float) and val.is_integer():
+            return int(val)
+        return val
+
+def _to_float(s):
+    try:
+        val = float(s)
+    except ValueError:
+        return s
+    # SQLite leaves "nan" alone rather than storing it as a number
+    if val != val:
+        return s
+    return val
+
+def _to_str(s):
+    return s
+
+def column_converter(sqltype):
+    '''
+    Returns the function that converts CSV fields to values for a column
+    of the given SQL type, following SQLite's rules for column affinity.
+    Fields that can't be converted are stored as they are.
+    '''
+    t = (sqltype or '').upper()
+    if 'INT' in t:
+        return _to_int
+    if 'CHAR' in t or 'CLOB' in t or 'TEXT' in t or 'BLOB' in t or t == '':
+        return _to_str
+    return _to_float
+
+
+def parse_range(args):
+    '''
+    Worker task: parses one byte range of a CSV file.
+    args: (filename, start, stop, sqltypes)
+    RETURNS: a list of row tuples of converted values
+    '''
+    filename, start, stop, sqltypes = args
+    return _parse(filename, start, stop, sqltypes)
+
+def _parse(filename, start, stop, sqltypes, data=None):
+    converters = [column_converter(t) for t in sqltypes]
+    return [tuple([convert(val) for convert, val in zip(converters, row)])
+            for row in _read_rows(filename, start, stop, data)]
+
+def parse_and_digest_range(args):
+    '''
+    Worker task: like parse_range, but also returns the md5 digest of the
+    bytes in the range.
+    '''
+    filename, start, stop, sqltypes = args
+    data = _read_range(filename, start, stop)
+    return _parse(filename, start, stop, sqltypes, data), hashlib.md5(data).hexdigest()
+
+def digest_range(args):
+    '''Worker task: returns the md5 digest of one byte range of a file.'''
+    filename, start, stop = args
+    return hashlib.md5(_read_range(filename, start, stop)).hexdigest()
+
+def _file_digest(range_digests):
+    return hashlib.md5(''.join(range_digests)).hexdigest()
+
+
+INT, FLOAT, VARCHAR = 0, 1, 2
+
+def infer_range(args):
+    '''
+    Worker task: works out the narrowest type that holds every value in
+    each column of one byte range of a CSV file.
+    args: (filename, start, stop, ncols)
+    RETURNS: a list of (kind, max_length) per column, where kind is INT,
+        FLOAT or VARCHAR, or None for columns without any values
+    '''
+    filename, start, stop, ncols = args
+    kinds = [None] * ncols
+    lengths = [0] * ncols
+    for row in _read_rows(filename, start, stop):
+        for i, val in enumerate(row):
+            lengths[i] = max(lengths[i], len(val))
+            kind = kinds[i]
+            if kind == VARCHAR:
+                continue
+            if kind != FLOAT:
+                try:
+                    int(val)
+                    kinds[i] = INT
+                    continue
+                except ValueError:
+                    pass
+            try:
+                float(val)
+                kinds[i] = FLOAT
+            except ValueError:
+                kinds[i] = VARCHAR
+    return zip(kinds, lengths)
+
+
+def defer_primary_key(create_statement):
+    '''
+    Removes the PRIMARY KEY clause from a CREATE TABLE statement, so that
+    the key's index isn't maintained while rows are loaded.
+    RETURNS: (statement, table name, key columns or None)
+    '''
+    table = re.match(r'\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[`"]?(\w+)',
+                     create_statement, re.I).group(1)
+    match = re.search(r',\s*PRIMARY\s+KEY\s*\(([^)]*)\)', create_statement, re.I)
+    if match is None:
+        return create_statement, table, None
+    key = [col.strip(' `"\n') for col in match.group(1).split(',')]
+    return (create_statement[:match.start()] + create_statement[match.end():],
+            table, key)
+
+
+def create_primary_key_index(connection, table, key):
+    '''Builds the unique index that stands in for a deferred primary key.'''
+    logging.info('Indexing %s on (%s)'%(table, ', '.join(key)))
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS pk_%s ON %s (%s)'
+                       %(table, table, ', '.join(key)))
+
+
+class CSVImporter(object):
+    '''
+    Loads CSV files into the tables of an SQLite database.
+    connection: an sqlite3 connection. The rows are committed when the
+        importer is closed, and rolled back if it is closed because of an
+        error.
+    bulk: turn journaling and syncing off while loading. Only for building
+        a new database that is deleted if the load fails, since the rows
+        can then not be rolled back.
+    processes: number of worker processes that parse the files, defaults to
+        the number of CPUs. The processes are only started once a file of
+        more than one range is read. With 1 process, parsing runs in the
+        calling thread.
+    cb: called with the number of bytes loaded so far after each range.
+        It may raise to abort the load.
+
+    Use as a context manager so the worker processes are shut down:
+
+        with CSVImporter(connection) as importer:
+            importer.load('Per_Object', filenames)
+    '''
+    def __init__(self, connection, processes=None, chunk_bytes=CHUNK_BYTES, cb=None,
+                 bulk=False):
+        self.connection = connection
+        self.bulk = bulk
+        self.chunk_bytes = chunk_bytes
+        self.cb = cb
+        self.bytes_done = 0
+        self.rows_loaded = 0
+        self.seconds = 0.0
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = max(1, int(processes))
+        self.pool = None
+        self._pragmas = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(abort=exc_type is not None)
+
+    def close(self, abort=False):
+        try:
+            if abort:
+                self.connection.rollback()
+            else:
+                self.connection.commit()
+        finally:
+            self._restore_pragmas()
+            if self.pool is not None:
+                if abort:
+                    self.pool.terminate()
+                else:
+                    self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def _map(self, fn, tasks):
+        '''
+        Yields fn(task) for each task, in order. Tasks run ahead in the
+        pool, but no more than 2 per process are waiting to be consumed so
+        parsed rows don't pile up in memory.
+        '''
+        if self.processes == 1 or len(tasks) < 2:
+            for task in tasks:
+                yield fn(task)
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(self.pool.apply_async(fn, (task,)))
+            if len(pending) >= 2 * self.processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def infer_column_types(self, filename):
+        '''
+        Returns a list of column types (INT, FLOAT or VARCHAR(#)) that each
+        column of a CSV file can safely be converted to.
+        '''
+        ncols = len(read_header(filename))
+        kinds = [None] * ncols
+        lengths = [0] * ncols
+        tasks = [(filename, start, stop, ncols)
+                 for start, stop in split_csv(filename, self.chunk_bytes)]
+        for result in self._map(infer_range, tasks):
+            for i, (kind, length) in enumerate(result):
+                kinds[i] = max(kinds[i], kind)
+                lengths[i] = max(lengths[i], length)
+        if all(kind is None for kind in kinds):
+            raise Exception, 'Cannot infer column types from an empty table.'
+        return [{INT: 'INT', FLOAT: 'FLOAT'}.get(kind, 'VARCHAR(%d)'%(length))
+                for kind, length in zip(kinds, lengths)]
+
+    def _set_pragmas(self):
+        if not self.bulk or self._pragmas is not None:
+            return
+        self._pragmas = dict((name, self.connection.execute('PRAGMA %s'%(name)).fetchone()[0])
+                             for name in ['synchronous', 'journal_mode', 'cache_size'])
+        # A crash mid-load leaves an incomplete database either way, so
+        # there's nothing for the journal or syncing to protect.
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA cache_size = -%d'%(LOAD_CACHE_KiB))
+
+    def _restore_pragmas(self):
+        if self._pragmas is None:
+            return
+        pragmas, self._pragmas = self._pragmas, None
+        try:
+            for name in ['synchronous', 'journal_mode', 'cache_size']:
+                self.connection.execute('PRAGMA %s = %s'%(name, pragmas[name]))
+        except Exception, e:
+            logging.warn('Could not restore database settings after loading CSVs: %s'%(e))
+
+    def load(self, table, filenames, header=True):
+        '''
+        Appends the rows of the given CSV files to an existing table, and
+        records the files in FILES_TABLE.
+        header: whether the first line of each file is a header line rather
+            than data. The CSVs written by CellProfiler's ExportToDatabase
+            have no header.
+        Each file's record is written in the same transaction as its rows.
+        RETURNS: the number of rows loaded
+        '''
+        self._set_pragmas()
+        self._create_files_table()
+        sqltypes = [row[2] for row in self.connection.execute('PRAGMA table_info(%s)'%(table))]
+        command = 'INSERT INTO %s VALUES (%s)'%(table, ','.join(['?'] * len(sqltypes)))
+        cursor = self.connection.cursor()
+        nrows = 0
+        for filename in filenames:
+            logging.info('Populating %s with data from %s'%(table, filename))
+            t0 = time.time()
+            stat = os.stat(filename)
+            first_rowid = self._max_rowid(table) + 1
+            ranges = split_csv(filename, self.chunk_bytes, header)
+            tasks = [(filename, start, stop, sqltypes) for start, stop in ranges]
+            file_rows = 0
+            digests = []
+            for (start, stop), (rows, digest) in itertools.izip(ranges, self._map(parse_and_digest_range, tasks)):
+                cursor.executemany(command, rows)
+                file_rows += len(rows)
+                digests.append(digest)
+                self.bytes_done += stop - start
+                if self.cb:
+                    self.cb(self.bytes_done)
+            self.connection.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?)'%(FILES_TABLE),
+                                    (table, os.path.abspath(filename), stat.st_size, stat.st_mtime,
+                                     _file_digest(digests), self.chunk_bytes,
+                                     first_rowid, first_rowid + file_rows - 1))
+            seconds = time.time() - t0
+            self.seconds += seconds
+            nrows += file_rows
+            logging.info('... loaded %d rows from %s in %.1fs (%d rows/s)'
+                         %(file_rows, os.path.basename(filename), seconds,
+                           file_rows / max(seconds, 1e-6)))
+        self.rows_loaded += nrows
+        return nrows
+
+    def _create_files_table(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS %s (table_name TEXT, filename TEXT, '
+                                'size INTEGER, mtime REAL, digest TEXT, chunk_bytes INTEGER, '
+                                'first_rowid INTEGER, last_rowid INTEGER, '
+                                'PRIMARY KEY (table_name, filename))'%(FILES_TABLE))
+
+    def _max_rowid(self, table):
+        return self.connection.execute('SELECT IFNULL(MAX(rowid), 0) FROM %s'%(table)).fetchone()[0]
+
+    def has_file_records(self):
+        '''Whether the database records which files its rows came from.'''
+        return self.connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' "
+                                       "AND name=?", (FILES_TABLE,)).fetchone()[0] > 0
+
+    def forget(self, table):
+        '''Drops the file records of a table, eg: when it is recreated.'''
+        if self.has_file_records():
+            self.connection.execute('DELETE FROM %s WHERE table_name=?'%(FILES_TABLE), (table,))
+
+    def digest(self, filename, chunk_bytes, header=True):
+        '''Returns the digest of a file's rows, as recorded by load.'''
+        tasks = [(filename, start, stop) for start, stop in split_csv(filename, chunk_bytes, header)]
+        return _file_digest(list(self._map(digest_range, tasks)))
+
+    def remove(self, table, filename):
+        '''Deletes the rows that were loaded from a file.'''
+        first, last = self.connection.execute('SELECT first_rowid, last_rowid FROM %s '
+                                              'WHERE table_name=? AND filename=?'%(FILES_TABLE),
+                                              (table, filename)).fetchone()
+        logging.info('Removing the rows of %s from %s'%(filename, table))
+        self.connection.execute('DELETE FROM %s WHERE rowid BETWEEN ? AND ?'%(table), (first, last))
+        self.connection.execute('DELETE FROM %s WHERE table_name=? AND filename=?'%(FILES_TABLE),
+                                (table, filename))
+
+    def sync(self, table, filenames, header=True):
+        '''
+        Brings a table up to date with a set of CSV files: files that are
+        new or have changed since they were recorded are (re)loaded, and the
+        rows of recorded files that are no longer in the set are deleted.
+        Files whose modification time changed but whose contents didn't are
+        left alone. Indexes are kept up to date by SQLite as rows change.
+        header: whether the files have a header line, see load.
+        RETURNS: the number of files that were loaded or removed
+        '''
+        self._create_files_table()
+        recorded = dict((row[0], row[1:]) for row in self.connection.execute(
+            'SELECT filename, size, mtime, digest, chunk_bytes FROM %s WHERE table_name=?'
+            %(FILES_TABLE), (table,)))
+        filenames = [os.path.abspath(filename) for filename in filenames]
+        changes = 0
+        for filename in set(recorded) - set(filenames):
+            self.remove(table, filename)
+            changes += 1
+        to_load = []
+        for filename in filenames:
+            if filename in recorded:
+                size, mtime, digest, chunk_bytes = recorded[filename]
+                stat = os.stat(filename)
+                if stat.st_size == size and stat.st_mtime == mtime:
+                    continue
+                if stat.st_size == size and self.digest(filename, chunk_bytes, header) == digest:
+                    # only touched
+                    self.connection.execute('UPDATE %s SET mtime=? WHERE table_name=? AND filename=?'
+                                            %(FILES_TABLE), (stat.st_mtime, table, filename))
+                    continue
+                self.remove(table, filename)
+            to_load.append(filename)
+        if to_load:
+            self.load(table, to_load, header)
+        return changes + len(to_load)
+
+    def rate(self):
+        '''Rows loaded per second so far.'''
+        return self.rows_loaded / max(self.seconds, 1e-6)
@@ -1,5 +1,4 @@
 import logging
-from random import randint
 import numpy as np
 from dbconnect import *
 from singleton import *
@@ -89,58 +88,77 @@ class DataModel(Singleton):
     def GetRandomObject(self):
         '''
         Returns a random object key
-        We expect self.data.keys() to return the keys in the SAME ORDER
-        every time since we build cumSums from that same ordering.  This
-        need not necessarily be in sorted order.
         '''
-        self._if_empty_populate()
-        obIdx = randint(1, self.obCount)
-        imIdx = np.searchsorted(self.cumSums, obIdx, 'left')
-        # SUBTLETY: images which have zero objects will appear as repeated
-        #    sums in the cumulative array, so we must pick the first index
-        #    of any repeated sum, otherwise we are picking an image with no
-        #    objects
-        while self.cumSums[imIdx] == self.cumSums[imIdx-1]:
-            imIdx -= 1
-        imKey = self.data.keys()[imIdx-1]
-        obIdx = obIdx-self.cumSums[imIdx-1]  # object number relative to this image
-                    
-        obKey = db.GetObjectIDAtIndex(imKey, obIdx)
-        return obKey
+        return self.GetRandomObjects(1)[0]
 
-    def GetRandomObjects(self, N, imKeys=None):
+    def _sample_object_indices(self, N, imKeys):
+        '''
+        Draws N objects uniformly (with replacement) from the given images.
+        Returns a list of image keys and an array of 1-based object indices
+        within those images, suitable for db.GetObjectIDsAtIndices.
+        '''
+        counts = np.array([self.data.get(imKey, 0) for imKey in imKeys], dtype='int')
+        sums = np.cumsum(counts)
+        if N < 1 or len(sums) == 0 or sums[-1] < 1:
+            return [], np.zeros(0, dtype='int')
+        obIdx = np.random.randint(0, sums[-1], N)
+        # images with zero objects appear as repeated sums, searching to the
+        # right of each draw skips over them
+        imIdx = np.searchsorted(sums, obIdx, 'right')
+        indices = obIdx - (sums[imIdx] - counts[imIdx]) + 1
+        return [imKeys[i] for i in imIdx], indices
+
+    def GetRandomObjects(self, N, imKeys=None, filter_name=None):
         '''
         Returns N random objects.
-        If a list of imKeys is specified, GetRandomObjects will return 
-        objects from only these images.
+        If a list of imKeys or a filter_name is specified, GetRandomObjects
+        will return objects from only these images.
+        '''
+        self._if_empty_populate()
+        if filter_name is not None:
+            imKeys = self.GetAllImageKeys(filter_name)
+        if imKeys is None:
+            imKeys = self.keylist
+        imKeys = [tuple(imKey) for imKey in imKeys]
+        sampledKeys, indices = self._sample_object_indices(N, imKeys)
+        return [obKey for obKey in db.GetObjectIDsAtIndices(sampledKeys, indices)
+                if obKey is not None]
+
+    def GetStratifiedRandomObjects(self, N, group, filter_name=None):
+        '''
+        Returns N random objects spread as evenly as possible over the keys of
+        the given group, so that small groups are represented as well as
+        large ones. If filter_name is specified, only objects from images
+        within the filter are returned.
         '''
         self._if_empty_populate()
-        if imKeys == None:
-            return [self.GetRandomObject() for i in xrange(N)]
-        elif imKeys == []:
+        if filter_name is not None:
+            allowed = set(tuple(imKey) for imKey in self.GetAllImageKeys(filter_name))
+        strata = []
+        for groupKey, imKeys in self.revGroupMaps[group].items():
+            imKeys = [tuple(imKey) for imKey in imKeys]
+            if filter_name is not None:
+                imKeys = [imKey for imKey in imKeys if imKey in allowed]
+            if sum([self.data.get(imKey, 0) for imKey in imKeys]) > 0:
+                strata.append(imKeys)
+        if N < 1 or len(strata) == 0:
             return []
-        else:
-            sums = np.cumsum([self.data[imKey] for imKey in imKeys])
-            if sums[-1] < 1:
-                return []
-            obs = []
-            for i in xrange(N):
-                obIdx = randint(1, sums[-1])
-                index = np.searchsorted(sums, obIdx, 'left')
-                if index != 0:
-                    while sums[index] == sums[index-1]:
-                        index -= 1
-                    obIdx = obIdx-sums[index-1]
-                obKey = db.GetObjectIDAtIndex(imKeys[index], obIdx)
-                obs.append(obKey)
-            return obs
-            
+        # split N evenly and hand out the remainder to randomly chosen groups
+        nPerStratum = np.zeros(len(strata), dtype='int') + N // len(strata)
+        nPerStratum[np.random.permutation(len(strata))[:N % len(strata)]] += 1
+        sampledKeys = []
+        indices = []
+        for imKeys, n in zip(strata, nPerStratum):
+            keys, idx = self._sample_object_indices(n, imKeys)
+            sampledKeys += keys
+            indices += list(idx)
+        return [obKey for obKey in db.GetObjectIDsAtIndices(sampledKeys, indices)
+                if obKey is not None]
+
     def GetObjectsFromImage(self, imKey):
         self._if_empty_populate()
-        obKeys=[]
-        for i in xrange(1,self.GetObjectCountFromImage(imKey)+1):
-            obKeys.append(db.GetObjectIDAtIndex(imKey, i))
-        return obKeys
+        nObjects = self.GetObjectCountFromImage(imKey)
+        return db.GetObjectIDsAtIndices([imKey] * nObjects, range(1, nObjects + 1))
         # JK - The above code was previously removed in favor of the code below.
         # However the new code is sensitive to objects not having consecutive IDs 
         # in an image, whereas the above code is not making it more robust
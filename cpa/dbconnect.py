@@ -3,21 +3,36 @@ import types
 import random
 from properties import Properties
 from singleton import Singleton
+import sqlaggregates
+from querycache import QueryCache
+import querycache
+from schemacatalog import SchemaCatalog
+from querystats import QueryStats
+import querystats
+import schemacatalog
 from sys import stderr
 import exceptions
 import numpy as np
 import logging
 import string
 import sys
+import itertools
 import threading
+import time
 import traceback
 import re
 import os.path
 import logging
 import copy
+from collections import OrderedDict
 # This module should be usable on systems without wx.
 
 verbose = True
+# Names of the temporary tables made by DBConnect.key_table_clause
+_KEY_TABLE_RE = re.compile(r'\b_cpa_keys_[0-9a-f]{16}\b')
+# Frames in these files are skipped when finding who made a query
+_QUERY_STATS_SKIP = set([sys._getframe().f_code.co_filename,
+                         schemacatalog.SchemaCatalog.columns.im_func.func_code.co_filename])
 
 p = Properties.getInstance()
 
@@ -103,6 +118,129 @@ def get_data_table_from_csv_reader(reader):
     return dtable
 
 
+def rows_to_float_array(rows, ncols=None, dtype=np.float64):
+    '''
+    Converts rows of query results directly into a contiguous 2-D float array
+    without going through strings. NULLs and values that can't be read as
+    numbers become NaN.
+    rows -- list of row tuples as returned by DBConnect.execute
+    ncols -- number of columns, only needed to shape an empty result
+    dtype -- np.float32 or np.float64
+    '''
+    if len(rows) == 0:
+        return np.zeros((0, ncols or 0), dtype=dtype)
+    try:
+        # Fast path: numbers, NULLs (None -> NaN) and numeric strings are
+        # all converted in C.
+        return np.array(rows, dtype=dtype).reshape(len(rows), -1)
+    except (ValueError, TypeError):
+        pass
+    def to_float(val):
+        try:
+            return float(val)
+        except (ValueError, TypeError):
+            return np.nan
+    return np.array([[to_float(val) for val in row] for row in rows], dtype=dtype)
+
+
+def _sql_column_kind(coltype):
+    '''Returns float or int for numeric SQL column types, otherwise None.'''
+    coltype = coltype.upper()
+    if coltype.startswith(('FLOAT', 'DOUBLE', 'REAL', 'DECIMAL', 'NUMERIC')):
+        return float
+    if 'INT' in coltype:
+        return int
+    return None
+
+
+def rows_to_sql_params(rows, coltypes):
+    '''
+    Converts rows of values into a list of tuples of plain Python values
+    that can be bound as query parameters, a column at a time. None and
+    NaN or infinite values in numeric columns become NULL.
+    rows -- list of rows or a 2-D array
+    coltypes -- SQL type of each column, eg: "INT", "FLOAT", "VARCHAR(10)"
+    '''
+    block = np.empty((len(rows), len(coltypes)), dtype=object)
+    block[:] = rows
+    for i, coltype in enumerate(coltypes):
+        col = block[:, i]
+        kind = _sql_column_kind(coltype)
+        if kind is not None:
+            nulls = np.equal(col, None)
+            try:
+                values = np.where(nulls, 0, col).astype(np.float64)
+            except (ValueError, TypeError):
+                # eg: text in a numeric column, let the database deal with it
+                kind = None
+        if kind is None:
+            block[:, i] = [v.item() if isinstance(v, np.generic) else v for v in col]
+            continue
+        nulls |= ~np.isfinite(values)
+        if kind is int and np.all(values[~nulls] == np.floor(values[~nulls])):
+            values = values.astype(np.int64)
+        # astype(object) yields Python floats and ints
+        col = values.astype(object)
+        col[nulls] = None
+        block[:, i] = col
+    return map(tuple, block)
+
+
+def _infer_column_dtype(values):
+    '''
+    Returns a numpy type for a column of query results from the python
+    types of its values: integers become int64 (float64 if there are also
+    NULLs), other numbers become float64 and anything else is an object.
+    '''
+    types_seen = set(type(v) for v in values)
+    has_null = type(None) in types_seen
+    types_seen.discard(type(None))
+    if types_seen and types_seen <= set([int, long, bool]):
+        return 'f8' if has_null else 'i8'
+    if types_seen <= set([int, long, bool, float, decimal.Decimal]):
+        return 'f8'
+    return 'O'
+
+
+def _widen_dtype(dtype, other):
+    '''
+    Returns a structured dtype whose fields can hold the values of the
+    fields of both dtype and other: numbers are widened to the larger
+    numeric type (eg: int64 -> float64), strings to the longer string and
+    a mix of numbers and strings becomes an object field.
+    '''
+    other = np.dtype(other)
+    descr = []
+    for name in dtype.names:
+        a, b = dtype[name], other[name]
+        if a == b:
+            descr.append((name, a))
+        elif 'O' not in (a.kind, b.kind) and \
+                (a.kind == b.kind or (a.kind in 'biuf' and b.kind in 'biuf')):
+            descr.append((name, np.promote_types(a, b)))
+        else:
+            descr.append((name, 'O'))
+    return np.dtype(descr)
+
+
+def _rows_to_structured_array(rows, dtype):
+    '''
+    Converts rows of query results into a structured array of the given
+    dtype. Integer fields in which a NULL turns up are widened to float64
+    and the NULLs become NaN.
+    '''
+    try:
+        return np.array(rows, dtype=dtype)
+    except (TypeError, ValueError):
+        def has_null(i):
+            return any(row[i] is None for row in rows)
+        widened = np.dtype([(name, 'f8' if dtype[name].kind in 'iub' and has_null(i) else dtype[name])
+                            for i, name in enumerate(dtype.names)])
+        if widened == dtype:
+            raise
+        return np.array(rows, dtype=widened)
+
+
 def clean_up_colnames(colnames):
     '''takes a list of column names and makes them so they
     don't have to be quoted in sql syntax'''
@@ -157,12 +295,27 @@ def object_key_columns(table_name=''):
 def object_key_defs():
     return ', '.join(['%s INT'%(id) for id in object_key_columns()])
 
+def _key_table_clause(keys, columns):
+    '''
+    Returns a clause matching the given keys through a temporary table (see
+    DBConnect.key_table_clause) if there are enough of them, else None.
+    '''
+    db = DBConnect.getInstance()
+    if len(keys) < db.key_table_threshold:
+        return None
+    return db.key_table_clause(keys, columns)
+
 def GetWhereClauseForObjects(obkeys, table_name=None):
     '''
     Return a SQL WHERE clause that matches any of the given object keys.
     Example: GetWhereClauseForObjects([(1, 3), (2, 4)]) => "ImageNumber=1 
              AND ObjectNumber=3 OR ImageNumber=2 AND ObjectNumber=4"
+    Large key sets are matched against a temporary table instead, so the
+    clause may only be used in queries run through DBConnect.
     '''
+    clause = _key_table_clause(obkeys, object_key_columns(table_name))
+    if clause is not None:
+        return clause
     if table_name is None:
         table_name = ''
     # To limit the depth of this expression, we split it into a binary tree.
@@ -178,12 +331,39 @@ def GetWhereClauseForObjects(obkeys, table_name=None):
 
     return split(obkeys,table_name)
 
+def GetWhereClauseForObjectsByImage(obkeys, table_name=None):
+    '''
+    Return a SQL WHERE clause that matches any of the given object keys,
+    with one term per image instead of one per object.
+    Example: GetWhereClauseForObjectsByImage([(1, 3), (1, 5), (2, 4)]) => 
+             "(ImageNumber=1 AND ObjectNumber IN (3,5)) OR 
+              (ImageNumber=2 AND ObjectNumber IN (4))"
+    Large key sets are matched against a temporary table instead, so the
+    clause may only be used in queries run through DBConnect.
+    '''
+    clause = _key_table_clause(obkeys, object_key_columns(table_name))
+    if clause is not None:
+        return clause
+    by_image = {}
+    for obkey in obkeys:
+        by_image.setdefault(tuple(obkey[:-1]), []).append(obkey[-1])
+    key_cols = object_key_columns(table_name)
+    return ' OR '.join(['(' + ' AND '.join([col + '=' + str(value) 
+                                            for col, value in zip(key_cols[:-1], imkey)] +
+                                           ['%s IN (%s)'%(key_cols[-1], ','.join([str(o) for o in objects]))]) + ')'
+                        for imkey, objects in sorted(by_image.items())])
+
 def GetWhereClauseForImages(imkeys):
     '''
     Return a SQL WHERE clause that matches any of the given image keys.
     Example: GetWhereClauseForImages([(3,), (4,)]) => 
              "(ImageNumber IN (3, 4))"
+    Large key sets are matched against a temporary table instead, so the
+    clause may only be used in queries run through DBConnect.
     '''
+    clause = _key_table_clause(imkeys, image_key_columns())
+    if clause is not None:
+        return clause
     imkeys.sort()
     if not p.table_id:
         return '%s IN (%s)'%(p.image_id, ','.join([str(k[0]) for k in imkeys]))
@@ -258,6 +438,251 @@ def get_csv_filenames_from_sql_file():
     return imcsvs, obcsvs
 
 
+def cursor_result_dtype(cursor, sample=None):
+    """
+    Return an appropriate descriptor for a numpy array in which the
+    result of the query last run on cursor can be stored.
+    sample -- some rows of the result. SQLite cursors don't describe
+              column types, so for SQLite the types are inferred from
+              these values instead.
+    """
+    names = [d[0] for d in cursor.description]
+    if p.db_type.lower() == 'sqlite':
+        columns = zip(*(sample or [])) or [()] * len(names)
+        return [(name, _infer_column_dtype(col)) for name, col in zip(names, columns)]
+    descr = []
+    for (name, type_code, display_size, internal_size, precision, 
+         scale, null_ok), flags in zip(cursor.description, 
+                                       cursor.description_flags):
+        conversion = cursor.connection.converter.get(type_code)
+        if isinstance(conversion, list):
+            fun2 = None
+            for mask, fun in conversion:
+                fun2 = fun
+                if mask & flags:
+                    break
+        else:
+            fun2 = conversion
+        if fun2 in [decimal.Decimal, types.FloatType]:
+            dtype = 'f8'
+        elif fun2 in [types.IntType]:
+            dtype = 'i4'
+        elif fun2 in [types.LongType]:
+            dtype = 'i8'
+        elif fun2 in [types.StringType] and internal_size > 0:
+            dtype = '|S%d'%(internal_size,)
+        else:
+            dtype = 'O'
+        descr.append((name, dtype))
+    return descr
+
+
+def _connection_is_alive(conn):
+    '''Health check for pooled connections.'''
+    try:
+        if p.db_type.lower() == 'mysql':
+            conn.ping()
+        else:
+            conn.execute('SELECT 1')
+        return True
+    except Exception:
+        return False
+
+
+class ConnectionPool(object):
+    '''
+    A thread-safe, bounded pool of database connections.
+    open_connection -- called to open a new connection when none are idle
+    max_size -- at most this many connections are open (idle or checked
+                out) at once
+    is_alive -- health check run on an idle connection before it is handed
+                out again; connections that fail it are closed and replaced
+    on_close -- called with each connection the pool closes
+    '''
+    def __init__(self, open_connection, max_size=16, is_alive=None, on_close=None):
+        self.open_connection = open_connection
+        self.max_size = max_size
+        self.is_alive = is_alive
+        self.on_close = on_close
+        self._idle = []
+        self._nopen = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        '''The number of open connections.'''
+        return self._nopen
+
+    @property
+    def nidle(self):
+        return len(self._idle)
+
+    def checkout(self, timeout=None):
+        '''
+        Returns an idle connection, or a new one if none are idle. If
+        max_size connections are already checked out, waits up to timeout
+        seconds (forever if None) for one to be returned and then raises
+        DBException.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._nopen >= self.max_size:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise DBException, 'All %d database connections are in use.'%(self.max_size)
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    conn = None
+                    self._nopen += 1
+            # Connect and check health outside the lock, they may be slow
+            if conn is None:
+                try:
+                    return self.open_connection()
+                except:
+                    with self._cond:
+                        self._nopen -= 1
+                        self._cond.notify()
+                    raise
+            if self.is_alive is None or self.is_alive(conn):
+                return conn
+            logging.info('Replacing a lost database connection.')
+            self.discard(conn)
+
+    def checkin(self, conn):
+        '''Returns a checked out connection to the pool.'''
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def discard(self, conn):
+        '''Closes a checked out connection that shouldn't be reused, eg:
+        because it was lost.'''
+        self._close(conn)
+        with self._cond:
+            self._nopen -= 1
+            self._cond.notify()
+
+    def close_all(self):
+        '''Closes the idle connections.'''
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._nopen -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        if self.on_close is not None:
+            self.on_close(conn)
+
+
+class ResultBatches(object):
+    """
+    Iterates over the result of a query in batches of at most batch_size
+    rows, converted to numpy arrays. See DBConnect.iter_batches.
+    dtype -- a numpy type for 2-D batches (NULLs become NaN for float
+             types), or 'structured' or a structured descriptor for
+             structured arrays with one field per column. An inferred
+             structured descriptor is widened for later batches whose
+             values don't fit it, eg: an integer column that turns out to
+             hold NULLs, floats or strings.
+    close_cursor -- close the cursor once the result has been read.
+    release -- called after closing the cursor, eg: to hand a connection
+               used only by this result back to the pool.
+    cancel() may be called from any thread; iteration then stops before
+    the next batch is fetched and the cursor is released.
+    """
+    def __init__(self, cursor, batch_size, dtype=np.float64, close_cursor=True, release=None):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.columns = [d[0] for d in cursor.description or []]
+        self.close_cursor = close_cursor
+        self.release = release
+        self.structured = isinstance(dtype, list) or dtype == 'structured' or \
+                          (isinstance(dtype, np.dtype) and dtype.names is not None)
+        # whether the structured descriptor is inferred from the rows
+        self.inferred = self.structured and dtype == 'structured'
+        if self.structured:
+            self.dtype = None if self.inferred else np.dtype(dtype)
+        else:
+            self.dtype = np.dtype(dtype)
+        self.nrows = 0
+        # seconds spent fetching rows from the cursor
+        self.fetch_time = 0.0
+        self._cancelled = threading.Event()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def next(self):
+        if self._closed or self._cancelled.is_set():
+            self.close()
+            raise StopIteration
+        try:
+            start = time.time()
+            rows = self.cursor.fetchmany(self.batch_size)
+            self.fetch_time += time.time() - start
+        except Exception:
+            self.close()
+            raise
+        if len(rows) == 0:
+            self.close()
+            raise StopIteration
+        self.nrows += len(rows)
+        if not self.structured:
+            if np.issubdtype(self.dtype, np.floating):
+                return rows_to_float_array(rows, len(self.columns), self.dtype)
+            return np.array(rows, dtype=self.dtype).reshape(len(rows), len(self.columns))
+        if self.inferred:
+            # each batch may widen the types inferred from earlier ones
+            dtype = np.dtype(cursor_result_dtype(self.cursor, rows))
+            self.dtype = dtype if self.dtype is None else _widen_dtype(self.dtype, dtype)
+        batch = _rows_to_structured_array(rows, self.dtype)
+        self.dtype = batch.dtype
+        return batch
+
+    def close(self):
+        """Releases the cursor (and connection) without reading the rest
+        of the result. Safe to call more than once."""
+        if getattr(self, '_closed', True):
+            return
+        self._closed = True
+        if not self.close_cursor:
+            return
+        try:
+            self.cursor.close()
+        except Exception, e:
+            logging.debug('Error closing cursor: %s'%(e))
+        if self.release is not None:
+            try:
+                self.release()
+            except Exception, e:
+                logging.debug('Error releasing connection: %s'%(e))
+
+
 class SqliteClassifier():
     def __init__(self):
         pass
@@ -295,6 +720,40 @@ class DBConnect(Singleton):
         #self.link_cols = {}  # link_cols['table'] = columns that link 'table' to the per-image table
         self.sqlite_classifier = SqliteClassifier()
         self.gui_parent = None
+        # Connections are checked out of the pool by connect() and returned
+        # by CloseConnection(), so threads reuse a bounded set of them.
+        self.pool = None
+        self.pool_key = None
+        self.pool_timeout = 60
+        # checked out connection -> the pool it came from
+        self._checked_out = {}
+        self.connection_setup_hooks = []
+        self._connections_lock = threading.RLock()
+        # Results of read-only queries made through execute(), enabled by
+        # the db_query_cache_size property. The data version is looked up
+        # at most every data_version_ttl seconds.
+        self.query_cache = QueryCache(0)
+        self.data_version_ttl = 5
+        self._data_version = None
+        self._data_version_time = None
+        # Column names, types and statistics, kept until CPA changes the
+        # database schema
+        self.schema = SchemaCatalog(self)
+        # Key sets at least this large are loaded into temporary tables by
+        # key_table_clause. The max_key_sets most recently used sets are
+        # kept (name -> keys), and each connection keeps tables for its
+        # max_key_tables most recently used ones (connection -> {name: None}).
+        self.key_table_threshold = 1000
+        self.max_key_sets = 64
+        self.max_key_tables = 8
+        self._key_sets = OrderedDict()
+        self._key_tables = {}
+        # Timings of the queries, by caller. Queries slower than the
+        # db_slow_query_time property are logged with their query plan.
+        self.query_stats = QueryStats()
+        # connID -> (query, args, execution time, caller) of a query run
+        # with return_result=False, recorded once its result has been read
+        self._unread = {}
 
     def __str__(self):
         return string.join([ (key + " = " + str(val) + "\n")
@@ -316,16 +775,17 @@ class DBConnect(Singleton):
             if self.connectionInfo[connID] == (p.db_host, p.db_user, 
                                                (p.db_passwd or None), p.db_name):
                 logging.warn('A connection already exists for this thread. %s as %s@%s (connID = "%s").'%(p.db_name, p.db_user, p.db_host, connID))
+                # It's being replaced, most likely because it was lost
+                self._discard_connection(connID)
             else:
                 raise DBException, 'A connection already exists for this thread (%s). Close this connection first.'%(connID,)
+        self._release_dead_threads()
 
         # MySQL database: connect normally
         if p.db_type.lower() == 'mysql':
-            import MySQLdb
             from MySQLdb.cursors import SSCursor
             try:
-                conn = MySQLdb.connect(host=p.db_host, db=p.db_name, 
-                                       user=p.db_user, passwd=(p.db_passwd or None))
+                conn = self.checkout_connection()
                 self.connections[connID] = conn
                 self.cursors[connID] = SSCursor(conn)
                 self.connectionInfo[connID] = (p.db_host, p.db_user, 
@@ -338,8 +798,6 @@ class DBConnect(Singleton):
             
         # SQLite database: create database from CSVs
         elif p.db_type.lower() == 'sqlite':
-            import sqlite3 as sqlite
-            
             if not p.db_sqlite_file:
                 # Compute a UNIQUE database name for these files
                 import md5
@@ -350,7 +808,17 @@ class DBConnect(Singleton):
                     os.listdir(dbpath)
                 except OSError:
                     os.mkdir(dbpath)
-                if p.db_sql_file:
+                if p.db_sqlite_incremental:
+                    # The database is kept up to date with the CSVs rather
+                    # than rebuilt when they change, so only name it by
+                    # where they are.
+                    if p.db_sql_file:
+                        l = 'incremental%s'%(os.path.abspath(p.db_sql_file))
+                    else:
+                        l = 'incremental%s%s'%(os.path.abspath(p.image_csv_file),
+                                               os.path.abspath(p.object_csv_file))
+                    dbname = 'CPA_DB_%s.db'%(md5.md5(l).hexdigest())
+                elif p.db_sql_file:
                     csv_dir = os.path.split(p.db_sql_file)[0] or '.'
                     imcsvs, obcsvs = get_csv_filenames_from_sql_file()
                     files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
@@ -367,56 +835,9 @@ class DBConnect(Singleton):
                     
                 p.db_sqlite_file = os.path.join(dbpath, dbname)
             logging.info('[%s] SQLite file: %s'%(connID, p.db_sqlite_file))
-            self.connections[connID] = sqlite.connect(p.db_sqlite_file)
-            self.connections[connID].text_factory = str
+            self.connections[connID] = self.checkout_connection()
             self.cursors[connID] = self.connections[connID].cursor()
             self.connectionInfo[connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
-            self.connections[connID].create_function('greatest', -1, max)
-            # Create MEDIAN function
-            class median:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    n = len(self.values)
-                    if n == 0:
-                        return None
-                    self.values.sort()
-                    if n%2 == 1:
-                        return self.values[n//2]
-                    else:
-                        return (self.values[n//2-1] + self.values[n//2]) / 2
-            self.connections[connID].create_aggregate('median', 1, median)
-            # Create STDDEV function
-            class stddev:
-                def __init__(self):
-                    self.reset()
-                def reset(self):
-                    self.values = []
-                def step(self, val):
-                    if val is not None:
-                        if not np.isnan(float(val)):
-                            self.values.append(float(val))
-                def finalize(self):
-                    if len(self.values) == 0:
-                        return None
-                    avg = np.mean(self.values)
-                    b = np.sum([(x-avg)**2 for x in self.values])
-                    std = np.sqrt(b/len(self.values))
-                    return std
-            self.connections[connID].create_aggregate('stddev', 1, stddev)
-            # Create REGEXP function
-            def regexp(expr, item):
-                reg = re.compile(expr)
-                return reg.match(item) is not None
-            self.connections[connID].create_function("REGEXP", 2, regexp)
-            # Create classifier function
-            self.connections[connID].create_function('classifier', -1, self.sqlite_classifier.classify)
             
             try:
                 # Try the connection
@@ -428,23 +849,31 @@ class DBConnect(Singleton):
                 # If this is the first connection, then we need to create the DB from the csv files
                 if len(self.connections) == 1:
                     if p.db_sql_file:
-                        # TODO: prompt user "create db, y/n"
-                        logging.info('[%s] Creating SQLite database at: %s.'%(connID, p.db_sqlite_file))
-                        try:
-                            self.CreateSQLiteDBFromCSVs()
-                        except Exception, e:
-                            try:
-                                if os.path.isfile(p.db_sqlite_file):
-                                    os.remove(p.db_sqlite_file)
-                            except:
-                                pass
-                            raise e
+                        create = self.CreateSQLiteDBFromCSVs
                     elif p.image_csv_file and p.object_csv_file:
-                        # TODO: prompt user "create db, y/n"
-                        logging.info('[%s] Creating SQLite database at: %s.'%(connID, p.db_sqlite_file))
-                        self.CreateSQLiteDB()
+                        create = self.CreateSQLiteDB
                     else:
                         raise DBException, 'Database at %s appears to be empty.'%(p.db_sqlite_file)
+                    # TODO: prompt user "create db, y/n"
+                    logging.info('[%s] Creating SQLite database at: %s.'%(connID, p.db_sqlite_file))
+                    try:
+                        create()
+                    except Exception, e:
+                        # Remove the incomplete database so it isn't loaded
+                        # next time. Its connections are closed first, since
+                        # an open file can't be removed on Windows.
+                        self._discard_connection(connID)
+                        if self.pool is not None:
+                            self.pool.close_all()
+                        try:
+                            if os.path.isfile(p.db_sqlite_file):
+                                os.remove(p.db_sqlite_file)
+                        except OSError:
+                            pass
+                        raise e
+            else:
+                if p.db_sqlite_incremental and not empty_sqlite_db and len(self.connections) == 1:
+                    self.UpdateSQLiteDBFromCSVs()
             if p.classification_type == 'image':
                 self.CreateObjectImageTable()
             logging.debug('[%s] Connected to database: %s'%(connID, p.db_sqlite_file))
@@ -453,6 +882,138 @@ class DBConnect(Singleton):
         else:
             raise DBException, "Unknown db_type in properties: '%s'\n"%(p.db_type)
 
+    def _open_connection(self):
+        '''
+        Opens a new connection to the database in the properties and runs
+        the setup for it. Used by the connection pool.
+        '''
+        if p.db_type.lower() == 'mysql':
+            import MySQLdb
+            conn = MySQLdb.connect(host=p.db_host, db=p.db_name, 
+                                   user=p.db_user, passwd=(p.db_passwd or None))
+        elif p.db_type.lower() == 'sqlite':
+            import sqlite3 as sqlite
+            # The pool makes sure only one thread uses a connection at a
+            # time, but it may not be the thread that opened it.
+            conn = sqlite.connect(p.db_sqlite_file, check_same_thread=False)
+            self._setup_sqlite_connection(conn)
+        else:
+            raise DBException, "Unknown db_type in properties: '%s'\n"%(p.db_type)
+        for hook in self.connection_setup_hooks:
+            hook(conn)
+        return conn
+
+    def _setup_sqlite_connection(self, conn):
+        '''Registers the functions CPA's queries rely on with a new SQLite
+        connection.'''
+        conn.text_factory = str
+        conn.create_function('greatest', -1, max)
+        # Create MEDIAN, STDDEV, PERCENTILE and MAD aggregates
+        sqlaggregates.register(conn)
+        # Create REGEXP function
+        def regexp(expr, item):
+            reg = re.compile(expr)
+            return reg.match(item) is not None
+        conn.create_function("REGEXP", 2, regexp)
+        # Create classifier function
+        conn.create_function('classifier', -1, self.sqlite_classifier.classify)
+
+    def add_connection_setup_hook(self, hook):
+        '''
+        Adds a function that is called with each new database connection,
+        eg: to set PRAGMAs or register SQLite functions. Connections that
+        are already open are not affected.
+        '''
+        self.connection_setup_hooks.append(hook)
+
+    def checkout_connection(self, timeout=None):
+        '''
+        Returns a connection from the pool, opening one if none are idle.
+        If the pool is exhausted, blocks for up to timeout seconds (or
+        pool_timeout if None) and then raises DBException.
+        Connections must be handed back with checkin_connection().
+        '''
+        key = (p.db_type.lower(), p.db_host, p.db_user, p.db_name, p.db_sqlite_file)
+        with self._connections_lock:
+            if self.pool is not None and self.pool_key != key:
+                # The properties now point at a different database
+                self.pool.close_all()
+                self.pool = None
+                self.invalidate_query_cache()
+                self.schema.invalidate()
+                self._key_tables = {}
+            if self.pool is None:
+                self.pool = ConnectionPool(self._open_connection, 
+                                           int(p.db_connection_pool_size or 16),
+                                           is_alive=_connection_is_alive,
+                                           on_close=self._forget_key_tables)
+                self.pool_key = key
+            pool = self.pool
+        conn = pool.checkout(self.pool_timeout if timeout is None else timeout)
+        with self._connections_lock:
+            self._checked_out[conn] = pool
+        return conn
+
+    def checkin_connection(self, conn):
+        '''
+        Hands a connection from checkout_connection back to the pool. It is
+        closed instead if the pool has been replaced since it was checked
+        out, eg: by Disconnect, since it may be to a different database.
+        '''
+        with self._connections_lock:
+            pool = self._checked_out.pop(conn, None)
+            current = pool is not None and pool is self.pool
+        if not current:
+            self._close_connection(pool, conn)
+            return
+        try:
+            conn.commit()
+        except Exception, e:
+            logging.debug('Discarding connection that failed to commit: %s'%(e))
+            pool.discard(conn)
+            return
+        pool.checkin(conn)
+
+    def discard_connection(self, conn):
+        '''Closes a connection from checkout_connection that shouldn't be
+        reused, eg: because it was lost.'''
+        with self._connections_lock:
+            pool = self._checked_out.pop(conn, None)
+        self._close_connection(pool, conn)
+
+    def _close_connection(self, pool, conn):
+        if pool is not None:
+            # also frees its place in the pool
+            pool.discard(conn)
+        else:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._forget_key_tables(conn)
+
+    def _forget_key_tables(self, conn):
+        # The temporary tables went with the connection
+        with self._connections_lock:
+            self._key_tables.pop(conn, None)
+
+    def _discard_connection(self, connID):
+        # Closes a connection that shouldn't go back to the pool
+        with self._connections_lock:
+            self.cursors.pop(connID, None)
+            self.connectionInfo.pop(connID, None)
+            conn = self.connections.pop(connID, None)
+        if conn is None:
+            return
+        self.discard_connection(conn)
+
+    def _release_dead_threads(self):
+        '''Returns the connections of threads that have exited to the pool.'''
+        alive = set(t.getName() for t in threading.enumerate())
+        for connID in self.connections.keys():
+            if connID not in alive:
+                self.CloseConnection(connID)
+
     def setup_sqlite_classifier(self, thresh, a, b):
         self.sqlite_classifier.setup_classifier(thresh, a, b)
 
@@ -463,27 +1024,139 @@ class DBConnect(Singleton):
         self.cursors = {}
         self.connectionInfo = {}
         self.classifierColNames = None
+        # The next connection may be to a different database
+        self.invalidate_query_cache()
+        self.schema.invalidate()
+        self._key_tables = {}
+        if self.pool is not None:
+            self.pool.close_all()
+            self.pool = None
     
     def CloseConnection(self, connID=None):
+        '''Hands the connection of the given thread back to the pool.'''
         if not connID:
             connID = threading.currentThread().getName()
-        if connID in self.connections.keys():
-            try:
-                self.connections[connID].commit()
-            except: pass
-            self.cursors.pop(connID)
-            self.connections.pop(connID).close()
+        with self._connections_lock:
+            if connID not in self.connections.keys():
+                logging.warn('No database connection ID "%s" found!' %(connID))
+                return
+            cursor = self.cursors.pop(connID)
+            conn = self.connections.pop(connID)
             (db_host, db_user, db_passwd, db_name) = self.connectionInfo.pop(connID)
-            logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
-        else:
-            logging.warn('No database connection ID "%s" found!' %(connID))
+            self._unread.pop(connID, None)
+        try:
+            cursor.close()
+        except Exception:
+            pass
+        self.checkin_connection(conn)
+        logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
+
+    def data_version(self):
+        '''
+        Returns a value that changes when the database is modified: the
+        modification time of the object table. It is looked up at most once
+        every data_version_ttl seconds.
+        '''
+        now = time.time()
+        if self._data_version_time is None or now - self._data_version_time > self.data_version_ttl:
+            try:
+                self._data_version = self.get_objects_modify_date()
+            except Exception:
+                self._data_version = None
+            self._data_version_time = now
+        return self._data_version
+
+    def invalidate_query_cache(self, table=None):
+        '''Drops the cached results of queries that mention the given
+        table, or all cached results if no table is given.'''
+        self.query_cache.invalidate(table)
+        self._data_version_time = None
+
+    def _invalidate_written_table(self, query):
+        table = querycache.written_table(query)
+        if table is None:
+            return
+        if len(self.query_cache) > 0:
+            self.invalidate_query_cache(table)
+        # '' means the schema may have changed
+        self.schema.invalidate(table)
+
+    def explain(self, query, args=None):
+        '''
+        Returns the query plan of a SELECT statement (from EXPLAIN QUERY PLAN
+        on SQLite or EXPLAIN on MySQL) as a list of rows, or None if it
+        can't be explained.
+        On MySQL the plan comes from a pooled connection, since the
+        thread's connection may still be streaming a result, so queries of
+        the thread's temporary tables can't be explained. Nor can queries
+        while every pooled connection is in use, rather than waiting for
+        one.
+        '''
+        if not re.match(r'\s*select\b', query, re.I):
+            return None
+        if p.db_type.lower() == 'sqlite':
+            conn = self.connections.get(threading.currentThread().getName())
+            if conn is None:
+                return None
+            # A separate cursor, so that the results of the thread's cursor
+            # are not disturbed
+            cursor = conn.cursor()
+            try:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query)
+                return [tuple(row) for row in cursor.fetchall()]
+            except Exception, e:
+                logging.debug('Could not explain query: %s'%(e))
+                return None
+            finally:
+                cursor.close()
+        try:
+            conn = self.checkout_connection(timeout=0)
+        except Exception, e:
+            logging.debug('Could not explain query: %s'%(e))
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute('EXPLAIN ' + query, args=args)
+            plan = [tuple(row) for row in cursor.fetchall()]
+            cursor.close()
+            return plan
+        except Exception, e:
+            logging.debug('Could not explain query: %s'%(e))
+            return None
+        finally:
+            self.checkin_connection(conn)
+
+    def _record_query(self, query, args, wall_time, fetch_time=0.0, nrows=0, nbytes=0,
+                      cache_hit=False, caller=None):
+        stats = self.query_stats
+        slow = p.db_slow_query_time
+        stats.slow_query_time = None if slow in (None, '') else float(slow)
+        if caller is None:
+            caller = querystats.find_caller(_QUERY_STATS_SKIP)
+        stats.record(caller, query, wall_time, fetch_time, nrows, nbytes, cache_hit)
+        if stats.is_slow(wall_time):
+            stats.record_slow(caller, query, wall_time, nrows, self.explain(query, args))
+
+    def _record_unread(self, connID, fetch_time=0.0, nrows=0):
+        # Records the last query run with return_result=False on the
+        # connection, once its result has been read. Results read with
+        # GetNextResult are recorded without their fetch time when the next
+        # query is run.
+        entry = self._unread.pop(connID, None)
+        if entry is not None:
+            query, args, exec_time, caller = entry
+            self._record_query(query, args, exec_time + fetch_time, fetch_time, nrows,
+                               caller=caller)
 
     @DBDisconnectedException.with_mysql_retry
-    def execute(self, query, args=None, silent=False, return_result=True):
+    def execute(self, query, args=None, silent=False, return_result=True, cache=True):
         '''
         Executes the given query using the connection associated with
         the current thread.  Returns the results as a list of rows
         unless return_result is false.
+        If db_query_cache_size is set, the results of read-only queries
+        are cached unless cache is false. Queries that modify a table
+        drop the cached results that mention it.
         '''
         if p.db_type.lower() == 'sqlite':
             if args:
@@ -498,18 +1171,46 @@ class DBConnect(Singleton):
             cursor = self.cursors[connID]
         except KeyError, e:
             raise DBException, 'No such connection: "%s".\n' %(connID)
+        self._record_unread(connID)
+
+        self.query_cache.max_bytes = int(float(p.db_query_cache_size or 0) * 2**20)
+        cache = (cache and return_result and self.query_cache.enabled and
+                 querycache.is_cacheable(query))
+        if cache:
+            key = self.query_cache.key(query, args, self.data_version())
+            rows = self.query_cache.get(key)
+            if rows is not None:
+                self._record_query(query, args, 0.0, nrows=len(rows), cache_hit=True)
+                return rows
+        key_tables = _KEY_TABLE_RE.findall(query)
+        if key_tables:
+            self._load_key_tables(self.connections[connID], key_tables)
         
         # Finally make the query
         try:
             if verbose and not silent: 
                 logging.debug('[%s] %s'%(connID, query))
+            start = time.time()
             if p.db_type.lower() == 'sqlite':
                 assert args is None
                 cursor.execute(query)
             else:
                 cursor.execute(query, args=args)
-            if return_result:
-                return self._get_results_as_list()
+            executed = time.time()
+            self._invalidate_written_table(query)
+            if not return_result:
+                # On MySQL the rows are streamed as they are read, so the
+                # query is only recorded once they have been
+                self._unread[connID] = (query, args, executed - start,
+                                        querystats.find_caller(_QUERY_STATS_SKIP))
+                return
+            rows = self._get_results_as_list()
+            fetched = time.time()
+            self._record_query(query, args, fetched - start, fetched - executed,
+                               len(rows), querystats.estimate_nbytes(rows))
+            if cache:
+                self.query_cache.put(key, rows)
+            return rows
         except Exception, e:
             try:
                 if isinstance(e, DBOperationalError()) and e.args[0] in [2006, 2013, 1053]:
@@ -524,6 +1225,36 @@ class DBConnect(Singleton):
                                     '\nFirst exception was: %s'
                                     '\nSecond exception was: %s'%(connID, query, e, e2))
             
+    @DBDisconnectedException.with_mysql_retry
+    def execute_many(self, query, rows, silent=True):
+        '''
+        Executes the given parameterized query once for each row, eg: to
+        insert a batch of rows with a single call. Use "%s" as the parameter
+        placeholder for either database type. MySQLdb sends INSERT statements
+        as a single multi-row INSERT.
+        '''
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+        cursor = self.cursors[connID]
+        self._record_unread(connID)
+        if p.db_type.lower() == 'sqlite':
+            query = query.replace('%s', '?')
+        try:
+            if verbose and not silent:
+                logging.debug('[%s] %s'%(connID, query))
+            start = time.time()
+            cursor.executemany(query, rows)
+            self._record_query(query, None, time.time() - start,
+                               nrows=hasattr(rows, '__len__') and len(rows) or 0)
+            self._invalidate_written_table(query)
+        except Exception, e:
+            if isinstance(e, DBOperationalError()) and e.args[0] in [2006, 2013, 1053]:
+                raise DBDisconnectedException()
+            raise DBException, ('Database query failed for connection "%s"'
+                                '\nQuery was: "%s"'
+                                '\nException was: %s'%(connID, query, e))
+
     def Commit(self):
         connID = threading.currentThread().getName()
         try:
@@ -555,48 +1286,220 @@ class DBConnect(Singleton):
         connID = threading.currentThread().getName()
         return list(self.cursors[connID].fetchall())
 
-    def result_dtype(self):
+    def result_dtype(self, sample=None):
         """
         Return an appropriate descriptor for a numpy array in which the
-        result can be stored.
+        result of the last query can be stored. See cursor_result_dtype.
+        """
+        return cursor_result_dtype(self.cursors[threading.currentThread().getName()], sample)
+
+    def get_results_as_structured_array(self, n=None, dtype=None):
+        """
+        Returns the remaining results of the last query as a structured
+        array with one field per column.
+        n -- number of rows to fetch from the cursor at a time
+        dtype -- descriptor of the result, inferred with result_dtype if
+                 not given
+        Integer columns holding NULLs are widened to float with NaNs.
         """
-        #XXX: This doesn't work for SQLite... no cursor.description_flags
         cursor = self.cursors[threading.currentThread().getName()]
-        descr = []
-        for (name, type_code, display_size, internal_size, precision, 
-             scale, null_ok), flags in zip(cursor.description, 
-                                           cursor.description_flags):
-            conversion = cursor.connection.converter[type_code]
-            if isinstance(conversion, list):
-                fun2 = None
-                for mask, fun in conversion:
-                    fun2 = fun
-                    if mask & flags:
-                        break
-            else:
-                fun2 = conversion
-            if fun2 in [decimal.Decimal, types.FloatType]:
-                dtype = 'f8'
-            elif fun2 in [types.IntType, types.LongType]:
-                dtype = 'i4'
-            elif fun2 in [types.StringType]:
-                dtype = '|S%d'%(internal_size,)
-            descr.append((name, dtype))
-        return descr
-
-    def get_results_as_structured_array(self, n=None):
-        #XXX: this doesn't work for SQLite
-        col_names = self.GetResultColumnNames()
+        batches = ResultBatches(cursor, n or 10000, dtype or 'structured', close_cursor=False)
+        chunks = list(batches)
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=batches.dtype or self.result_dtype())
+        if len(chunks) == 1:
+            return chunks[0]
+        # a later chunk may have widened a column, eg: a NULL or a float
+        # in an integer column
+        return np.concatenate([c.astype(batches.dtype) for c in chunks])
+
+    def execute_as_structured_array(self, query, dtype=None, chunk_size=10000, silent=False):
+        """
+        Executes the given query and returns the result as a structured
+        array with one field per column. See get_results_as_structured_array.
+        """
+        self.execute(query, silent=silent, return_result=False)
+        start = time.time()
+        result = self.get_results_as_structured_array(chunk_size, dtype)
+        self._record_unread(threading.currentThread().getName(), time.time() - start, len(result))
+        return result
+
+    def execute_as_array(self, query, dtype=np.float64, chunk_size=10000, silent=False):
+        """
+        Executes the given query and returns the result as a 2-D array of
+        the given type, filled one chunk of rows at a time so the whole
+        result never has to be held as a list of tuples. For float types,
+        NULLs and values that can't be read as numbers become NaN.
+        """
+        self.execute(query, silent=silent, return_result=False)
+        start = time.time()
         connID = threading.currentThread().getName()
-        records = []
-        while True:
-            r = self.cursors[connID].fetchmany(n)
-            print len(r)
-            if len(r) == 0:
-                break
-            records.extend(list(r))
-        return np.array(records, dtype=self.result_dtype())
+        cursor = self.cursors[connID]
+        ncols = len(cursor.description)
+        result = np.empty((chunk_size, ncols), dtype=dtype)
+        filled = 0
+        for chunk in ResultBatches(cursor, chunk_size, dtype, close_cursor=False):
+            if filled + len(chunk) > len(result):
+                result = np.resize(result, (2 * len(result), ncols))
+            result[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+        self._record_unread(connID, time.time() - start, filled)
+        return result[:filled]
+
+    def iter_batches(self, query, batch_size=10000, dtype=np.float64, silent=False):
+        """
+        Executes the given query and returns a ResultBatches iterator that
+        yields the result batch_size rows at a time, so that results larger
+        than memory can be processed.
+        dtype -- a numpy type for 2-D batches, or 'structured' for
+                 structured arrays with one field per column
+
+        On MySQL the rows are streamed from the server through a separate
+        pooled connection, since the thread's own connection can't run other
+        queries until an unbuffered result has been read. On SQLite a
+        separate cursor is stepped on the thread's connection. Either is
+        released when iteration finishes, fails, or is cancelled or closed:
+
+            with db.iter_batches(query) as batches:
+                for batch in batches:
+                    ...
+        """
+        connID = threading.currentThread().getName()
+        if verbose and not silent:
+            logging.debug('[%s] (batches) %s'%(connID, query))
+        caller = querystats.find_caller(_QUERY_STATS_SKIP)
+        connection = None
+        try:
+            start = time.time()
+            if p.db_type.lower() == 'mysql':
+                from MySQLdb.cursors import SSCursor
+                connection = self.checkout_connection()
+                cursor = SSCursor(connection)
+            else:
+                if not connID in self.connections.keys():
+                    self.connect()
+                cursor = self.connections[connID].cursor()
+            key_tables = _KEY_TABLE_RE.findall(query)
+            if key_tables:
+                self._load_key_tables(connection or self.connections[connID], key_tables)
+            cursor.execute(query)
+        except Exception, e:
+            if connection is not None:
+                self.discard_connection(connection)
+            raise DBException, ('Database query failed for connection "%s"'
+                                '\nQuery was: "%s"'
+                                '\nException was: %s'%(connID, query, e))
+        executed = time.time()
+        batches = ResultBatches(cursor, batch_size, dtype)
+        def release():
+            # The result has been read (or abandoned)
+            self._record_query(query, None, executed - start + batches.fetch_time,
+                               batches.fetch_time, batches.nrows, caller=caller)
+            if connection is not None:
+                self.checkin_connection(connection)
+        batches.release = release
+        return batches
     
+    def key_table_clause(self, keys, columns):
+        '''
+        Returns a WHERE clause that matches rows whose columns hold any of
+        the given integer keys, eg: "(ImageNumber, ObjectNumber) IN (SELECT
+        k0, k1 FROM _cpa_keys_...)". The keys are loaded into an indexed
+        temporary table on the calling thread's connection. Returns None if
+        that isn't possible, eg: the keys aren't integers or the database
+        user may not create temporary tables.
+        Tables are named after the keys they hold, so a repeated key set
+        reuses its table and queries that use it can be cached. Queries run
+        through execute or iter_batches load the tables they name into the
+        connection that runs them, so a clause may be used on any thread as
+        long as its keys are among the max_key_sets most recently used.
+        Loading a table commits the connection's open transaction, since
+        its rows would otherwise be lost if that transaction were rolled
+        back.
+        '''
+        import hashlib
+        import sqlite3
+        try:
+            keys = sorted(set(tuple(int(v) for v in key) for key in keys))
+        except (TypeError, ValueError):
+            return None
+        if len(keys) == 0:
+            return None
+        ncols = len(keys[0])
+        if ncols > 1 and p.db_type.lower() == 'sqlite' and sqlite3.sqlite_version_info < (3, 15):
+            # IN with row values needs SQLite 3.15
+            return None
+        name = '_cpa_keys_%s'%(hashlib.sha1(repr(keys)).hexdigest()[:16])
+        cols = ['k%d'%(i) for i in range(ncols)]
+        with self._connections_lock:
+            self._key_sets.pop(name, None)
+            self._key_sets[name] = keys
+            while len(self._key_sets) > self.max_key_sets:
+                self._key_sets.popitem(last=False)
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+        try:
+            self._load_key_tables(self.connections[connID], [name])
+        except DBException, e:
+            logging.warn('%s\nMatching the keys without a temporary table.'%(e))
+            return None
+        if ncols == 1:
+            return '%s IN (SELECT k0 FROM %s)'%(columns[0], name)
+        return '(%s) IN (SELECT %s FROM %s)'%(', '.join(columns), ', '.join(cols), name)
+
+    def _load_key_tables(self, conn, names):
+        '''
+        Makes sure the connection has the named key tables, creating the
+        ones it doesn't from the remembered key sets. Their tables are
+        marked as the connection's most recently used, and its least
+        recently used tables beyond max_key_tables are dropped.
+        '''
+        with self._connections_lock:
+            tables = self._key_tables.setdefault(conn, OrderedDict())
+            missing = []
+            for name in names:
+                if name in tables:
+                    tables[name] = tables.pop(name)
+                else:
+                    missing.append((name, self._key_sets.get(name)))
+        if not missing:
+            return
+        # These tables are private to the connection and named after
+        # their content, so they go straight to a cursor rather than
+        # through execute, which would drop the query and schema caches.
+        cursor = conn.cursor()
+        placeholder = p.db_type.lower() == 'sqlite' and '?' or '%s'
+        try:
+            for name, keys in missing:
+                if keys is None:
+                    raise DBException, ('The keys of temporary table %s are no longer '
+                                        'known, get a new clause for them.'%(name))
+                cols = ['k%d'%(i) for i in range(len(keys[0]))]
+                try:
+                    cursor.execute('CREATE TEMPORARY TABLE %s (%s, PRIMARY KEY (%s))'
+                                   %(name, ', '.join([c + ' BIGINT' for c in cols]), ', '.join(cols)))
+                    cursor.executemany('INSERT INTO %s VALUES (%s)'
+                                       %(name, ', '.join([placeholder] * len(cols))), keys)
+                    conn.commit()
+                except Exception, e:
+                    try:
+                        cursor.execute('DROP TABLE IF EXISTS %s'%(name))
+                    except Exception:
+                        pass
+                    raise DBException, ('Could not load %d keys into temporary table %s'
+                                        '\nException was: %s'%(len(keys), name, e))
+                logging.debug('Loaded %d keys into temporary table %s'%(len(keys), name))
+                with self._connections_lock:
+                    tables[name] = None
+                    old = []
+                    while len(tables) > max(self.max_key_tables, len(names)):
+                        old.append(tables.popitem(last=False)[0])
+                for old_name in old:
+                    cursor.execute('DROP TABLE IF EXISTS %s'%(old_name))
+        finally:
+            cursor.close()
+
     def GetObjectIDAtIndex(self, imKey, index):
         '''
         Returns the true object ID of the nth object in an image.
@@ -611,6 +1514,53 @@ class DBConnect(Singleton):
         object_number = object_number[0][0]
         return tuple(list(imKey)+[int(object_number)])
     
+    def GetObjectIDsAtIndices(self, imKeys, indices, chunk_size=500):
+        '''
+        Batch version of GetObjectIDAtIndex: returns the object key of the
+        nth object in each image, in the same order as the input.
+        imKeys: list of image keys (repeats are fine)
+        indices: list of POSITIVE integers (1,2,3...), one per image key
+        chunk_size: number of distinct images resolved per query
+        Objects are ordered by object id within each image. Images whose
+        object ids are contiguous are resolved from their MIN/MAX/COUNT alone,
+        only images with gaps in their ids have their ids fetched. A key is
+        None if its image has no objects.
+        '''
+        imKeys = [tuple(int(k) for k in imKey) for imKey in imKeys]
+        positions = {}
+        for pos, imKey in enumerate(imKeys):
+            positions.setdefault(imKey, []).append(pos)
+        nkey = len(image_key_columns())
+        obKeys = [None] * len(imKeys)
+        unique_keys = sorted(positions.keys())
+        for start in xrange(0, len(unique_keys), chunk_size):
+            chunk = unique_keys[start:start + chunk_size]
+            where_clause = GetWhereClauseForImages(list(chunk))
+            res = self.execute('SELECT %s, MIN(%s), MAX(%s), COUNT(*) FROM %s WHERE %s GROUP BY %s'
+                               %(UniqueImageClause(), p.object_id, p.object_id, p.object_table,
+                                 where_clause, UniqueImageClause()))
+            ranges = dict((tuple(int(v) for v in r[:nkey]), tuple(int(v) for v in r[nkey:]))
+                          for r in res)
+            gapped = [imKey for imKey, (lo, hi, count) in ranges.items() if hi - lo + 1 != count]
+            object_ids = {}
+            if gapped:
+                res = self.execute('SELECT %s, %s FROM %s WHERE %s ORDER BY %s, %s'
+                                   %(UniqueImageClause(), p.object_id, p.object_table,
+                                     GetWhereClauseForImages(list(gapped)), UniqueImageClause(),
+                                     p.object_id))
+                for r in res:
+                    object_ids.setdefault(tuple(int(v) for v in r[:nkey]), []).append(int(r[nkey]))
+            for imKey in chunk:
+                if imKey not in ranges:
+                    continue
+                for pos in positions[imKey]:
+                    if imKey in object_ids:
+                        object_number = object_ids[imKey][indices[pos] - 1]
+                    else:
+                        object_number = ranges[imKey][0] + indices[pos] - 1
+                    obKeys[pos] = imKey + (int(object_number),)
+        return obKeys
+
     def GetPerImageObjectCounts(self):
         '''
         Returns a list of (imKey, obCount) tuples. 
@@ -655,6 +1605,55 @@ class DBConnect(Singleton):
         else:
             return res[0]
     
+    def GetObjectsCoords(self, obKeys, chunk_size=500, silent=False):
+        '''
+        Batch version of GetObjectCoords: returns a dict mapping each of the
+        given object keys to its x, y coordinates. Objects are grouped by
+        image and fetched with one query per chunk_size images. Raises an
+        Exception if any object or its coordinates are missing.
+        '''
+        coords = {}
+        for obKey, row in self._iter_object_rows(obKeys, [p.cell_x_loc, p.cell_y_loc], 
+                                                 chunk_size, silent):
+            coords[obKey] = row
+        for obKey in obKeys:
+            obKey = tuple(obKey)
+            if obKey not in coords or None in coords[obKey]:
+                message = ('Failed to load coordinates for object key %s. This may '
+                           'indicate a problem with your per-object table.\n'
+                           'You can check your per-object table "%s" in TableViewer'
+                           %(', '.join(['%s:%s'%(col, val) for col, val in 
+                                        zip(object_key_columns(), obKey)]), 
+                           p.object_table))
+                raise Exception(message)
+        return coords
+
+    def _iter_object_rows(self, obKeys, columns, chunk_size=500, silent=True, cb=None):
+        '''
+        Yields (obKey, row) for the given object keys, where row holds the
+        values of columns. The keys are grouped by image and fetched with
+        one query per chunk_size images. Keys that are not in the object
+        table are skipped. cb, if given, is called with the fraction of
+        keys fetched after each query.
+        '''
+        nkey = len(object_key_columns())
+        by_image = {}
+        for obKey in obKeys:
+            by_image.setdefault(tuple(obKey[:-1]), []).append(tuple(obKey))
+        imKeys = sorted(by_image.keys())
+        num_fetched = 0
+        for start in xrange(0, len(imKeys), chunk_size):
+            chunk = [obKey for imKey in imKeys[start:start + chunk_size] 
+                     for obKey in by_image[imKey]]
+            res = self.execute('SELECT %s, %s FROM %s WHERE %s'
+                               %(UniqueObjectClause(), ', '.join(columns), p.object_table,
+                                 GetWhereClauseForObjectsByImage(chunk)), silent=silent)
+            for row in res:
+                yield tuple(int(v) for v in row[:nkey]), row[nkey:]
+            num_fetched += len(chunk)
+            if cb is not None:
+                cb(num_fetched / float(len(obKeys)))
+
     def GetAllObjectCoordsFromImage(self, imKey):
         ''' Returns a list of lists x, y coordinates for all objects in the given image. '''
         select = 'SELECT '+p.cell_x_loc+', '+p.cell_y_loc+' FROM '+p.object_table+' WHERE '+GetWhereClauseForImages([imKey])+' ORDER BY '+p.object_id
@@ -803,9 +1802,7 @@ class DBConnect(Singleton):
         
     def GetColumnNames(self, table):
         '''Returns a list of the column names for the specified table. '''
-        # NOTE: SQLite doesn't like DESCRIBE or SHOW statements so we do it this way.
-        self.execute('SELECT * FROM %s LIMIT 1'%(table))
-        return self.GetResultColumnNames()   # return the column names
+        return self.schema.column_names(table)
     
 
     
@@ -1039,12 +2036,7 @@ class DBConnect(Singleton):
             
     def GetColumnTypeStrings(self, table):
         '''Returns the SQL type string for each column of the given table.'''
-        if p.db_type.lower() == 'sqlite':
-            res = self.execute('PRAGMA table_info(%s)'%(table))
-            return [r[2] for r in res]
-        elif p.db_type == 'mysql':
-            res = self.execute('SHOW COLUMNS FROM %s'%(table))
-            return [r[1] for r in res]
+        return self.schema.column_types(table)
         
     def GetColumnTypeString(self, table, colname):
         '''Returns the SQL type string for a given table column. '''
@@ -1088,10 +2080,8 @@ class DBConnect(Singleton):
 
             if exclude_features_with_no_variance:
                 # ignore columns which have no variance
-                cq = ', '.join(['MAX(%s)-MIN(%s)'%(col,col) for col in col_names])
-                res = np.array(self.execute('SELECT %s FROM %s'%(cq, p.object_table))[0])
-                ignore_cols = np.array(col_names)[np.where(res==0)[0]]                
-                for colname in ignore_cols:
+                stats = self.schema.column_stats(p.object_table, self.classifierColNames)
+                for colname in [col for col in self.classifierColNames if stats[col].is_constant()]:
                     self.classifierColNames.remove(colname)            
                     logging.warn('Ignoring column "%s" because it has zero variance'%(colname))
             
@@ -1127,9 +2117,7 @@ class DBConnect(Singleton):
         if len(data) == 0:
             logging.error('No data for obKey: %s'%str(obKey))
             return None
-        # This should be the case
-        assert all([type(x) in [int, long, float] for x in data[0]])
-        return np.array(data[0])
+        return rows_to_float_array(data[:1])[0]
 
     def GetCellData(self, obKey):
         '''
@@ -1141,8 +2129,28 @@ class DBConnect(Singleton):
             logging.error('No data for obKey: %s'%str(obKey))
             return None
         # fetch out only numeric data
-        values = [x if type(x) in [int, long, float] else 0.0 for x in data[0]]
-        return np.array(values)
+        return np.nan_to_num(rows_to_float_array(data[:1])[0])
+
+    def GetCellDataForObjects(self, obKeys, chunk_size=500, cb=None):
+        '''
+        Batch version of GetCellData: returns a dict mapping object keys to
+        their measurements (every column of the object table, as floats).
+        Objects are grouped by image and fetched with one query per
+        chunk_size images. Objects that are not found are left out.
+        cb, if given, is called with the fraction of keys fetched so far.
+        '''
+        if not obKeys:
+            return {}
+        keys = []
+        rows = []
+        for obKey, row in self._iter_object_rows(obKeys, ['%s.*'%(p.object_table)], 
+                                                 chunk_size, cb=cb):
+            keys.append(obKey)
+            rows.append(row)
+        if not rows:
+            return {}
+        data = np.nan_to_num(rows_to_float_array(rows))
+        return dict(zip(keys, data))
 
     def GetPlateNames(self):
         '''
@@ -1236,76 +2244,38 @@ class DBConnect(Singleton):
         Creates an SQLite database from files specified in properties
         image_csv_file and object_csv_file.
         '''
-        import csv
-        # CREATE THE IMAGE TABLE
-        # All the ugly code is to establish the type of each column in the table
-        # so we can form a proper CREATE TABLE statement.
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        columnLabels = r.next()
-        columnLabels = [lbl.strip() for lbl in columnLabels]
-        dtable = get_data_table_from_csv_reader(r)
-        colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-        
-        # Build the CREATE TABLE statement
-        statement = 'CREATE TABLE '+p.image_table+' ('
-        statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
-        keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
-        statement += ',\nPRIMARY KEY (' + keys + ') )'
-        f.close()
-        
-        logging.info('Creating table: %s'%(p.image_table))
-        self.execute('DROP TABLE IF EXISTS %s'%(p.image_table))
-        self.execute(statement)
-
+        import csvimport
+        tables = [(p.image_table, p.image_csv_file)]
         if not p.classification_type == 'image':
-            # CREATE THE OBJECT TABLE
-            # For the object table we assume that all values are type FLOAT
-            # except for the primary keys
-            f = open(p.object_csv_file, 'U')
-            r = csv.reader(f)
-            columnLabels = r.next()
-            columnLabels = [lbl.strip() for lbl in columnLabels]
-            dtable = get_data_table_from_csv_reader(r)
-            colTypes = self.InferColTypesFromData(dtable, len(columnLabels))
-            statement = 'CREATE TABLE '+p.object_table+' ('
-            statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
-            keys = ','.join([x for x in [p.table_id, p.image_id, p.object_id] if x in columnLabels])
-            statement += ',\nPRIMARY KEY (' + keys + ') )'
-            f.close()
-
-            logging.info('Creating table: %s'%(p.object_table))
-            self.execute('DROP TABLE IF EXISTS '+p.object_table)
-            self.execute(statement)
-        
-        # POPULATE THE IMAGE TABLE
-        f = open(p.image_csv_file, 'U')
-        r = csv.reader(f)
-        row = r.next() # skip the headers
-        row = r.next()
-        while row: 
-            self.execute('INSERT INTO '+p.image_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                         silent=True)
-            try:
-                row = r.next()
-            except StopIteration:
-                break
-        f.close()
-        
-        # POPULATE THE OBJECT TABLE
-        if not p.classification_type == 'image':
-            f = open(p.object_csv_file, 'U')
-            r = csv.reader(f)
-            row = r.next() # skip the headers
-            row = r.next()
-            while row:
-                self.execute('INSERT INTO '+p.object_table+' VALUES ('+','.join(["'%s'"%(i) for i in row])+')',
-                             silent=True)
-                try:
-                    row = r.next()
-                except StopIteration: break
-            f.close()
-        
+            tables += [(p.object_table, p.object_csv_file)]
+
+        connID = threading.currentThread().getName()
+        conn = self.connections[connID]
+        primary_keys = []
+        with csvimport.CSVImporter(conn, bulk=True) as importer:
+            for table, filename in tables:
+                # Establish the type of each column in the table so we can
+                # form a proper CREATE TABLE statement.
+                columnLabels = csvimport.read_header(filename)
+                colTypes = importer.infer_column_types(filename)
+                statement = 'CREATE TABLE '+table+' ('
+                statement += ',\n'.join([lbl+' '+colTypes[i] for i, lbl in enumerate(columnLabels)])
+                statement += ')'
+                logging.info('Creating table: %s'%(table))
+                self.execute('DROP TABLE IF EXISTS %s'%(table))
+                self.execute(statement)
+                importer.forget(table)
+                # The primary key is indexed after the rows are loaded
+                primary_keys += [(table, [x for x in [p.table_id, p.image_id, p.object_id]
+                                          if x in columnLabels])]
+            for table, filename in tables:
+                importer.load(table, [filename])
+        logging.info('Loaded %d rows at %d rows/s'%(importer.rows_loaded, importer.rate()))
+        self.invalidate_query_cache()
+        self.schema.invalidate()
+        for table, key in primary_keys:
+            if key:
+                csvimport.create_primary_key_index(conn, table, key)
         self.Commit()
         
     def CreateSQLiteDBFromCSVs(self):
@@ -1313,7 +2283,7 @@ class DBConnect(Singleton):
         Creates an SQLite database from files generated by CellProfiler's
         ExportToDatabase module.
         '''
-        import csv
+        import csvimport
         
         imcsvs, obcsvs = get_csv_filenames_from_sql_file()
                 
@@ -1348,14 +2318,20 @@ class DBConnect(Singleton):
                     in_create_stmt = True
         f.close()
         
+        # Primary keys are indexed after the rows are loaded, which is much
+        # cheaper than maintaining the index on every insert.
+        primary_keys = []
         for q in create_stmts:
+            q, table, key = csvimport.defer_primary_key(q)
             self.execute(q)
+            if key:
+                primary_keys.append((table, key))
         
-        import wx
-        if self.gui_parent is not None and issubclass(self.gui_parent.__class__, wx.Window):
-            dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
-        else:
-            dlg = None
+        dlg = None
+        if self.gui_parent is not None:
+            import wx
+            if issubclass(self.gui_parent.__class__, wx.Window):
+                dlg = wx.ProgressDialog('Creating sqlite DB...', '0% Complete', 100, self.gui_parent, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
 
         # find the number of bytes we're going to read
         total_bytes = 0
@@ -1363,81 +2339,90 @@ class DBConnect(Singleton):
             total_bytes += os.path.getsize(os.path.join(csv_dir, file))
         total_bytes = float(total_bytes)
 
-        base_bytes = 0
-        connID = threading.currentThread().getName()
-        # populate tables with contents of csv files
-        for file in imcsvs:
-            logging.info('Populating image table with data from %s'%file)
-            f = open(os.path.join(csv_dir, file), 'U')
-            r = csv.reader(f)
-            row1 = r.next()
-            command = 'INSERT INTO '+p.image_table+' VALUES ('+','.join(['?' for i in row1])+')'
-            self.cursors[connID].execute(command, row1)
-            self.cursors[connID].executemany(command, [l for l in r if len(l)>0])
-            f.close()
-            base_bytes += os.path.getsize(os.path.join(csv_dir, file))
-            pct = min(int(100 * base_bytes / total_bytes), 100)
+        def update(bytes_done):
+            pct = min(int(100 * bytes_done / total_bytes), 100)
             if dlg:
                 c, s = dlg.Update(pct, '%d%% Complete'%(pct))
                 if not c:
-                    try:
-                        os.remove(p.db_sqlite_file)
-                    except OSError:
-                        wx.MessageBox('Could not remove incomplete database'
-                                      ' at "%s". This file must be removed '
-                                      'manually or CPAnalyst will load it '
-                                      'the next time use use the current '
-                                      'database settings.', 'Error')
                     raise Exception, 'cancelled load'
             logging.info("... loaded %d%% of CSV data"%(pct))
 
-        line_count = 0
         if not p.classification_type == 'image':
             assert len(obcsvs)>0, ('Failed to parse object csv filenames from %s. '
                               'Make sure db_sql_file in your properties file is'
                               ' set to the .SQL file output by CellProfiler\'s '
                               'ExportToDatabase module.'%(os.path.split(p.db_sql_file)[1]))
 
-            for file in obcsvs:
-                logging.info('Populating object table with data from %s'%file)
-                f = open(csv_dir+os.path.sep+file, 'U')
-                r = csv.reader(f)
-                row1 = r.next()
-                command = 'INSERT INTO '+p.object_table+' VALUES ('+','.join(['?' for i in row1])+')'
-                # guess at a good number of lines, about 250 megabytes, assuming floats)
-                nlines = (250*1024*1024) / (len(row1) * 64)
-                self.cursors[connID].execute(command, row1)
-                while True:
-                    # fetch a certain number of lines efficiently
-                    args = [l for idx, l in zip(range(nlines), r) if len(l) > 0]
-                    if args == []:
-                        break
-                    self.cursors[connID].executemany(command, args)
-                    line_count += len(args)
-
-                    pct = min(int(100 * (f.tell() + base_bytes) / total_bytes), 100)
-                    if dlg:
-                        c, s = dlg.Update(pct, '%d%% Complete'%(pct))
-                        if not c:
-                            try:
-                                os.remove(p.db_sqlite_file)
-                            except OSError:
-                                wx.MessageBox('Could not remove incomplete database'
-                                              ' at "%s". This file must be removed '
-                                              'manually or CPAnalyst will load it '
-                                              'the next time use use the current '
-                                              'database settings.', 'Error')
-                            raise Exception, 'cancelled load'
-                    logging.info("... loaded %d%% of CSV data"%(pct))
-                f.close()
-                logging.info("Finished loading CSV data")
-                base_bytes += os.path.getsize(os.path.join(csv_dir, file))
+        # populate tables with contents of csv files
+        connID = threading.currentThread().getName()
+        conn = self.connections[connID]
+        try:
+            with csvimport.CSVImporter(conn, cb=update, bulk=True) as importer:
+                # ExportToDatabase writes CSVs without header lines
+                importer.load(p.image_table, [os.path.join(csv_dir, file) for file in imcsvs],
+                              header=False)
+                if not p.classification_type == 'image':
+                    importer.load(p.object_table, [os.path.join(csv_dir, file) for file in obcsvs],
+                                  header=False)
+        except Exception, e:
+            if dlg and str(e) == 'cancelled load':
+                dlg.Destroy()
+                try:
+                    os.remove(p.db_sqlite_file)
+                except OSError:
+                    wx.MessageBox('Could not remove incomplete database'
+                                  ' at "%s". This file must be removed '
+                                  'manually or CPAnalyst will load it '
+                                  'the next time use use the current '
+                                  'database settings.', 'Error')
+            raise
+        logging.info("Finished loading CSV data: %d rows at %d rows/s"
+                     %(importer.rows_loaded, importer.rate()))
+        self.invalidate_query_cache()
+        self.schema.invalidate()
 
+        for table, key in primary_keys:
+            csvimport.create_primary_key_index(conn, table, key)
         # Commit only at very end. No use in committing if the db is incomplete.
         self.Commit()
         if dlg:
             dlg.Destroy()
 
+    def UpdateSQLiteDBFromCSVs(self):
+        '''
+        Brings an SQLite database created from CSV files up to date with
+        them: CSVs that are new or have changed since the database was
+        created are loaded, and the rows of CSVs that are no longer listed
+        are deleted. See csvimport.CSVImporter.sync.
+        '''
+        import csvimport
+        if p.db_sql_file:
+            csv_dir = os.path.split(p.db_sql_file)[0] or '.'
+            imcsvs, obcsvs = get_csv_filenames_from_sql_file()
+            tables = [(p.image_table, [os.path.join(csv_dir, file) for file in imcsvs]),
+                      (p.object_table, [os.path.join(csv_dir, file) for file in obcsvs])]
+            # ExportToDatabase writes CSVs without header lines
+            header = False
+        elif p.image_csv_file and p.object_csv_file:
+            tables = [(p.image_table, [p.image_csv_file]), (p.object_table, [p.object_csv_file])]
+            header = True
+        else:
+            return
+        if p.classification_type == 'image':
+            tables = tables[:1]
+        connID = threading.currentThread().getName()
+        with csvimport.CSVImporter(self.connections[connID]) as importer:
+            if not importer.has_file_records():
+                logging.warn('%s does not record which CSV files it was created '
+                             'from, so it can not be updated.'%(p.db_sqlite_file))
+                return
+            changes = sum([importer.sync(table, files, header) for table, files in tables])
+        if changes:
+            logging.info('Updated %d CSV files in %s'%(changes, p.db_sqlite_file))
+            self.invalidate_query_cache()
+            self.schema.invalidate()
+        self.Commit()
+
     def GetImageWidthHeight(self,list_of_cols):
         # Get image width and height
         try:
@@ -1557,25 +2542,53 @@ class DBConnect(Singleton):
             if key in self.GetColumnNames(tablename):
                 self.execute('CREATE INDEX %s ON %s (%s)'%('%s_%s'%(tablename,key), tablename, key))
 
-    def insert_rows_into_table(self, tablename, colnames, coltypes, rows):
-        '''Inserts the given rows into the table
+    def insert_rows_into_table(self, tablename, colnames, coltypes, rows,
+                               batch_size=10000, cb=None):
         '''
-        for row in rows:
-            vals = []
-            for i, val in enumerate(row):
-                if (coltypes[i]=='FLOAT' and (np.isinf(val) or np.isnan(val))
-                    or val is None):
-                    vals += ['NULL']
-                else:
-                    vals += ['"%s"'%val]
-            vals = ', '.join(vals)
-            self.execute('INSERT INTO %s (%s) VALUES (%s)'%(
-                          tablename, ', '.join(colnames), vals), silent=True)
+        Inserts the given rows into the table and commits them. The rows are
+        sent in batches with the values bound as parameters; MySQLdb turns
+        each batch into multi-row INSERTs that fit in max_allowed_packet.
+        None, and NaN or infinite values in numeric columns, become NULL.
+        rows -- list of rows, a 2-D array, or an iterable of rows
+        cb -- if given, is called with the fraction of rows inserted so far
+              (only if the number of rows is known)
+        '''
+        query = 'INSERT INTO %s (%s) VALUES (%s)'%(tablename, ', '.join(colnames),
+                                                   ', '.join(['%s'] * len(colnames)))
+        try:
+            nrows = len(rows)
+        except TypeError:
+            nrows = None
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+        if p.db_type.lower() == 'mysql':
+            packet = self.execute('SELECT @@max_allowed_packet', cache=False)[0][0]
+            # leave some room for the protocol overhead
+            self.cursors[connID].max_stmt_length = max(int(packet) - 1024, 1024)
+        start = time.time()
+        done = 0
+        rows = iter(rows)
+        try:
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                self.execute_many(query, rows_to_sql_params(batch, coltypes))
+                done += len(batch)
+                if cb and nrows:
+                    cb(float(done) / nrows)
+        except:
+            self.connections[connID].rollback()
+            raise
+        self.Commit()
+        logging.info('Inserted %d rows into %s at %d rows/s'
+                     %(done, tablename, done / max(time.time() - start, 1e-3)))
     
     def CreateTempTableFromData(self, dtable, colnames, tablename, temporary=True):
         '''Creates and populates a temporary table in the database.
         '''
-        return CreateTableFromData(dtable, colnames, tablename, temporary=temporary)
+        return self.CreateTableFromData(dtable, colnames, tablename, temporary=temporary)
     
     def CreateTableFromData(self, dtable, colnames, tablename, temporary=False, coltypes=None):
         '''Creates and populates a table in the database.
@@ -1590,9 +2603,11 @@ class DBConnect(Singleton):
         if coltypes is None:
             coltypes = self.InferColTypesFromData(dtable, len(colnames))
         self.create_empty_table(tablename, colnames, coltypes, temporary)
-        self.create_default_indexes_on_table(tablename)
         logging.info('Populating %stable %s...'%((temporary and 'temporary ' or ''), tablename))
         self.insert_rows_into_table(tablename, colnames, coltypes, dtable)
+        # Indexing after the rows are in is quicker than updating the
+        # indexes row by row
+        self.create_default_indexes_on_table(tablename)
         self.Commit()
         return True
     
@@ -1696,35 +2711,104 @@ class DBConnect(Singleton):
         Returns (hist, bin_edges), where hist is a numpy array of size
         nbins and bin_edges is a numpy array of size nbins + 1.
         """
-        if ' ' in table_or_query:
-            table_clause = "(%s) as foo"%(query,)
-        else:
-            table_clause = table_or_query
+        hists, edges = self.histograms([column], table_or_query, nbins,
+                                       ranges=range and [range])
+        return hists[0], edges[0]
 
-        if range is None:
-            data = self.execute("select min(%s), max(%s) from %s" %
-                                (column, column, table_clause))
-            min = data[0][0]
-            max = data[0][1]
+    def histograms(self, columns, table_or_query, nbins, ranges=None, group_by=None):
+        """
+        Compute 1-D histograms of several columns in the database, reading
+        the rows once to find the ranges of the columns (unless given) and
+        once more to count them.
+        columns         -- list of column names or expressions
+        table_or_query  -- either a table name or a subquery, as a string
+        nbins           -- the number of bins in each histogram
+        ranges          -- list of (lower, upper) range of the bins of each
+                           column, or None to use the column's min and max
+        group_by        -- list of columns to compute separate histograms
+                           for each value of. All groups share the same bins.
+
+        Values outside the range and NULLs are not counted, values equal
+        to the upper limit are counted in the last bin (as np.histogram
+        does). On SQLite, values that are not finite numbers (eg: "nan"
+        stored as text) are not counted either. Returns (hists,
+        bin_edges), where bin_edges is an array of shape (len(columns),
+        nbins + 1) and hists is an array of shape (len(columns), nbins),
+        or if group_by is given, a dict mapping each group's key tuple to
+        such an array.
+        """
+        if ' ' in table_or_query.strip():
+            table_clause = "(%s) AS _hist"%(table_or_query,)
         else:
-            min, max = range
-            
-        clause = ("round(%d * (%s - (%f)) / (%f - (%f)))" % 
-                  (nbins, column, min, max, min))
-        h = np.zeros(nbins)
-        res = self.execute("select %s as bin, count(*) from %s "
-                           "where %s <= %d "
-                           "group by %s order by bin" % (clause, table_clause,
-                                                         clause, nbins, clause))
-        for bin, count in res:
-            if bin == nbins:
-                bin -= 1
-            h[bin] = count
-        return h, np.linspace(min, max, nbins + 1)
+            table_clause = table_or_query
+        names = columns
+        if p.db_type.lower() == 'sqlite':
+            # SQLite keeps values of any type in any column, eg: the "nan"s
+            # in CSVs are kept as text, and infinities as reals.
+            columns = ["(CASE WHEN typeof(%s) IN ('integer', 'real') AND abs(%s) <= %r "
+                       "THEN %s END)"%(c, c, sys.float_info.max, c) for c in columns]
+        ranges = list(ranges or [None] * len(columns))
+        missing = [i for i, r in enumerate(ranges) if r is None]
+        if missing:
+            res = self.execute("SELECT %s FROM %s"%(
+                ', '.join(['MIN(%s), MAX(%s)'%(columns[i], columns[i]) for i in missing]),
+                table_clause))[0]
+            for j, i in enumerate(missing):
+                ranges[i] = res[2*j : 2*j+2]
+        edges = np.zeros((len(columns), nbins + 1))
+        for i, (lo, hi) in enumerate(ranges):
+            if lo is None or hi is None:
+                # no values
+                lo, hi = 0., 1.
+            lo, hi = float(lo), float(hi)
+            if not (np.isfinite(lo) and np.isfinite(hi)):
+                raise ValueError('The range of %s, (%r, %r), is not finite.'%(names[i], lo, hi))
+            if lo == hi:
+                lo, hi = lo - 0.5, hi + 0.5
+            ranges[i] = lo, hi
+            edges[i] = np.linspace(lo, hi, nbins + 1)
+
+        # Each row is joined with a small table of column indices and
+        # binned by the column with that index, so all the columns are
+        # counted in one pass over the rows.
+        floor = p.db_type.lower() == 'sqlite' and 'CAST(%s AS INTEGER)' or 'FLOOR(%s)'
+        bin_clauses = []
+        for i, (column, (lo, hi)) in enumerate(zip(columns, ranges)):
+            binned = floor%("%d * (%s - (%r)) / (%r)"%(nbins, column, lo, hi - lo))
+            bin_clauses += ["WHEN %d THEN CASE WHEN %s = %r THEN %d WHEN %s >= %r AND %s < %r "
+                            "THEN %s END"%(i, column, hi, nbins - 1, column, lo, column, hi, binned)]
+        bin_clause = 'CASE _hist_columns.i %s END'%(' '.join(bin_clauses))
+        indices = ' UNION ALL '.join(['SELECT %d AS i'%(i) for i in xrange(len(columns))])
+        # SQLite and MySQL read the tables of a CROSS/STRAIGHT_JOIN in order,
+        # so the rows are read once rather than once per column.
+        join = p.db_type.lower() == 'sqlite' and 'CROSS JOIN' or 'STRAIGHT_JOIN'
+        group_by = list(group_by or [])
+        res = self.execute("SELECT %s _hist_columns.i, %s AS _hist_bin, COUNT(*) "
+                           "FROM %s %s (%s) AS _hist_columns "
+                           "GROUP BY %s _hist_columns.i, _hist_bin"%(
+                ''.join([g + ', ' for g in group_by]), bin_clause,
+                table_clause, join, indices,
+                ''.join([g + ', ' for g in group_by])))
+        ngroup = len(group_by)
+        if ngroup == 0:
+            hists = np.zeros((len(columns), nbins))
+            for i, bin, count in res:
+                if bin is not None:
+                    # rounding may put values just below the limit in bin nbins
+                    hists[int(i), min(int(bin), nbins - 1)] += count
+            return hists, edges
+        hists = {}
+        for row in res:
+            i, bin, count = row[ngroup:]
+            if bin is None:
+                continue
+            h = hists.setdefault(tuple(row[:ngroup]), np.zeros((len(columns), nbins)))
+            h[int(i), min(int(bin), nbins - 1)] += count
+        return hists, edges
 
     def get_objects_modify_date(self):
         if p.db_type.lower() == 'mysql':
-            return self.execute("select UPDATE_TIME from INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME='%s' and TABLE_SCHEMA='%s'"%(p.object_table, p.db_name))[0][0]
+            return self.execute("select UPDATE_TIME from INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME='%s' and TABLE_SCHEMA='%s'"%(p.object_table, p.db_name), cache=False)[0][0]
         else:
             return os.path.getmtime(p.db_sqlite_file)
 
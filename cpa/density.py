@@ -1,5 +1,5 @@
 from cpatool import CPATool
-from dbconnect import DBConnect, UniqueImageClause, image_key_columns, object_key_columns
+from dbconnect import DBConnect, UniqueImageClause, image_key_columns, object_key_columns, rows_to_float_array
 import sqltools as sql
 from multiclasssql import filter_table_prefix
 from properties import Properties
@@ -231,7 +231,7 @@ class DataSourcePanel(wx.Panel):
         if self.filter != None:
             q.add_filter(self.filter)
             
-        return db.execute(str(q))
+        return rows_to_float_array(db.execute(str(q)), 2)
         
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
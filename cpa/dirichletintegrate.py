@@ -6,7 +6,7 @@ from numpy import *
 from scipy.integrate import quadrature, romberg, fixed_quad
 from scipy.special import gammaln, betaln, digamma, polygamma, betainc, gamma
 import pdb
-from hypergeom import hyper3F2regularizedZ1, hyper3F2Z1, hyper3F2aZ1
+from hypergeom import hyper3F2regularizedZ1, hyper3F2Z1, hyper3F2aZ1, hyper3F2aZ1_rows
 
 
 def dirichlet_integrate(alpha):
@@ -151,6 +151,40 @@ def score(prior, counts):
         return beta_enriched((prior_a, prior_b), (posterior_a, posterior_b))
     return [score_idx(i) for i in range(K)]
 
+def beta_enriched_rows(prior, posterior):
+    ''' beta_enriched for a single prior (a, b) and arrays of posteriors (c, d) '''
+    a, b = prior
+    c = asarray(posterior[0], float64)
+    d = asarray(posterior[1], float64)
+    hyper = hyper3F2aZ1_rows(a, 1-b, a+c, a+c+d)
+    scale = exp(gammaln(a) + gammaln(a+c) + gammaln(d) - gammaln(1+a) - gammaln(a+c+d) - betaln(a,b) - betaln(c,d))
+    with errstate(invalid='ignore'):
+        v = hyper * scale
+    # See beta_enriched for why this can be nan.
+    fallback = where(a / (a + b) > c / (c + d), 0.0, 1.0)
+    return where(isnan(v), fallback, clip(v, 0, 1))
+
+def score_all(prior, counts):
+    ''' score many wells at once.  counts is an N x K array holding the
+    observed counts of each well; returns an N x K array whose rows match
+    score(prior, counts[i]).  Wells with identical counts are only scored
+    once, and each class is scored for all of the wells in a single pass. '''
+    counts = asarray(counts, float64)
+    assert counts.ndim == 2 and counts.shape[1] == len(prior), "dirichletintegrate.score_all: array shapes do not match: "+str(prior.shape)+' and '+str(counts.shape)
+    if len(counts) == 0:
+        return zeros(counts.shape, float64)
+    unique_counts, inverse = unique(counts, axis=0, return_inverse=True)
+    posterior = prior + unique_counts
+    posterior_sum = posterior.sum(axis=1)
+    scores = empty(unique_counts.shape, float64)
+    for idx in range(len(prior)):
+        prior_a = prior[idx]
+        prior_b = sum(prior) - prior_a
+        posterior_a = posterior[:, idx]
+        posterior_b = posterior_sum - posterior_a
+        scores[:, idx] = beta_enriched_rows((prior_a, prior_b), (posterior_a, posterior_b))
+    return scores[inverse]
+
 def logit(p):
      return log2(p) - log2(1-p)
 
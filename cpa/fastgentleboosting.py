@@ -4,6 +4,7 @@ import logging
 import multiclasssql_legacy as multiclasssql # Legacy code for scoring cells
 import numpy as np
 import matplotlib.pyplot as plt
+from fastgentleboostingworkermulticlass import train_weak_learner, presort, find_best_weak_learner, feature_search_pool
 from sys import stdin, stdout, argv, exit
 from time import time
 
@@ -209,14 +210,12 @@ class FastGentleBoosting(object):
             weights[np.tile(classmask, (1, num_classes))] /= num_examples_class
         balancing = weights.copy()
 
+        # Sort each feature once; the order is the same in every round.
+        orders = presort(values)
+        pool = feature_search_pool(values.shape[1])
+
         def GetOneWeakLearner(ctl=None, tlbi=None):
-            best_error = float(np.Infinity)
-            for feature_idx in range(values.shape[1]):
-                thresh, err, a, b = self.TrainWeakLearner(label_matrix, weights, values[:, feature_idx])
-                if err < best_error:
-                    best_error = err
-                    bestvals = (err, feature_idx, thresh, a, b)
-            err, column, thresh, a, b = bestvals
+            err, column, thresh, a, b = find_best_weak_learner(label_matrix, weights, values, orders, pool)
             # recompute weights
             delta = np.reshape(values[:, column] > thresh, (num_examples, 1))
             feature_thresh_mask = np.tile(delta, (1, num_classes))
@@ -235,36 +234,40 @@ class FastGentleBoosting(object):
 
             return (err, colnames[int(column)], thresh, a, b, reweights, recomputed_labels, adjustment)
 
-        self.model = []
-        for weak_count in range(num_learners):
-            if do_tests:
-                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner(ctl=computed_test_labels, tlbi=test_labels_by_iteration)
-            else:
-                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner()
-
-            # compute margins
-            step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
-            step_relative = step_correct_class - (adjustment[label_matrix < 0].reshape((num_examples, num_classes - 1)))
-            mask = (step_relative > 0)
-            margin_correct += step_relative * mask
-            margin_incorrect += (- step_relative) * (~ mask)
-            expected_worst_margin = sum(balancing[:,0] * (margin_correct / (margin_correct + margin_incorrect)).min(axis=1)) / sum(balancing[:,0])
-
-            computed_labels = recomputed_labels
-            self.model += [(colname, thresh, a, b, expected_worst_margin)]
-
-            if callback is not None:
-                callback(weak_count / float(num_learners))
-
-            if fout:
-                colname, thresh, a, b, e_m = self.model[-1]
-                fout.write("IF (%s > %s, %s, %s)\n" %
-                           (colname, repr(thresh),
-                            "[" + ", ".join([repr(v) for v in a]) + "]",
-                            "[" + ", ".join([repr(v) for v in b]) + "]"))
-            if err == 0.0:
-                break
-            weights = reweight
+        try:
+            self.model = []
+            for weak_count in range(num_learners):
+                if do_tests:
+                    err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner(ctl=computed_test_labels, tlbi=test_labels_by_iteration)
+                else:
+                    err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner()
+
+                # compute margins
+                step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
+                step_relative = step_correct_class - (adjustment[label_matrix < 0].reshape((num_examples, num_classes - 1)))
+                mask = (step_relative > 0)
+                margin_correct += step_relative * mask
+                margin_incorrect += (- step_relative) * (~ mask)
+                expected_worst_margin = sum(balancing[:,0] * (margin_correct / (margin_correct + margin_incorrect)).min(axis=1)) / sum(balancing[:,0])
+
+                computed_labels = recomputed_labels
+                self.model += [(colname, thresh, a, b, expected_worst_margin)]
+
+                if callback is not None:
+                    callback(weak_count / float(num_learners))
+
+                if fout:
+                    colname, thresh, a, b, e_m = self.model[-1]
+                    fout.write("IF (%s > %s, %s, %s)\n" %
+                               (colname, repr(thresh),
+                                "[" + ", ".join([repr(v) for v in a]) + "]",
+                                "[" + ", ".join([repr(v) for v in b]) + "]"))
+                if err == 0.0:
+                    break
+                weights = reweight
+        finally:
+            if pool is not None:
+                pool.close()
         if do_tests:
             return test_labels_by_iteration
 
@@ -282,55 +285,7 @@ class FastGentleBoosting(object):
         label_matrix and weights are NxC.
         values is N
         '''
-
-        global order, s_values, s_labels, s_weights, s_weights_times_labels, num_a, den_a, a, b, sless0, sgrtr0, w_below_neg, w_below_pos, w_above_neg, w_above_pos, J
-
-        # Sort labels and weights by values (AKA possible thresholds).  By
-        # default, argsort is not stable, so the results will vary
-        # slightly with the number of workers.  Add kind="mergesort" to
-        # get a stable sort, which avoids this.
-        order = np.argsort(values)
-        s_values = values[order]
-        s_labels = labels[order, :]
-        s_weights = weights[order, :]
-
-        # useful subfunction
-        num_examples = labels.shape[0]
-        def tilesum(a):
-            return np.tile(np.sum(a, axis=0), (num_examples, 1))
-
-        # Equations 9 and 10 of Torralba et al.
-        s_weights_times_labels = s_weights * s_labels
-        num_a = (tilesum(s_weights_times_labels) - np.cumsum(s_weights_times_labels, axis=0))
-        den_a = (tilesum(s_weights) - np.cumsum(s_weights, axis=0))
-        den_a[den_a <= 0.0] = 1.0 # avoid div by zero
-        a = num_a / den_a
-        b = np.cumsum(s_weights_times_labels, axis=0) / np.cumsum(s_weights, axis=0)
-
-        # We need, at each index, the total weights below and above,
-        # separated by positive and negative label.  Below includes the
-        # current index
-        sless0 = (s_labels < 0)
-        sgrtr0 = (s_labels > 0)
-        w_below_neg = np.cumsum(s_weights * sless0, axis=0)
-        w_below_pos = np.cumsum(s_weights * sgrtr0, axis=0)
-        w_above_neg = tilesum(s_weights * sless0) - w_below_neg
-        w_above_pos = tilesum(s_weights * sgrtr0) - w_below_pos
-
-        # Now evaluate the error at each threshold.
-        # (see Equation 7, and note that we're assuming -1 and +1 for entries in the label matrix.
-        J = w_below_neg * ((-1 - b)**2) + w_below_pos * ((1 - b)**2) + w_above_neg * ((-1 - a)**2) + w_above_pos * ((1 - a)**2)
-        J = J.sum(axis=1)
-
-        # Find index of least error
-        idx = np.argmin(J)
-
-        # make sure we're at the top of this thresh
-        while (idx+1 < len(s_values)) and (s_values[idx] == s_values[idx + 1]):
-            idx += 1
-
-        # return the threshold at that index
-        return s_values[idx], J[idx], a[idx, :].copy(), b[idx, :].copy()
+        return train_weak_learner(labels, weights, values)
 
     def UpdateBins(self, classBins):
         self.classBins = classBins
@@ -1,6 +1,6 @@
 from numpy import *
 import sys
-from fastgentleboostingworkermulticlass import train_weak_learner
+from fastgentleboostingworkermulticlass import presort, find_best_weak_learner, feature_search_pool
 
 
 def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None):
@@ -32,14 +32,12 @@ def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False
         weights[tile(classmask, (1, num_classes))] /= num_examples_class
     balancing = weights.copy()
     
+    # Sort each feature once; the order is the same in every round.
+    orders = presort(values)
+    pool = feature_search_pool(values.shape[1])
+
     def get_one_weak_learner(ctl=None, tlbi=None):
-        best_error = float(Infinity)
-        for feature_idx in range(values.shape[1]):
-            thresh, err, a, b = train_weak_learner(label_matrix, weights, values[:, feature_idx])
-            if err < best_error:
-                best_error = err
-                bestvals = (err, feature_idx, thresh, a, b)
-        err, column, thresh, a, b = bestvals
+        err, column, thresh, a, b = find_best_weak_learner(label_matrix, weights, values, orders, pool)
         # recompute weights
         delta = reshape(values[:, column] > thresh, (num_examples, 1))
         feature_thresh_mask = tile(delta, (1, num_classes))
@@ -58,36 +56,40 @@ def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False
 
         return (err, colnames[int(column)], thresh, a, b, reweights, recomputed_labels, adjustment)
 
-    weak_learners = []
-    for weak_count in range(num_learners):
-        if do_tests:
-            err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = get_one_weak_learner(ctl=computed_test_labels, tlbi=test_labels_by_iteration)
-        else:
-            err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = get_one_weak_learner()
-
-        # compute margins
-        step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
-        step_relative = step_correct_class - (adjustment[label_matrix < 0].reshape((num_examples, num_classes - 1)))
-        mask = (step_relative > 0)
-        margin_correct += step_relative * mask
-        margin_incorrect += (- step_relative) * (~ mask)
-        expected_worst_margin = sum(balancing[:,0] * (margin_correct / (margin_correct + margin_incorrect)).min(axis=1)) / sum(balancing[:,0])
-
-        computed_labels = recomputed_labels
-        weak_learners += [(colname, thresh, a, b, expected_worst_margin)]
-
-        if callback is not None:
-            callback(weak_count / float(num_learners))
-
-        if fout:
-            colname, thresh, a, b, e_m = weak_learners[-1]
-            fout.write("IF (%s > %s, %s, %s)\n" %
-                       (colname, repr(thresh), 
-                        "[" + ", ".join([repr(v) for v in a]) + "]", 
-                        "[" + ", ".join([repr(v) for v in b]) + "]"))
-        if err == 0.0:
-            break
-        weights = reweight
+    try:
+        weak_learners = []
+        for weak_count in range(num_learners):
+            if do_tests:
+                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = get_one_weak_learner(ctl=computed_test_labels, tlbi=test_labels_by_iteration)
+            else:
+                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = get_one_weak_learner()
+
+            # compute margins
+            step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
+            step_relative = step_correct_class - (adjustment[label_matrix < 0].reshape((num_examples, num_classes - 1)))
+            mask = (step_relative > 0)
+            margin_correct += step_relative * mask
+            margin_incorrect += (- step_relative) * (~ mask)
+            expected_worst_margin = sum(balancing[:,0] * (margin_correct / (margin_correct + margin_incorrect)).min(axis=1)) / sum(balancing[:,0])
+
+            computed_labels = recomputed_labels
+            weak_learners += [(colname, thresh, a, b, expected_worst_margin)]
+
+            if callback is not None:
+                callback(weak_count / float(num_learners))
+
+            if fout:
+                colname, thresh, a, b, e_m = weak_learners[-1]
+                fout.write("IF (%s > %s, %s, %s)\n" %
+                           (colname, repr(thresh), 
+                            "[" + ", ".join([repr(v) for v in a]) + "]", 
+                            "[" + ", ".join([repr(v) for v in b]) + "]"))
+            if err == 0.0:
+                break
+            weights = reweight
+    finally:
+        if pool is not None:
+            pool.close()
     if do_tests:
         return test_labels_by_iteration
     return weak_learners
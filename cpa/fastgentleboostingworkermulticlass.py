@@ -5,7 +5,7 @@
 from sys import stdin, stdout, stderr, argv, exit
 from numpy import *
 
-def train_weak_learner(labels, weights, values):
+def train_weak_learner(labels, weights, values, order=None):
     ''' For a multiclass training set, with C classes and N examples,
     finds the optimal weak learner in O(M * N logN) time.
     Optimality is defined by Eq. 7 of Torralba et al., 'Sharing visual
@@ -18,15 +18,14 @@ def train_weak_learner(labels, weights, values):
     Labels should be 1 and -1, only.
     label_matrix and weights are NxC.
     values is Nx1
+    order is argsort(values), if it has already been computed (see presort).
     '''
-    
-    global order, s_values, s_labels, s_weights, s_weights_times_labels, num_a, den_a, a, b, sless0, sgrtr0, w_below_neg, w_below_pos, w_above_neg, w_above_pos, J
-
     # Sort labels and weights by values (AKA possible thresholds).  By
     # default, argsort is not stable, so the results will vary
     # slightly with the number of workers.  Add kind="mergesort" to
     # get a stable sort, which avoids this.
-    order = argsort(values)
+    if order is None:
+        order = argsort(values)
     s_values = values[order]
     s_labels = labels[order, :]
     s_weights = weights[order, :]
@@ -69,6 +68,59 @@ def train_weak_learner(labels, weights, values):
     # return the threshold at that index
     return s_values[idx], J[idx], a[idx, :].copy(), b[idx, :].copy()
 
+def presort(values):
+    ''' Returns the N x M array whose columns are argsort(values[:, j]).
+    The order only depends on the values, so it can be computed once per
+    training set and reused in every boosting round.
+    '''
+    return argsort(values, axis=0)
+
+def _search_features(labels, weights, values, orders, columns):
+    best_error = float(Infinity)
+    bestvals = None
+    for column in columns:
+        thresh, err, a, b = train_weak_learner(labels, weights, values[:, column], orders[:, column])
+        if err < best_error:
+            best_error = err
+            bestvals = (err, column, thresh, a, b)
+    return bestvals
+
+def find_best_weak_learner(labels, weights, values, orders, pool=None, chunk_size=32):
+    ''' Trains a weak learner on every column of values and returns
+    (err, column, thresh, a, b) for the one with the least error. Ties
+    go to the lowest column, exactly as when looping over the columns.
+    orders is presort(values).
+    pool, if given, is a multiprocessing.pool.ThreadPool over which
+    chunks of chunk_size columns are evaluated in parallel.
+    '''
+    ncols = values.shape[1]
+    chunks = [range(start, min(start + chunk_size, ncols))
+              for start in range(0, ncols, chunk_size)]
+    search = lambda columns: _search_features(labels, weights, values, orders, columns)
+    if pool is None or len(chunks) == 1:
+        results = map(search, chunks)
+    else:
+        results = pool.map(search, chunks)
+    best_error = float(Infinity)
+    bestvals = None
+    for result in results:
+        if result is not None and result[0] < best_error:
+            best_error = result[0]
+            bestvals = result
+    return bestvals
+
+def feature_search_pool(ncols):
+    ''' Returns a ThreadPool for find_best_weak_learner, or None if there
+    are too few columns (or CPUs) for parallel search to help.
+    The caller must close() it.
+    '''
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    nthreads = min(cpu_count(), ncols // 32)
+    if nthreads < 2:
+        return None
+    return ThreadPool(nthreads)
+
 def train_classifier(labels, values, iterations):
     # make sure these are arrays (not matrices)
     labels = array(labels)
@@ -79,17 +131,9 @@ def train_classifier(labels, values, iterations):
     learners = []
     weights = ones(labels.shape)
     output = zeros(labels.shape)
+    orders = presort(values)
     for n in range(iterations):
-        best_error = float(Infinity)
-
-        for feature_idx in range(values.shape[1]):
-            val, err, a, b = train_weak_learner(labels, weights, values[:, feature_idx])
-            if err < best_error:
-                best_error = err
-                best_idx = feature_idx
-                best_val = val
-                best_a = a
-                best_b = b
+        err, best_idx, best_val, best_a, best_b = find_best_weak_learner(labels, weights, values, orders)
 
         delta = values[:, best_idx] > best_val
         delta.shape = (len(delta), 1)
@@ -115,6 +159,7 @@ def doit():
     num_classes = myfromfile(stdin, int32, (1,))[0]
     values = myfromfile(stdin, float32, (n, ncols))
     label_matrix = myfromfile(stdin, int32, (n, num_classes))
+    orders = presort(values)
 
     while True:
         # It would be cleaner to tell the worker we're done by just
@@ -125,16 +170,7 @@ def doit():
             return
         weights = myfromfile(stdin, float32, (n, num_classes))
 
-        best = float(Infinity)
-        for column in range(ncols):
-            colvals = values[:, column]
-            # print >>stderr, "WORK", column, label_matrix, weights, colvals
-            thresh, err, a, b = train_weak_learner(label_matrix, weights, colvals)
-            if err < best:
-                best = err
-                bestvals = (err, column, thresh, a, b)
-
-        err, column, thresh, a, b = bestvals
+        err, column, thresh, a, b = find_best_weak_learner(label_matrix, weights, values, orders)
         array([err, column, thresh], float32).tofile(stdout)
         a.astype(float32).tofile(stdout)
         b.astype(float32).tofile(stdout)
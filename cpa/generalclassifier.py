@@ -26,6 +26,13 @@ class GeneralClassifier(BaseEstimator, ClassifierMixin):
 
         logging.info('Initialized New Classifier: ' + self.name)
 
+    def __getstate__(self):
+        # The Classifier frame in env can't be pickled, and scoring workers
+        # only need the trained model.
+        state = self.__dict__.copy()
+        state['env'] = None
+        return state
+
     # Set features
     def _set_features(self, features):
         self.features = features
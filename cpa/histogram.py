@@ -1,7 +1,8 @@
-from dbconnect import DBConnect, UniqueImageClause, image_key_columns, object_key_columns
+from dbconnect import DBConnect, UniqueImageClause, image_key_columns, object_key_columns, rows_to_float_array
 from icons import lasso_tool
 import sqltools as sql
 from multiclasssql import filter_table_prefix
+from queryexecutor import QueryExecutor
 from properties import Properties
 import guiutils as ui
 from wx.combo import OwnerDrawnComboBox as ComboBox
@@ -150,25 +151,41 @@ class DataSourcePanel(wx.Panel):
                 or (self.x_column.table != p.image_table and db.adjacent(p.object_table, self.x_column.table))
                 )
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, wait=False):
+        '''Redraws the histogram once its query has run in the background,
+        or right away if wait is true.'''
         self.gate_choice.set_gatable_columns([self.x_column])
-        points = self._load_points()
         bins = int(self.bins_input.GetValue())
+        x_scale = self.x_scale_choice.GetString(self.x_scale_choice.GetSelection())
         self.figpanel.set_x_label(self.x_column.col)
-        self.figpanel.set_x_scale(self.x_scale_choice.GetString(self.x_scale_choice.GetSelection()))
+        self.figpanel.set_x_scale(x_scale)
         self.figpanel.set_y_scale(self.y_scale_choice.GetString(self.y_scale_choice.GetSelection()))
-        self.figpanel.setpoints(points, bins)
+        column, query = self.x_column.col, str(self._points_query())
+        if x_scale == LINEAR_SCALE:
+            # Bin in the database rather than fetching every value
+            load = lambda: db.histogram(column, query, bins)
+            def show(res):
+                self.figpanel.sethistogram(*res)
+                self._redraw()
+        else:
+            load = lambda: rows_to_float_array(db.execute(query), 1, np.float32)[:, 0]
+            def show(points):
+                self.figpanel.setpoints(points, bins)
+                self._redraw()
+        # Supersedes the query of an earlier update that is still running
+        QueryExecutor.getInstance().redraw(self, load, show, wait)
+
+    def _redraw(self):
         self.update_gate_helper()
         self.figpanel.draw()
         
-    def _load_points(self):
+    def _points_query(self):
         q = sql.QueryBuilder()
         select = [self.x_column]
         q.set_select_clause(select)
         if self.filter is not None:
             q.add_filter(self.filter)
-            
-        return np.array(db.execute(str(q))).T[0]
+        return q
 
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
@@ -205,7 +222,7 @@ class DataSourcePanel(wx.Panel):
             self.y_scale_choice.SetStringSelection(settings['y-scale'])
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
+        self.update_figpanel(wait=True)
         if 'x-lim' in settings:
             self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
         if 'y-lim' in settings:
@@ -279,6 +296,24 @@ class HistogramPanel(FigureCanvasWxAgg):
         self.subplot.set_xlabel(x_label)
         self.reset_toolbar()
     
+    def sethistogram(self, hist, edges):
+        ''' Plots counts that were already binned, eg: by db.histogram.
+        hist - count of each bin
+        edges - the nbins + 1 bin edges
+        '''
+        self.bins = len(hist)
+        self.subplot.clear()
+        if hist.sum() == 0:
+            logging.warn('No data to plot.')
+            return
+        self.subplot.hist(edges[:-1], edges, weights=hist,
+                          facecolor=[0.0,0.62,1.0], 
+                          edgecolor='none',
+                          log=self.log_y,
+                          alpha=0.75)
+        self.subplot.set_xlabel(self.x_label)
+        self.reset_toolbar()
+
     def set_x_label(self, label):
         self.x_label = label
         
@@ -108,3 +108,61 @@ def hyper3F2aZ1(a1, a2, a3, b2, tol=1e-10):
         return (A[0] - B[0]) / C[0]
     else:
         return hyper3F2Z1(a1, a2, a3, a1+1, b2, tol=tol)[0]
+
+
+def hyper3F2Z1_rows(a1, a2, a3, b1, b2, tol=1e-15):
+    '''hyper3F2Z1 evaluated for many rows at once.  a1, a2 and b1 are
+    scalars, a3 and b2 are arrays.  Each row keeps adding blocks of 100
+    terms until its own last term drops below tol, as in hyper3F2Z1.'''
+    a3, b2 = broadcast_arrays(asarray(a3, float64), asarray(b2, float64))
+    shape = a3.shape
+    a3 = a3.ravel()
+    b2 = b2.ravel()
+    n = len(a3)
+
+    a1b1carry = 1.0
+    a2kcarry = 1.0
+    a3b2carry = ones(n, float64)
+    lastterm = zeros(n, float64)
+    blocksums = []
+    active = arange(n)
+    count = 0
+    while len(active) > 0:
+        k = arange(count, count + 100, dtype=float64)
+        a1b1terms = a1b1carry * cumprod((a1 + k) / (b1 + k))
+        a2kterms = a2kcarry * cumprod((a2 + k) / (1 + k))
+        a3b2terms = a3b2carry[active, newaxis] * cumprod((a3[active, newaxis] + k) / (b2[active, newaxis] + k), axis=1)
+        termprod = a1b1terms * a3b2terms * a2kterms
+        blocksums.append((active, termprod[:, ::-1].sum(axis=1)))
+        lastterm[active] = termprod[:, -1]
+        a1b1carry = a1b1terms[-1]
+        a2kcarry = a2kterms[-1]
+        a3b2carry[active] = a3b2terms[:, -1]
+        count += 100
+        # rows whose terms are no longer finite will never converge
+        last = abs(termprod[:, -1])
+        active = active[(last >= tol) & isfinite(last)]
+
+    # sum in reverse, for better accuracy
+    total = zeros(n, float64)
+    for rows, blocksum in reversed(blocksums):
+        total[rows] += blocksum
+    return (1.0 + total).reshape(shape), lastterm.reshape(shape)
+
+
+def hyper3F2aZ1_rows(a1, a2, a3, b2, tol=1e-10):
+    '''hyper3F2aZ1 evaluated for many rows at once.  a1 and a2 are
+    scalars, a3 and b2 are arrays.  Since the recursions below only depend
+    on a1 and a2, they are shared by all of the rows.'''
+    if (a2 > -2):
+        toladjust = tol / max(1, abs((a2 - a1 - 1) / (a2 - 1)))
+        return ((a2 - a1 - 1) * hyper3F2aZ1_rows(a1, a2 - 1, a3, b2, tol=toladjust) + a1 * hyp2f1mine(a2 - 1, a3, b2)) / (a2 - 1)
+    if (a2 < -10):
+        a2new = arange(a2, -9)
+        B = a2new[-1] * hyper3F2aZ1_rows(a1, a2new[-1]+1, a3, b2)
+        for idx in arange(len(a2new)-1, 0, -1):
+            A = a1 * hyp2f1mine(a2new[idx], a3, b2)
+            B = a2new[idx-1] * ((A - B) / (a1 - a2new[idx]))
+        return (a1 * hyp2f1mine(a2new[0], a3, b2) - B) / (a1 - a2new[0])
+    else:
+        return hyper3F2Z1_rows(a1, a2, a3, a1+1, b2, tol=tol)[0]
@@ -0,0 +1,162 @@
+'''
+A thread-safe, byte-bounded LRU cache of decoded images, used by
+imagetools.FetchImage. An image is a list of channel arrays.
+
+Images evicted from memory can optionally be spilled to a directory of
+uncompressed .npz files, which is much faster to read back than
+decoding the original (e.g. 16-bit multi-channel TIFF) files again.
+'''
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def image_nbytes(imgs):
+    return sum(im.nbytes for im in imgs)
+
+
+class ImageCache(object):
+    '''
+    max_bytes: upper bound on the total size of the images held in memory.
+        The most recently added image is always kept, even if it is
+        larger than max_bytes.
+    spill_dir: if given, images evicted from memory are written here and
+        read back on a later miss.
+    spill_max_bytes: upper bound on the total size of the spilled images.
+    '''
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self._images = OrderedDict()    # key -> (imgs, nbytes), oldest first
+        self._spilled = OrderedDict()   # key -> (filename, nbytes), oldest first
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.spilled_nbytes = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        return key in self._images
+
+    def get(self, key):
+        '''Returns the cached image for key or None.'''
+        with self._lock:
+            entry = self._images.pop(key, None)
+            if entry is not None:
+                self._images[key] = entry
+                self.hits += 1
+                return entry[0]
+            spilled = self._spilled.get(key)
+        if spilled is not None:
+            imgs = self._read_spilled(spilled[0])
+            if imgs is not None:
+                with self._lock:
+                    self.spill_hits += 1
+                self.put(key, imgs)
+                return imgs
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, imgs):
+        '''Adds an image to the cache, evicting the least recently used
+        images until the cache fits in max_bytes.'''
+        nbytes = image_nbytes(imgs)
+        evicted = []
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._images[key] = (imgs, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self._images) > 1:
+                k, (im, n) = self._images.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+                evicted.append((k, im, n))
+        if self.spill_dir:
+            # Write outside the lock so other threads aren't held up by I/O
+            for k, im, n in evicted:
+                self._spill(k, im, n)
+
+    def clear(self):
+        '''Empties the cache and deletes any spilled images.'''
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+            spilled = self._spilled.values()
+            self._spilled.clear()
+            self.spilled_nbytes = 0
+        for filename, n in spilled:
+            self._remove(filename)
+
+    def stats(self):
+        '''Returns a dict of the cache counters and sizes.'''
+        with self._lock:
+            return dict(hits=self.hits, spill_hits=self.spill_hits,
+                        misses=self.misses, evictions=self.evictions,
+                        images=len(self._images), nbytes=self.nbytes,
+                        spilled_images=len(self._spilled),
+                        spilled_nbytes=self.spilled_nbytes)
+
+    def _spill_filename(self, key):
+        return os.path.join(self.spill_dir,
+                            hashlib.sha1(repr(key)).hexdigest() + '.npz')
+
+    def _spill(self, key, imgs, nbytes):
+        if nbytes > self.spill_max_bytes:
+            return
+        with self._lock:
+            entry = self._spilled.pop(key, None)
+            if entry is not None:
+                # Already on disk, just mark it as recently used
+                self._spilled[key] = entry
+                return
+        filename = self._spill_filename(key)
+        try:
+            if not os.path.exists(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            with open(filename + '.tmp', 'wb') as f:
+                np.savez(f, *imgs)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), e:
+            logging.warn('Could not spill image %s to %s: %s'%(key, filename, e))
+            return
+        removed = []
+        with self._lock:
+            old = self._spilled.pop(key, None)
+            if old is not None:
+                self.spilled_nbytes -= old[1]
+            self._spilled[key] = (filename, nbytes)
+            self.spilled_nbytes += nbytes
+            while self.spilled_nbytes > self.spill_max_bytes:
+                k, (fn, n) = self._spilled.popitem(last=False)
+                self.spilled_nbytes -= n
+                removed.append(fn)
+        for fn in removed:
+            self._remove(fn)
+
+    def _read_spilled(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                raw = np.load(f)
+                return [raw['arr_%d'%i] for i in range(len(raw.files))]
+        except (IOError, OSError, KeyError, ValueError):
+            # The file may have been evicted by another thread meanwhile
+            return None
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -20,6 +20,7 @@ from time import time
 import icons
 import dbconnect
 import dirichletintegrate
+import imagepanel
 import imagetools
 import polyafit
 import sortbin
@@ -1085,7 +1086,10 @@ class ImageGallery(wx.Frame):
     def SetBrightness(self, brightness):
         ''' Updates the global image brightness across all tiles. '''
         self.brightness = brightness
-        [t.SetBrightness(brightness) for bin in self.all_sort_bins() for t in bin.tiles]
+        tiles = [t for bin in self.all_sort_bins() for t in bin.tiles]
+        for t in tiles:
+            t.brightness = brightness
+        imagepanel.UpdateBitmaps(tiles)
 
     def SetScale(self, scale):
         ''' Updates the global image scaling across all tiles. '''
@@ -1095,7 +1099,10 @@ class ImageGallery(wx.Frame):
 
     def SetContrastMode(self, mode):
         self.contrast = mode
-        [t.SetContrastMode(mode) for bin in self.all_sort_bins() for t in bin.tiles]
+        tiles = [t for bin in self.all_sort_bins() for t in bin.tiles]
+        for t in tiles:
+            t.contrast = mode
+        imagepanel.UpdateBitmaps(tiles)
 
     def PostMessage(self, message):
         ''' Updates the status bar text and logs to info. '''
@@ -90,3 +90,26 @@ class ImagePanel(wx.Panel):
         self.UpdateBitmap()
 
 
+def UpdateBitmaps(panels):
+    '''
+    Recalculates the bitmaps of many ImagePanels at once. Panels that share
+    display settings are composited together in one batch, which is much
+    faster than calling UpdateBitmap on each of them.
+    '''
+    groups = {}
+    for panel in panels:
+        key = (tuple(panel.chMap), panel.brightness, panel.scale, 
+               panel.contrast, panel.display_whole_image)
+        groups.setdefault(key, []).append(panel)
+    for (chMap, brightness, scale, contrast, display_whole_image), group in groups.items():
+        bitmaps = imagetools.MergeTilesToBitmaps([panel.images for panel in group],
+                                                 chMap = list(chMap),
+                                                 brightness = brightness,
+                                                 scale = scale,
+                                                 contrast = contrast,
+                                                 display_whole_image = display_whole_image)
+        for panel, bitmap in zip(group, bitmaps):
+            panel.bitmap = bitmap
+            panel.Refresh()
+
+
@@ -6,6 +6,7 @@ import PIL.Image as Image
 import pilfix
 from properties import Properties
 import dbconnect
+from imagecache import ImageCache
 from imagereader import ImageReader
 import logging
 import matplotlib.image
@@ -15,24 +16,39 @@ import wx
 p = Properties.getInstance()
 db = dbconnect.DBConnect.getInstance()
 
-cache = {}
-cachedkeys = []
+# Decoded images, sized from the properties each time an image is fetched.
+cache = ImageCache(0)
+
+def ConfigureImageCache():
+    '''Applies the image_cache_* properties to the image cache.'''
+    cache.max_bytes = int(float(p.image_cache_size or 512) * 2**20)
+    cache.spill_dir = p.image_cache_spill_dir or None
+    cache.spill_max_bytes = int(float(p.image_cache_spill_size or 2048) * 2**20)
 
 def FetchTile(obKey, display_whole_image=False):
     '''returns a list of image channel arrays cropped around the object
     coordinates
     '''
-    imKey = obKey[:-1]
+    return FetchTiles([obKey], display_whole_image)[0]
+
+def FetchTiles(obKeys, display_whole_image=False):
+    '''returns a list with one list of image channel arrays per object key,
+    cropped around the object coordinates. All object keys must come from
+    the same image, which is read only once. Entries are None for objects
+    whose coordinates could not be loaded.
+    '''
+    imKey = obKeys[0][:-1]
+    assert all(obKey[:-1] == imKey for obKey in obKeys), \
+           'FetchTiles expects object keys from a single image'
     # Could transform object coords here
     imgs = FetchImage(imKey)
-    
-    size = (int(p.image_size),int(p.image_size))
 
     if display_whole_image:
-        return imgs
+        return [imgs for obKey in obKeys]
 
-    else:
-        size = (int(p.image_tile_size), int(p.image_tile_size))
+    size = (int(p.image_tile_size), int(p.image_tile_size))
+    tiles = []
+    for obKey in obKeys:
         pos = list(db.GetObjectCoords(obKey))
         if None in pos:
             message = ('Failed to load coordinates for object key %s. This may '
@@ -43,26 +59,23 @@ def FetchTile(obKey, display_whole_image=False):
                        p.object_table))
             wx.MessageBox(message, 'Error')
             logging.error(message)
-            return None
+            tiles.append(None)
+            continue
         if p.rescale_object_coords:
             pos[0] *= p.image_rescale[0] / p.image_rescale_from[0]
             pos[1] *= p.image_rescale[1] / p.image_rescale_from[1]
-    
-        return [Crop(im, size, pos) for im in imgs]
+        tiles.append([Crop(im, size, pos) for im in imgs])
+    return tiles
 
 def FetchImage(imKey):
-    global cachedkeys
-    if imKey in cache.keys():
-        return cache[imKey]
-    else:
+    ConfigureImageCache()
+    imgs = cache.get(imKey)
+    if imgs is None:
         ir = ImageReader()
         filenames = db.GetFullChannelPathsForImage(imKey)
         imgs = ir.ReadImages(filenames)                       
-        cache[imKey] = imgs
-        cachedkeys += [imKey]
-        while len(cachedkeys) > int(p.image_buffer_size):
-            del cache[cachedkeys.pop(0)]
-        return cache[imKey]
+        cache.put(imKey, imgs)
+    return imgs
 
 def ShowImage(imKey, chMap, parent=None, brightness=1.0, scale=1.0, contrast=None):
     from imageviewer import ImageViewer
@@ -119,25 +132,52 @@ def MergeToBitmap(imgs, chMap, brightness=1.0, scale=1.0, masks=[], contrast=Non
     blending - list, how to blend this channel with others 'add' or 'subtract'
                eg: ['add','add','add','subtract']
     '''
-    if contrast=='Log':
-        logims = [log_transform(im) for im in imgs]
-        imData = MergeChannels(logims, chMap, masks=masks)
-    elif contrast=='Linear':
-        newims = [auto_contrast(im) for im in imgs]
-        imData = MergeChannels(newims, chMap, masks=masks)
-    else:
-        imData = MergeChannels(imgs, chMap, masks=masks)
-        
-    h,w = imgs[0].shape
+    if masks:
+        if contrast=='Log':
+            logims = [log_transform(im) for im in imgs]
+            imData = MergeChannels(logims, chMap, masks=masks)
+        elif contrast=='Linear':
+            newims = [auto_contrast(im) for im in imgs]
+            imData = MergeChannels(newims, chMap, masks=masks)
+        else:
+            imData = MergeChannels(imgs, chMap, masks=masks)
 
-    # Convert from float [0-1] to 8bit
-    imData *= 255.0
+        # Convert from float [0-1] to 8bit
+        imData *= 255.0
+        imData[imData>255] = 255
+        imData = imData.astype('uint8')
+        img = _RGBToBitmap(imData, scale, display_whole_image, brightness)
+    else:
+        imData = MergeChannelsToRGB(imgs, chMap, brightness=brightness, contrast=contrast)
+        img = _RGBToBitmap(imData, scale, display_whole_image)
+    return img
 
-    imData[imData>255] = 255
+def MergeTilesToBitmaps(tiles, chMap, brightness=1.0, scale=1.0, contrast=None, display_whole_image=False):
+    '''
+    Like MergeToBitmap, but for a list of tiles (each a list of channel
+    arrays) at once. Tiles of the same size are composited in a single
+    call to MergeChannelsToRGB.
+    Returns a list of bitmaps in the order of the tiles.
+    '''
+    bitmaps = [None] * len(tiles)
+    by_shape = {}
+    for i, imgs in enumerate(tiles):
+        by_shape.setdefault(tuple(im.shape for im in imgs), []).append(i)
+    for indices in by_shape.values():
+        stacks = [np.array([tiles[i][c] for i in indices]) 
+                  for c in range(len(tiles[indices[0]]))]
+        rgb = MergeChannelsToRGB(stacks, chMap, brightness=brightness, contrast=contrast)
+        for i, imData in zip(indices, rgb):
+            bitmaps[i] = _RGBToBitmap(imData, scale, display_whole_image)
+    return bitmaps
+
+def _RGBToBitmap(imData, scale=1.0, display_whole_image=False, brightness=1.0):
+    '''Converts an h x w x 3 uint8 array to a wx.Bitmap'''
+    h, w = imData.shape[:2]
 
     # Write wx.Image
     img = wx.EmptyImage(w,h)
-    img.SetData(imData.astype('uint8').flatten())
+    img.SetData(np.ascontiguousarray(imData).tostring())
 
     tmp_h = int(p.image_size)
     tmp_w = int(p.image_size)
@@ -159,6 +199,102 @@ def MergeToBitmap(imgs, chMap, brightness=1.0, scale=1.0, masks=[], contrast=Non
 
     return img.ConvertToBitmap()
 
+colormap = {'red'      : [1,0,0], 
+            'green'    : [0,1,0], 
+            'blue'     : [0,0,1], 
+            'cyan'     : [0,1,1], 
+            'yellow'   : [1,1,0], 
+            'magenta'  : [1,0,1], 
+            'gray'     : [1,1,1], 
+            'none'     : [0,0,0] }
+
+def _ChannelLevels(im, contrast, buf, out):
+    '''
+    Writes the 8-bit display levels of one channel into the uint8 array
+    out, using the float32 array buf as scratch space. im may hold a
+    single image (h x w) or a stack of tiles (n x h x w); for the 'Linear'
+    and 'Log' contrast modes each tile is stretched by its own range, like
+    auto_contrast and log_transform do.
+    '''
+    axes = (-2, -1)
+    if contrast in ('Linear', 'Log'):
+        lo = im.min(axis=axes, keepdims=True)
+        hi = im.max(axis=axes, keepdims=True)
+        # Binary images are left as they are
+        stretch = ((im > lo) & (im < hi)).any(axis=axes, keepdims=True)
+    if contrast == 'Linear':
+        span = np.where(stretch, hi - lo, 1.0)
+        np.subtract(im, np.where(stretch, lo, 0.0), out=buf)
+        buf *= (255.0 / span).astype(np.float32)
+    elif contrast == 'Log':
+        positive = np.where(im > 0, im, np.inf).min(axis=axes, keepdims=True)
+        positive = np.where(np.isfinite(positive), positive, hi)
+        np.clip(im, positive, np.maximum(positive, hi), out=buf)
+        np.log(buf, out=buf)
+        buf -= np.log(positive).astype(np.float32)
+        top = np.log(hi / positive)
+        factor = np.where(top > 0, 255.0 / np.where(top > 0, top, 1.0), 0.0)
+        buf *= factor.astype(np.float32)
+        # Binary images are left as they are
+        if not stretch.all():
+            mask = np.broadcast_to(~stretch, im.shape)
+            buf[mask] = im[mask] * 255.0
+    else:
+        np.multiply(im, 255.0, out=buf)
+    np.clip(buf, 0, 255, out=buf)
+    out[...] = buf
+
+def MergeChannelsToRGB(imgs, chMap, brightness=1.0, contrast=None):
+    '''
+    Merges the given channels into an 8-bit RGB image the same way
+    MergeChannels, contrast and brightness do, without going through a
+    float64 RGB image.
+    imgs  - list of channel arrays, each either h x w or a stack of tiles
+            n x h x w
+    Returns a uint8 array of shape imgs[0].shape + (3,).
+    Each channel is converted to 8-bit levels once. The levels are
+    blended with integer arithmetic into one preallocated accumulator,
+    and clipping and brightness are applied with a single 8-bit lookup
+    table.
+    '''
+    n_channels = sum(map(int, p.channels_per_image))
+    blending = p.image_channel_blend_modes or ['add']*n_channels
+    shape = imgs[0].shape
+
+    acc = np.zeros((3,) + shape, dtype=np.int16)
+    buf = np.empty(shape, dtype=np.float32)
+    levels = [None] * len(imgs)
+    for i, im in enumerate(imgs):
+        if chMap[i].lower() == 'none':
+            continue
+        levels[i] = np.empty(shape, dtype=np.uint8)
+        _ChannelLevels(im, contrast, buf, levels[i])
+
+    for mode in ('add', 'subtract'):
+        for i, level in enumerate(levels):
+            if level is not None and blending[i].lower() == mode:
+                c = colormap[chMap[i].lower()]
+                for chan in range(3):
+                    if c[chan]:
+                        if mode == 'add':
+                            acc[chan] += level
+                        else:
+                            acc[chan] -= level
+        np.clip(acc, 0, 255, out=acc)
+
+    for i, level in enumerate(levels):
+        if level is not None and blending[i].lower() == 'solid':
+            c = colormap[chMap[i].lower()]
+            solid = level == 255
+            for chan in range(3):
+                acc[chan][solid] = 255 * c[chan]
+
+    lut = np.minimum(np.arange(256) * brightness, 255).astype(np.uint8)
+    rgb = np.empty(shape + (3,), dtype=np.uint8)
+    for chan in range(3):
+        rgb[..., chan] = lut[acc[chan]]
+    return rgb
+
 def MergeChannels(imgs, chMap, masks=[]):
     '''
     Merges the given image data into the channels listed in chMap.
@@ -168,15 +304,6 @@ def MergeChannels(imgs, chMap, masks=[]):
     blending = p.image_channel_blend_modes or ['add']*n_channels
     h,w = imgs[0].shape
     
-    colormap = {'red'      : [1,0,0], 
-                'green'    : [0,1,0], 
-                'blue'     : [0,0,1], 
-                'cyan'     : [0,1,1], 
-                'yellow'   : [1,1,0], 
-                'magenta'  : [1,0,1], 
-                'gray'     : [1,1,1], 
-                'none'     : [0,0,0] }
-    
     imData = np.zeros((h,w,3), dtype='float')
     
     for i, im in enumerate(imgs):
@@ -2,12 +2,18 @@
 import numpy as np
 import sys
 import logging
+import collections
+import itertools
+import cPickle
+import multiprocessing
+import threading
+import Queue
 
 sys.path.insert(1, '/home/vagrant/cpa-multiclass/CellProfiler-Analyst/cpa');
 sys.path.insert(1, '/home/vagrant/cpa-multiclass/CellProfiler-Analyst/')
 
 import cpa.sqltools
-from dbconnect import DBConnect, UniqueObjectClause, UniqueImageClause, image_key_columns, GetWhereClauseForImages, GetWhereClauseForObjects, object_key_defs
+from dbconnect import DBConnect, UniqueObjectClause, UniqueImageClause, image_key_columns, GetWhereClauseForImages, GetWhereClauseForObjects, object_key_defs, object_key_columns, clean_up_colnames, rows_to_float_array
 from properties import Properties
 from datamodel import DataModel
 from sklearn.ensemble import AdaBoostClassifier
@@ -21,66 +27,78 @@ temp_score_table = "_scores"
 temp_class_table = "_class"
 filter_table_prefix = '_filter_'
 
-def create_perobject_class_table(classifier, classNames):
+def _probability_classes(classifier):
+    '''
+    Returns the class numbers whose probabilities classifier.PredictProba
+    returns, in the order of its columns, or None if the trained model
+    doesn't provide probabilities.
+    '''
+    model = getattr(classifier, 'classifier', None)
+    if getattr(classifier, 'PredictProba', None) is None or model is None:
+        return None
+    # eg: SVC only provides probabilities if trained for them, and raises
+    # AttributeError otherwise
+    if not hasattr(model, 'predict_proba') or not hasattr(model, 'classes_'):
+        return None
+    return [int(c) for c in model.classes_]
+
+def create_perobject_class_table(classifier, classNames, batch_size=10000):
     '''
     classifier: generalclassifier object
     classNames: list/array of class names
-    RETURNS: Saves table with columns Table Number, Image Number, Object Number, class number, class name to a pre defined
+    batch_size: number of rows written per batched INSERT
+    RETURNS: Saves table with columns Table Number, Image Number, Object Number, class name, class number
+    and (if the classifier provides them) the probability of each class to a pre defined
     table in the database (the class number is the predicted class)
     '''
-    nClasses = len(classNames)
-
     if p.class_table is None:
         raise ValueError('"class_table" in properties file is not set.')
 
+    prob_cols = clean_up_colnames(['prob_%s'%(name) for name in classNames])
     index_cols = UniqueObjectClause()
-    class_cols = UniqueObjectClause() + ', class_number, class'
-    class_col_defs = object_key_defs() + ', class VARCHAR (%d)'%(3) + ', class_number INT'
-
+    class_cols = list(object_key_columns()) + ['class', 'class_number']
+    class_col_defs = [object_key_defs(), 'class VARCHAR (%d)'%(max([len(str(name)) for name in classNames] + [1])),
+                      'class_number INT']
+    # The model may not have been trained on every class, so its
+    # probabilities are put in the columns of the classes it knows.
+    prob_classes = _probability_classes(classifier)
+    with_probabilities = prob_classes is not None
+    if with_probabilities:
+        class_cols += prob_cols
+        class_col_defs += ['%s FLOAT'%(col) for col in prob_cols]
 
     # Drop must be explicitly asked for Classifier.ScoreAll
-    print('Drop table...')
+    logging.info('Creating class table %s'%(p.class_table))
     db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
-    print('Create table...')
-    db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-    print('Create index...')
-    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
+    db.execute('CREATE TABLE %s (%s)'%(p.class_table, ', '.join(class_col_defs)))
 
-    print('Getting data...')
+    insert = 'INSERT INTO %s (%s) VALUES (%s)'%(p.class_table, ', '.join(class_cols),
+                                                ', '.join(['%s'] * len(class_cols)))
+    query = 'SELECT %s, %s FROM %s'%(UniqueObjectClause(p.object_table),
+                                     ",".join(db.GetColnamesForClassifier()), p.object_table)
     number_of_features = len(db.GetColnamesForClassifier())
-    wheres = _where_clauses(p, dm, None)
-    data = []
-    for idx, where_clause in enumerate(wheres):
-        data = db.execute('SELECT %s, %s FROM %s '
-                          '%s WHERE %s'
-                          %(UniqueObjectClause(p.object_table),
-                            ",".join(db.GetColnamesForClassifier()), p.object_table,'', where_clause),
-                          silent=(idx > 10))
-        #data.extend(result)
-        #print('Getting predictions...')
-        cell_data, object_keys = processData(data)
-
-        predicted_classes = classifier.Predict(cell_data)
-        #print('Writing to database...')
-        if len(object_keys.shape) > 2:
-            expr = 'CASE '+ ''.join(["WHEN TableNumber=%d AND ImageNumber=%d AND ObjectNumber=%d THEN '%s'"%(
-                object_keys[ii][0], object_keys[ii][1], object_keys[ii][2], predicted_classes[ii] )
-                for ii in range(0, len(predicted_classes))])+ " END"
-            expr2 = 'CASE '+ ''.join(["WHEN TableNumber=%d AND ImageNumber=%d AND ObjectNumber=%d THEN '%s'"%(
-                object_keys[ii][0], object_keys[ii][1], object_keys[ii][2],
-                classNames[predicted_classes[ii] - 1]) for ii in range(0, len(predicted_classes))])+ " END"
-        elif len(object_keys.shape) == 2:
-            expr = 'CASE '+ ''.join(["WHEN ImageNumber=%d AND ObjectNumber=%d THEN '%s'"%(
-                object_keys[ii][0], object_keys[ii][1], predicted_classes[ii] )
-                for ii in range(0, len(predicted_classes))])+ " END"
-            expr2 = 'CASE '+ ''.join(["WHEN ImageNumber=%d AND ObjectNumber=%d THEN '%s'"%(
-                object_keys[ii][0], object_keys[ii][1], classNames[predicted_classes[ii] - 1])
-                for ii in range(0, len(predicted_classes))])+ " END"
-        db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s'%(p.class_table, class_cols, index_cols, expr, expr2, p.object_table),
-            silent=True)
-        print(idx)
+    nrows = 0
+    # Stream the object table rather than loading it, so that it needn't
+    # fit in memory.
+    with db.iter_batches(query, batch_size=batch_size) as batches:
+        for values in batches:
+            object_keys = values[:, :-number_of_features].astype(np.int64)
+            cell_data = np.nan_to_num(values[:, -number_of_features:])
+            predicted_classes = np.asarray(classifier.Predict(cell_data))
+            columns = [object_keys.tolist(),
+                       [[str(classNames[c - 1]), int(c)] for c in predicted_classes]]
+            if with_probabilities:
+                probabilities = np.zeros((len(cell_data), len(classNames)))
+                probabilities[:, np.array(prob_classes) - 1] = classifier.PredictProba(cell_data)
+                columns += [probabilities.tolist()]
+            rows = [list(itertools.chain(*row)) for row in itertools.izip(*columns)]
+            db.execute_many(insert, rows)
+            nrows += len(rows)
+    # Indexing after the load is much cheaper than maintaining the index
+    # on every insert.
+    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
     db.Commit()
-
+    logging.info('Wrote %d rows to class table %s'%(nrows, p.class_table))
 
 
 def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
@@ -90,8 +108,8 @@ def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
     classifier: trained classifier object
     filterKeys: (optional) A list of specific imKeys OR obKeys (NOT BOTH)
         to classify.
-        * WARNING: If this list is too long, you may exceed the size limit to
-          MySQL queries.
+        * Long lists are matched through a temporary table of keys (see
+          DBConnect.key_table_clause) rather than spelled out in the query.
         * Useful when fetching N objects from a particular class. Use the
           DataModel to get batches of random objects, and sift through them
           here until N objects of the desired class have been accumulated.
@@ -114,15 +132,8 @@ def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
     else:
         whereclause = ""
 
-    if p.area_scoring_column:
-        data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
-        ",".join(db.GetColnamesForClassifier()),
-        _objectify(p, p.area_scoring_column), p.object_table, whereclause))
-        area_score = data[-1] #separate area from data
-        data = data[:-1]
-    else:
-        data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
-        ",".join(db.GetColnamesForClassifier()), p.object_table, whereclause))
+    data = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(p.object_table),
+    ",".join(db.GetColnamesForClassifier()), p.object_table, whereclause))
 
     cell_data, object_keys = processData(data)
     res = [] # list
@@ -140,26 +151,22 @@ def FilterObjectsFromClassN(classNum, classifier, filterKeys, uncertain):
         res = object_keys[predicted_classes == classNum * np.ones(predicted_classes.shape)].tolist() #convert to list 
     return map(tuple,res) # ... and then to tuples
 
-def processData(data):
-    #takes data from query and returns arrays for feature values and object keys
+def processData(data, dtype=np.float64):
+    '''
+    Splits query results into arrays of feature values and object keys.
+    data: rows of key columns followed by the classifier columns
+    dtype: float type of the returned feature values
+    RETURNS: (cell_data, object_keys) where NULLs and values that can't be
+        converted to float are set to 0 in cell_data
+    '''
     number_of_features = len(db.GetColnamesForClassifier())
-
-    cell_data = np.array([row[-number_of_features:] for row in data]) #last number_of_features columns in row
-    object_keys = np.array([row[:-number_of_features] for row in data]) #all elements in row before last (number_of_features) elements
-
-    data_shape = cell_data.shape
-    # if numpy array is already floats, pass; if numpy array contains strings, convert
-    cell_data = np.where(cell_data == np.array(None), '0', cell_data).astype(str)
-
-    try:
-        cell_data = np.reshape(np.genfromtxt(cell_data.ravel(), delimiter=','), data_shape)
-        print 'data type 1 ', cell_data.dtype
-        cell_data = np.nan_to_num(cell_data)
-    except:
-        print 'data type 2 ', cell_data.dtype
-        cell_data = np.nan_to_num(cell_data)
-    logging.info('Any values that cannot be converted to float are set to 0')
-    return cell_data, object_keys
+    if len(data) == 0:
+        return np.zeros((0, number_of_features), dtype), np.zeros((0, 0), np.int64)
+    values = rows_to_float_array(data, dtype=dtype)
+    # all elements in a row before the last number_of_features are the key
+    object_keys = values[:, :-number_of_features].astype(np.int64)
+    cell_data = np.ascontiguousarray(values[:, -number_of_features:])
+    return np.nan_to_num(cell_data), object_keys
 
 def _objectify(p, field):
     return "%s.%s"%(p.object_table, field)
@@ -196,11 +203,178 @@ def _where_clauses(p, dm, filter_name):
                  %(_objectify(p, p.image_id), lo[0], _objectify(p, p.image_id), hi[0])
                  for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
 
-def PerImageCounts(classifier, num_classes, filter_name=None, cb=None):
+_worker_classifier = None
+
+def _init_scoring_worker(classifier):
+    # Pool initializer: the classifier is shipped to each worker only once.
+    global _worker_classifier
+    _worker_classifier = classifier
+
+def _count_block(block):
+    # Pool task: classify and count one block with the worker's classifier.
+    return _count_predictions(_worker_classifier, *block)
+
+def _count_predictions(classifier, cell_data, image_keys, areas=None):
+    '''
+    Classifies one block of objects and counts them per image and class.
+    cell_data: N x F array of feature values
+    image_keys: N x K array of image key columns for each object
+    areas: (optional) length N array of area scores to sum alongside the counts
+    RETURNS: a dict mapping image key + (class,) to np.array([count]) or,
+        if areas were given, np.array([count, area_sum])
+    '''
+    counts = {}
+    if len(cell_data) == 0:
+        return counts
+    predicted_classes = np.asarray(classifier.Predict(cell_data)).astype(np.int64)
+    rows = np.column_stack((np.asarray(image_keys).astype(np.int64), predicted_classes))
+    # sort rows so identical (image key, class) rows are adjacent, then
+    # count the length of each run
+    order = np.lexsort(rows.T[::-1])
+    rows = rows[order]
+    new_run = np.ones(len(rows), dtype=bool)
+    new_run[1:] = np.any(rows[1:] != rows[:-1], axis=1)
+    starts = np.flatnonzero(new_run)
+    run_counts = np.diff(np.append(starts, len(rows)))
+    if areas is not None:
+        run_areas = np.add.reduceat(np.asarray(areas, dtype=float)[order], starts)
+    for i, start in enumerate(starts):
+        key = tuple(int(v) for v in rows[start])
+        if areas is None:
+            counts[key] = np.array([run_counts[i]])
+        else:
+            counts[key] = np.array([run_counts[i], run_areas[i]])
+    return counts
+
+def _fetch_blocks(queries, area_score, blocks, stop):
+    '''
+    Producer for _iter_blocks: runs each query on this thread's own
+    connection and puts (cell_data, keys, areas) blocks on the bounded
+    blocks queue. Puts None when done, or the exception if a query failed.
+    '''
+    try:
+        for idx, query in enumerate(queries):
+            if stop.is_set():
+                break
+            data = db.execute(query, silent=(idx > 10))
+            areas = None
+            if area_score:
+                # the area column is selected after the classifier columns
+                areas = np.array([row[-1] or 0 for row in data], dtype=float)
+                data = [row[:-1] for row in data]
+            cell_data, keys = processData(data)
+            blocks.put((cell_data, keys, areas))
+        blocks.put(None)
+    except Exception, e:
+        logging.error('Failed to fetch objects for scoring: %s'%(e))
+        blocks.put(e)
+    finally:
+        db.CloseConnection()
+
+def _iter_blocks(queries, area_score=False, queue_size=2):
+    '''
+    Yields a (cell_data, keys, areas) block for each query. The queries are
+    run ahead in a background thread so fetching overlaps with whatever the
+    caller does with each block, but no more than queue_size blocks are held
+    in memory at once.
+    queries: list of SELECT statements returning key columns, classifier
+        columns, and (if area_score) the area scoring column
+    '''
+    blocks = Queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=_fetch_blocks, name='ScoringFetcher',
+                               args=(queries, area_score, blocks, stop))
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        # unblock the fetcher if it is waiting on a full queue
+        while fetcher.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+def _score_blocks(classifier, queries, area_score=False, processes=None, cb=None):
+    '''
+    Classifies and counts the objects returned by each query.
+    Fetching from the database runs in a background thread while prediction
+    runs in a pool of worker processes so the two overlap. Both the fetched
+    blocks and the blocks awaiting prediction are bounded so memory use stays
+    flat no matter how large the object table is.
+    classifier: trained classifier object (must be picklable if processes > 1)
+    queries: list of SELECT statements returning image key columns, classifier
+        columns, and (if area_score) the area scoring column
+    processes: number of worker processes, defaults to 1. With 1 process,
+        prediction runs in the calling thread.
+    cb: callback function to update with the fraction complete
+    RETURNS: a dict mapping image key + (class,) to counts (see _count_predictions)
+    '''
+    processes = max(1, min(int(processes or 1), len(queries)))
+    if processes > 1:
+        try:
+            cPickle.dumps(classifier, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            logging.warn('Classifier can not be sent to worker processes, '
+                         'scoring with a single process: %s'%(e))
+            processes = 1
+
+    pool = None
+    if processes > 1:
+        logging.info('Scoring with %d processes'%(processes))
+        pool = multiprocessing.Pool(processes, _init_scoring_worker, (classifier,))
+
+    counts = {}
+    def merge(block_counts):
+        for key, value in block_counts.items():
+            if key in counts:
+                counts[key] += value
+            else:
+                counts[key] = value
+
+    pending = collections.deque()
+    num_done = [0]
+    def block_done(block_counts):
+        merge(block_counts)
+        num_done[0] += 1
+        if cb:
+            cb(min(1, num_done[0] / float(len(queries)))) #progress
+
+    blocks = _iter_blocks(queries, area_score, 2 * processes)
+    try:
+        for block in blocks:
+            if pool is None:
+                block_done(_count_predictions(classifier, *block))
+                continue
+            pending.append(pool.apply_async(_count_block, (block,)))
+            while pending and (len(pending) >= 2 * processes or pending[0].ready()):
+                block_done(pending.popleft().get())
+        while pending:
+            block_done(pending.popleft().get())
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        blocks.close()
+        if pool is not None:
+            pool.terminate()
+    return counts
+
+def PerImageCounts(classifier, num_classes, filter_name=None, cb=None, processes=None):
     '''
     classifier: trained classifier object
     filter: name of filter, or None.
     cb: callback function to update with the fraction complete
+    processes: number of processes used to classify objects. Defaults to
+        Properties.scoring_processes or 1.
     RETURNS: A list of lists of imKeys and respective object counts for each class:
         Note that the imKeys are exploded so each row is of the form:
         [TableNumber, ImageNumber, Class1_ObjectCount, Class2_ObjectCount,...]
@@ -208,9 +382,9 @@ def PerImageCounts(classifier, num_classes, filter_name=None, cb=None):
         If p.area_scoring_column is set, then area scores will be appended to
         the object scores.
     '''
+    if processes is None and p.scoring_processes:
+        processes = int(p.scoring_processes)
 
-    # I'm pretty sure this would be even faster if we were to run two
-    # or more parallel threads and split the work between them.
     # For each image clause, classify the cells using the model
     # then for each image key, count the number in each class (and maybe area)
     def do_by_steps(tables, filter_name, area_score=False):
@@ -229,53 +403,13 @@ def PerImageCounts(classifier, num_classes, filter_name=None, cb=None):
             if join_table:
                 join_clause = 'JOIN %s USING (%s)' % (join_table, ','.join(image_key_columns()))
 
-        wheres = _where_clauses(p, dm, filter_name)
-        num_clauses = len(wheres)
-        counts = {}
-
-        # iterate over where clauses to go through whole set
-        for idx, where_clause in enumerate(wheres):
-            if filter_clause is not None:
-                where_clause += ' AND ' + filter_clause
-            if area_score:
-                data = db.execute('SELECT %s, %s, %s FROM %s '
-                                  '%s WHERE %s'
-                                  %(UniqueImageClause(p.object_table),
-                                    ",".join(db.GetColnamesForClassifier()),
-                                    _objectify(p, p.area_scoring_column), tables,
-                                    join_clause, where_clause),
-                                  silent=(idx > 10))
-                area_score = data[-1] #separate area from data
-                data = data[:-1]
-            else:
-                data = db.execute('SELECT %s, %s FROM %s '
-                                  '%s WHERE %s'
-                                  %(UniqueImageClause(p.object_table),
-                                    ",".join(db.GetColnamesForClassifier()), tables,
-                                    join_clause, where_clause),
-                                  silent=(idx > 10))
-
-            cell_data, image_keys = processData(data)
-            for i in range(cell_data.shape[0]):
-                for j in range(cell_data.shape[1]):
-                    try:
-                        float(cell_data[i,j])
-                    except:
-                        print i,j, cell_data[i,j], type(cell_data[i,j])
-            predicted_classes = classifier.Predict(cell_data)
-            for i in range(0, len(predicted_classes)):
-                row_cls = tuple(np.append(image_keys[i], predicted_classes[i]))
-                oneCount = np.array([1])
-                if area_score:
-                    oneCount = np.append(oneCount, area_score[i])
-                if row_cls in counts:
-                    counts[row_cls] += oneCount
-                else:
-                    counts[row_cls] = oneCount
-
-            if cb:
-                cb(min(1, idx/float(num_clauses))) #progress
-        return counts
+        columns = [UniqueImageClause(p.object_table), ",".join(db.GetColnamesForClassifier())]
+        if area_score:
+            columns += [_objectify(p, p.area_scoring_column)]
+        queries = ['SELECT %s FROM %s %s WHERE %s AND %s'
+                   %(', '.join(columns), tables, join_clause, where_clause, filter_clause)
+                   for where_clause in _where_clauses(p, dm, filter_name)]
+        return _score_blocks(classifier, queries, area_score, processes, cb)
 
     counts = do_by_steps(p.object_table, filter_name, p.area_scoring_column)
 
@@ -359,7 +359,6 @@ class PlateMapPanel(wx.Panel):
                             bmp[well] = imagetools.MergeToBitmap(imgs[well], p.image_channel_colors, scale=scale)
                             dc.DrawBitmap(bmp[well], px+1, py+1)
                     elif self.well_disp == IMAGE:
-                        p.image_buffer_size = p.plate_shape[0] * p.plate_shape[1]
                         wellkey = self.GetWellKeyAtCoord(px+r, py+r)
                         well = wellkey[-1]
                         if imgs.has_key(well):
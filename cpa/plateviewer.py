@@ -4,6 +4,7 @@ from dbconnect import DBConnect, UniqueImageClause, UniqueWellClause, image_key_
 import dbconnect
 import sqltools as sql
 import platemappanel as pmp
+from queryexecutor import QueryExecutor
 from datamodel import DataModel
 from guiutils import TableComboBox, FilterComboBox, get_other_table_from_user
 from wx.combo import OwnerDrawnComboBox as ComboBox
@@ -217,7 +218,6 @@ class PlateViewer(wx.Frame, CPATool):
         aggMethod   = self.aggregationMethodsChoice.Value
         categorical = measurement not in get_numeric_columns_from_table(table)
         fltr        = self.filterChoice.Value
-        self.colorBar.ClearNotifyWindows()
 
         q = sql.QueryBuilder()
         well_key_cols = [sql.Column(p.image_table, col) for col in well_key_columns()]
@@ -254,7 +254,13 @@ class PlateViewer(wx.Frame, CPATool):
                 q.add_filter(p.gates[fltr].as_filter())
             else:
                 raise Exception('Could not find filter "%s" in gates or filters'%(fltr))
-        wellkeys_and_values = db.execute(str(q))
+        # The plates are drawn once the query has run in the background
+        QueryExecutor.getInstance().redraw(
+            self, str(q),
+            lambda rows: self._show_plate_maps(rows, table, measurement, categorical, fltr))
+
+    def _show_plate_maps(self, wellkeys_and_values, table, measurement, categorical, fltr):
+        self.colorBar.ClearNotifyWindows()
         wellkeys_and_values = np.array(wellkeys_and_values, dtype=object)
 
         # Replace measurement None's with nan
@@ -304,7 +310,7 @@ class PlateViewer(wx.Frame, CPATool):
                     wx.MessageBox('No numeric data was found in %s.%s'
                                   %(table, measurement), 'Warning')
 
-        if categorical:
+        if categorical or self.wellDisplayChoice.Value.lower() in ['image', 'thumbnail']:
             self.colorBar.Hide()
         else:
             self.colorBar.Show()
@@ -5,6 +5,12 @@ Example usage as a script (builds cache and precomputes normalizations):
 
 $ python -m cpa.profiling.cache CDP2.properties /imaging/analysis/2008_12_04_Imaging_CDRP_for_MLPCN/CDP2/cache "Image_Metadata_ASSAY_WELL_ROLE = 'mock'"
 
+An existing per-image cache can be converted to the consolidated
+per-plate layout (one memory-mapped float32 feature matrix per plate)
+without access to the database:
+
+$ python -m cpa.profiling.cache -c /imaging/analysis/2008_12_04_Imaging_CDRP_for_MLPCN/CDP2/cache
+
 Example usage as module:
 
 >>> import cpa
@@ -23,6 +29,7 @@ import sys
 import os
 import logging
 import json
+import itertools
 from optparse import OptionParser
 import progressbar
 import numpy as np
@@ -53,6 +60,10 @@ def invert_dict(d):
         inverted.setdefault(v, []).append(k)
     return inverted
 
+# Consolidated plate stores opened by this process, keyed by the
+# filename of their index: (mtime, features, cellids, index).
+_consolidated_stores = {}
+
 
 
 class Cache(object):
@@ -74,6 +85,71 @@ class Cache(object):
         # feature files were previously stored as npy files
         return os.path.join(self.cache_dir, unicode(plate),
                             u'-'.join(map(unicode, imKey)) + '.npy')
+
+    def _consolidated_filenames(self, plate):
+        """Return the filenames of the feature matrix, the cellid column
+        and the image index of the consolidated store for PLATE."""
+        plate_dir = os.path.join(self.cache_dir, unicode(plate))
+        return (os.path.join(plate_dir, u'features.npy'),
+                os.path.join(plate_dir, u'cellids.npy'),
+                os.path.join(plate_dir, u'index.pickle'))
+
+    def _has_consolidated(self, plate):
+        # The index is written last, so its presence means the store
+        # is complete.
+        return os.path.exists(self._consolidated_filenames(plate)[2])
+
+    def _consolidated(self, plate):
+        """Return (features, cellids, index) for the consolidated store
+        of PLATE. The feature matrix is memory-mapped read-only and
+        INDEX maps each image key to its (start, stop) row range."""
+        features_filename, cellids_filename, index_filename = \
+            self._consolidated_filenames(plate)
+        mtime = os.path.getmtime(index_filename)
+        store = _consolidated_stores.get(index_filename)
+        if store is None or store[0] != mtime:
+            store = (mtime,
+                     np.load(features_filename, mmap_mode='r'),
+                     np_load(cellids_filename),
+                     cpa.util.unpickle1(index_filename))
+            _consolidated_stores[index_filename] = store
+        return store[1:]
+
+    def _remove_consolidated(self, plate):
+        """Remove the consolidated store of PLATE, eg: because one of
+        its per-image files has been rewritten."""
+        features_filename, cellids_filename, index_filename = \
+            self._consolidated_filenames(plate)
+        _consolidated_stores.pop(index_filename, None)
+        # The index goes first, so that a partly removed store is
+        # never taken for a complete one.
+        for filename in (index_filename, features_filename, cellids_filename):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _load_consolidated(self, plate, image_keys):
+        """Return the features (as float) and cellids of IMAGE_KEYS from
+        the consolidated store of PLATE, in the order given. Images
+        that are adjacent in the store are read as a single slice."""
+        features, cellids, index = self._consolidated(plate)
+        runs = []
+        for imKey in image_keys:
+            start, stop = index[imKey]
+            if start == stop:
+                continue
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = stop
+            else:
+                runs.append([start, stop])
+        nrows = sum(stop - start for start, stop in runs)
+        _features = np.empty((nrows, features.shape[1]), dtype=float)
+        _cellids = np.empty(nrows, dtype=int)
+        i = 0
+        for start, stop in runs:
+            _features[i:i + stop - start] = features[start:stop]
+            _cellids[i:i + stop - start] = cellids[start:stop]
+            i += stop - start
+        return _features, _cellids
     @property
     def _plate_map(self):
         if self._cached_plate_map is None:
@@ -121,36 +197,53 @@ class Cache(object):
         cellids = []
 
         for plate, imKeys in images_per_plate.items():
-            for imKey in imKeys:
-                # Work around bug in numpy that causes file
-                # handles to be left open.
-                with open(_image_filename(plate, imKey), 'rb') as file:
-                    raw = np.load(file)
-                    if flag_bkwd:
-                        _features = np.array(raw, dtype=float)
-                    else:
-                        _features = np.array(raw["features"], dtype=float)
-                        _cellids = np.array(raw["cellids"], dtype=int)
-
-                #import pdb
-                #pdb.set_trace()
-
-                if removeRowsWithNaN and len(_features) > 0:
-                    prune_rows = np.any(np.isnan(_features),axis=1)
-                    _features = _features[-prune_rows,:]
-                    if not flag_bkwd:
-                        if _cellids.shape != ():
-                            _cellids = _cellids[-prune_rows]
-                        else:
-                            # This is redundant but put in here
-                            # for sake of completeness
-                            if prune_rows[0]:
-                                _cellids = np.array([])
-
-                if len(_features) > 0:
-                    features.append(normalizer.normalize(plate, _features))
-                    if not flag_bkwd:
+            if self._has_consolidated(plate):
+                index = self._consolidated(plate)[2]
+            else:
+                index = {}
+            # Images missing from the consolidated store (eg: added
+            # since it was built) are read from their own files.
+            for consolidated, run in itertools.groupby(imKeys, lambda imKey: imKey in index):
+                if consolidated:
+                    _features, _cellids = self._load_consolidated(plate, list(run))
+                    if removeRowsWithNaN and len(_features) > 0:
+                        prune_rows = np.any(np.isnan(_features), axis=1)
+                        _features = _features[~prune_rows,:]
+                        _cellids = _cellids[~prune_rows]
+                    if len(_features) > 0:
+                        features.append(normalizer.normalize(plate, _features))
                         cellids.append(_cellids)
+                else:
+                    for imKey in run:
+                        # Work around bug in numpy that causes file
+                        # handles to be left open.
+                        with open(_image_filename(plate, imKey), 'rb') as file:
+                            raw = np.load(file)
+                            if flag_bkwd:
+                                _features = np.array(raw, dtype=float)
+                            else:
+                                _features = np.array(raw["features"], dtype=float)
+                                _cellids = np.array(raw["cellids"], dtype=int)
+
+                        #import pdb
+                        #pdb.set_trace()
+
+                        if removeRowsWithNaN and len(_features) > 0:
+                            prune_rows = np.any(np.isnan(_features),axis=1)
+                            _features = _features[~prune_rows,:]
+                            if not flag_bkwd:
+                                if _cellids.shape != ():
+                                    _cellids = _cellids[~prune_rows]
+                                else:
+                                    # This is redundant but put in here
+                                    # for sake of completeness
+                                    if prune_rows[0]:
+                                        _cellids = np.array([])
+
+                        if len(_features) > 0:
+                            features.append(normalizer.normalize(plate, _features))
+                            if not flag_bkwd:
+                                cellids.append(_cellids)
 
             if(len(features) > 0):
                 stackedfeatures = np.vstack(features)
@@ -231,13 +324,14 @@ class Cache(object):
         filename = self._image_filename(plate, image_key)
         if resume and os.path.exists(filename):
             return
-        features = cpa.db.execute("""select %s from %s where %s""" % (
+        features = cpa.db.execute_as_array("""select %s from %s where %s""" % (
                 ','.join(self.colnames), cpa.properties.object_table, 
                 cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        cellids  = cpa.db.execute("""select %s from %s where %s""" % (
+        cellids  = cpa.db.execute_as_array("""select %s from %s where %s""" % (
                 cpa.properties.object_id, cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        np.savez(filename, features=np.array(features, dtype=float), cellids=np.squeeze(np.array(cellids)))
+                cpa.dbconnect.GetWhereClauseForImages([image_key])), dtype=int)
+        np.savez(filename, features=features, cellids=cellids[:, 0])
+        self._remove_consolidated(plate)
 
     def _create_cache_counts(self, resume):
         """
@@ -252,6 +346,50 @@ class Cache(object):
         with cpa.util.replace_atomically(self._counts_filename) as f:
             np.save(f, counts)
 
+    def _create_cache_consolidated(self, resume=False):
+        """Convert the per-image feature files of every plate to the
+        consolidated per-plate layout. Requires the new (.npz) per-image
+        files, since the old .npy files lack cellids."""
+        for plate, image_keys in make_progress_bar('Consolidating')(invert_dict(self._plate_map).items()):
+            self._create_cache_consolidated_plate(plate, image_keys, resume)
+
+    def _create_cache_consolidated_plate(self, plate, image_keys, resume=False):
+        features_filename, cellids_filename, index_filename = \
+            self._consolidated_filenames(plate)
+        if resume and os.path.exists(index_filename):
+            return
+        image_keys = sorted(image_keys)
+        ncols = len(self.colnames)
+
+        # First pass: count the rows of each image from the cellids alone.
+        index = {}
+        nrows = 0
+        for image_key in image_keys:
+            with open(self._image_filename(plate, image_key), 'rb') as f:
+                n = np.atleast_1d(np.load(f)['cellids']).shape[0]
+            index[image_key] = (nrows, nrows + n)
+            nrows += n
+
+        # Second pass: copy the features and cellids into place.
+        features = np.lib.format.open_memmap(features_filename + '.tmp', mode='w+',
+                                             dtype=np.float32, shape=(nrows, ncols))
+        cellids = np.empty(nrows, dtype=int)
+        for image_key in image_keys:
+            start, stop = index[image_key]
+            if start == stop:
+                continue
+            with open(self._image_filename(plate, image_key), 'rb') as f:
+                raw = np.load(f)
+                features[start:stop] = np.reshape(raw['features'], (stop - start, ncols))
+                cellids[start:stop] = np.atleast_1d(raw['cellids'])
+        features.flush()
+        del features
+        os.rename(features_filename + '.tmp', features_filename)
+        with cpa.util.replace_atomically(cellids_filename) as f:
+            np.save(f, cellids)
+        cpa.util.pickle(index_filename + '.tmp', index)
+        os.rename(index_filename + '.tmp', index_filename)
+
 
 def _check_directory(dir, resume):
     if os.path.exists(dir):
@@ -264,9 +402,15 @@ def _check_directory(dir, resume):
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    parser = OptionParser("usage: %prog [-r] PROPERTIES-FILE CACHE-DIR PREDICATE")
+    parser = OptionParser("usage: %prog [-r] [-c] PROPERTIES-FILE CACHE-DIR PREDICATE\n"
+                          "       %prog -c [-r] CACHE-DIR")
     parser.add_option('-r', dest='resume', action='store_true', help='resume')
+    parser.add_option('-c', dest='consolidate', action='store_true', 
+                      help='also build the consolidated per-plate feature store')
     options, args = parser.parse_args()
+    if options.consolidate and len(args) == 1:
+        Cache(args[0])._create_cache_consolidated(options.resume)
+        sys.exit(0)
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, predicate = args
@@ -278,6 +422,8 @@ if __name__ == '__main__':
     cache = Cache(cache_dir)
 
     cache._create_cache(options.resume)
+    if options.consolidate:
+        cache._create_cache_consolidated(options.resume)
     if predicate != '':
         for Normalization in normalizations.values():
             Normalization(cache)._create_cache(predicate, options.resume)
@@ -1,7 +1,10 @@
 import sys
 import os
+import glob
 import logging
 import json
+import threading
+from collections import OrderedDict
 from optparse import OptionParser
 import progressbar
 import numpy as np
@@ -26,6 +29,69 @@ def make_progress_bar(text=None):
                                                    progressbar.ETA()]
     return progressbar.ProgressBar(widgets=widgets)
 
+#
+# Process-wide cache of normalization parameter arrays
+#
+
+# Upper bound on the total size of the cached parameter arrays.
+PARAMS_CACHE_BYTES = 256 * 2**20
+
+_params_cache = OrderedDict() # filename -> (mtime, array), oldest first
+_params_cache_lock = threading.Lock()
+_params_cache_nbytes = [0]
+
+def load_params(filename):
+    """Return the array stored in FILENAME, using a process-wide
+    cache. Since the filename contains both the normalization's
+    parameter directory and the plate, the cache is keyed by both.
+    An entry is reloaded when the file's mtime changes, and the
+    least recently used entries are evicted when the cache grows
+    beyond PARAMS_CACHE_BYTES. The returned array is read-only."""
+    mtime = os.path.getmtime(filename)
+    with _params_cache_lock:
+        entry = _params_cache.pop(filename, None)
+        if entry is not None:
+            if entry[0] == mtime:
+                _params_cache[filename] = entry
+                return entry[1]
+            _params_cache_nbytes[0] -= entry[1].nbytes
+    params = np_load(filename)
+    params.setflags(write=False)
+    with _params_cache_lock:
+        old = _params_cache.pop(filename, None)
+        if old is not None:
+            _params_cache_nbytes[0] -= old[1].nbytes
+        _params_cache[filename] = (mtime, params)
+        _params_cache_nbytes[0] += params.nbytes
+        while (_params_cache_nbytes[0] > PARAMS_CACHE_BYTES and 
+               len(_params_cache) > 1):
+            _, (_, evicted) = _params_cache.popitem(last=False)
+            _params_cache_nbytes[0] -= evicted.nbytes
+    return params
+
+def clear_params_cache():
+    with _params_cache_lock:
+        _params_cache.clear()
+        _params_cache_nbytes[0] = 0
+
+def preload_params(cache_dir, normalization_name):
+    """Load the column mask and the per-plate parameters of a
+    normalization into the process-wide cache. Meant to be run once
+    per worker when a parallel backend starts (see
+    cpa.profiling.parallel)."""
+    normalization = normalizations[normalization_name]
+    if normalization is DummyNormalization:
+        return
+    from .cache import Cache
+    normalizer = normalization(Cache(cache_dir))
+    filenames = [normalizer._colmask_filename] + \
+        sorted(glob.glob(os.path.join(normalizer.dir, 'params', '*.npy')))
+    for filename in filenames:
+        try:
+            load_params(filename)
+        except (IOError, OSError), e:
+            logger.debug('Could not preload %s: %s' % (filename, e))
+
 def _check_directory(dir, resume):
     if os.path.exists(dir):
         if not resume:
@@ -52,7 +118,7 @@ class BaseNormalization(object):
     @property
     def _colmask(self):
         if self._cached_colmask is None:
-            self._cached_colmask = np_load(self._colmask_filename)
+            self._cached_colmask = load_params(self._colmask_filename)
         return self._cached_colmask
 
     @abc.abstractmethod
@@ -174,7 +240,7 @@ class StdNormalization(BaseNormalization):
         super(StdNormalization, self).__init__(cache, param_dir)
 
     def normalize(self, plate, data):
-        params = np_load(self._params_filename(plate))
+        params = load_params(self._params_filename(plate))
         assert data.shape[1] == params.shape[1]
         data = data[:, self._colmask]
         params = params[:, self._colmask]
@@ -218,7 +284,7 @@ class RobustLinearNormalization(BaseNormalization):
         self.upper_q = upper_q
         
     def normalize(self, plate, data):
-        percentiles = np_load(self._params_filename(plate))
+        percentiles = load_params(self._params_filename(plate))
         assert data.shape[1] == percentiles.shape[1]
         data = data[:, self._colmask]
         percentiles = percentiles[:, self._colmask]
@@ -10,6 +10,10 @@ class ParallelProcessor(object):
     keyword argument "name".  This method returns a view.  A view is
     an object that has an imap method.
 
+    The optional INITIALIZER is called with INITARGS once in every
+    worker process when the backend starts, e.g. to preload data
+    that all tasks share.
+
     """
 
     @classmethod
@@ -50,7 +54,7 @@ class ParallelProcessor(object):
             return Multiprocessing()
 
     @classmethod
-    def create_from_options(cls, parser, options):
+    def create_from_options(cls, parser, options, initializer=None, initargs=()):
         noptions = ((options.ipython_profile and 1 or 0) +
                     (options.lsf_directory and 1 or 0) + 
                     (options.multiprocessing and 1 or 0))
@@ -62,16 +66,18 @@ class ParallelProcessor(object):
         elif options.ipython_profile:
             from IPython.parallel import Client, LoadBalancedView
             client = Client(profile=options.ipython_profile)
-            return IPython(client)
+            return IPython(client, initializer, initargs)
         elif options.multiprocessing:
-            return Multiprocessing()
+            return Multiprocessing(initializer, initargs)
         else:
-            return Uniprocessing()
+            return Uniprocessing(initializer, initargs)
 
 
 class IPython(ParallelProcessor):
-    def __init__(self, client):
+    def __init__(self, client, initializer=None, initargs=()):
         self.client = client
+        if initializer is not None:
+            self.client[:].apply_sync(initializer, *initargs)
 
     def view(self, name=None):
         logger.debug('%s: %d iPython engines' % (name, len(self.client.ids)))
@@ -79,19 +85,24 @@ class IPython(ParallelProcessor):
 
 
 class Multiprocessing(ParallelProcessor): 
-    def __init__(self, *args, **kwargs):
-        super(Multiprocessing, self).__init__(*args, **kwargs)
+    def __init__(self, initializer=None, initargs=()):
+        super(Multiprocessing, self).__init__()
         from multiprocessing import Pool
         # Instantiate Pool here instead of in the view method to
         # prevent it from being finalized while imap is running.
         # See http://stackoverflow.com/questions/5481104/multiprocessing-pool-imap-broken
-        self.pool = Pool()
+        self.pool = Pool(initializer=initializer, initargs=initargs)
 
     def view(self, name=None):
         return self.pool
 
 
 class Uniprocessing(ParallelProcessor):
+    def __init__(self, initializer=None, initargs=()):
+        super(Uniprocessing, self).__init__()
+        if initializer is not None:
+            initializer(*initargs)
+
     def view(self, name=None):
         logging.debug('%s: 1 sequential process' % name)
         return UniprocessingView()
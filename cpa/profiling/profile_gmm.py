@@ -29,7 +29,7 @@ from scipy import linalg
 from sklearn.mixture import GMM
 import cpa
 from .cache import Cache
-from normalization import RobustLinearNormalization, normalizations
+from normalization import RobustLinearNormalization, normalizations, preload_params
 from .profiles import Profiles, add_common_options
 from .parallel import ParallelProcessor, Uniprocessing
     
@@ -86,11 +86,12 @@ if __name__ == '__main__':
     parser.add_option('--components', dest='ncomponents', type='int', default=5, help='number of mixture components')
     add_common_options(parser)
     options, args = parser.parse_args()
-    parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 4:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, subsample_file, group_name = args
+    parallel = ParallelProcessor.create_from_options(parser, options, initializer=preload_params,
+                                                   initargs=(cache_dir, options.normalization))
     cpa.properties.LoadFile(properties_file)
 
     profiles = profile_gmm(cache_dir, subsample_file, group_name, 
@@ -37,7 +37,7 @@ from optparse import OptionParser
 import numpy as np
 import cpa
 from .cache import Cache
-from .normalization import RobustLinearNormalization, normalizations
+from .normalization import RobustLinearNormalization, normalizations, preload_params
 from profiles import Profiles, add_common_options
 from .parallel import ParallelProcessor, Uniprocessing
 
@@ -92,11 +92,12 @@ if __name__ == '__main__':
     parser.add_option('-f', dest='filter', help='only profile images matching this CPAnalyst filter')
     add_common_options(parser)
     options, args = parser.parse_args()
-    parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 4:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, group, control_filter = args
+    parallel = ParallelProcessor.create_from_options(parser, options, initializer=preload_params,
+                                                   initargs=(cache_dir, options.normalization))
 
     cpa.properties.LoadFile(properties_file)
     profiles = profile_ksstatistic(cache_dir, group, control_filter, 
@@ -9,7 +9,7 @@ import numpy as np
 from scipy.stats import mode
 import cpa
 from .cache import Cache
-from .normalization import DummyNormalization, RobustLinearNormalization, RobustStdNormalization, normalizations
+from .normalization import DummyNormalization, RobustLinearNormalization, RobustStdNormalization, normalizations, preload_params
 from .profiles import Profiles, add_common_options
 from .parallel import ParallelProcessor, Uniprocessing
 
@@ -136,11 +136,12 @@ if __name__ == '__main__':
                       action='store', default='mean')
     add_common_options(parser)
     options, args = parser.parse_args()
-    parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, group = args
+    parallel = ParallelProcessor.create_from_options(parser, options, initializer=preload_params,
+                                                   initargs=(cache_dir, options.normalization))
 
     cpa.properties.LoadFile(properties_file)
 
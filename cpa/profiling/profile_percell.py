@@ -7,7 +7,7 @@ from optparse import OptionParser
 import numpy as np
 import cpa
 from .cache import Cache
-from .normalization import DummyNormalization, RobustLinearNormalization, RobustStdNormalization, normalizations
+from .normalization import DummyNormalization, RobustLinearNormalization, RobustStdNormalization, normalizations, preload_params
 from .profiles import Profiles
 from .parallel import ParallelProcessor, Uniprocessing
 import string
@@ -98,11 +98,12 @@ if __name__ == '__main__':
     parser.add_option('--normalization', help='normalization method (default: RobustLinearNormalization)',
                       default='RobustLinearNormalization')
     options, args = parser.parse_args()
-    parallel = ParallelProcessor.create_from_options(parser, options)
 
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, group = args
+    parallel = ParallelProcessor.create_from_options(parser, options, initializer=preload_params,
+                                                   initargs=(cache_dir, options.normalization))
 
     cpa.properties.LoadFile(properties_file)
 
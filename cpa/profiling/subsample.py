@@ -19,7 +19,7 @@ import numpy as np
 import cpa
 from cpa.util import replace_atomically
 from .cache import Cache
-from .normalization import RobustLinearNormalization, normalizations
+from .normalization import RobustLinearNormalization, normalizations, preload_params
 from .parallel import ParallelProcessor, Uniprocessing
 
 def _break_indices(indices, image_keys, count_cells):
@@ -145,10 +145,11 @@ def _parse_arguments():
     parser.add_option('--normalization', help='normalization method (default: RobustLinearNormalization)',
                       default='RobustLinearNormalization')
     options, args = parser.parse_args()
-    parallel = ParallelProcessor.create_from_options(parser, options)
     if len(args) < 3 or len(args) > 4:
         parser.error('Incorrect number of arguments')
     properties_file, cache_dir, output_filename = args[:3]
+    parallel = ParallelProcessor.create_from_options(parser, options, initializer=preload_params,
+                                                   initargs=(cache_dir, options.normalization))
     if len(args) == 4:
         sample_size = int(args[3])
     else:
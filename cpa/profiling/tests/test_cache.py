@@ -1,3 +1,5 @@
+import os
+import shutil
 import tempfile
 import numpy as np
 import unittest
@@ -284,3 +286,67 @@ class CacheTestCase(unittest.TestCase):
     # TODO: test_create_image
 
     # TODO: test_check_directory
+
+
+class ConsolidatedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.c = cache.Cache(self.cache_dir)
+        self.c._cached_colnames = ['a', 'b']
+        self.c._cached_plate_map = {(1, 1): 'p1', (1, 2): 'p1', (1, 3): 'p1',
+                                    (1, 4): 'p2'}
+        self.data = {(1, 1): (np.array([[1., 2.], [3., np.nan]]), np.array([1, 2])),
+                     (1, 2): (np.array([]), np.array([])),
+                     (1, 3): (np.array([[5., 6.], [7., 8.], [9., 10.]]), np.array([1, 2, 3])),
+                     (1, 4): (np.array([[11., 12.]]), np.array(1))}
+        for imKey, (features, cellids) in self.data.items():
+            filename = self.c._image_filename(self.c._plate_map[imKey], imKey)
+            if not os.path.exists(os.path.dirname(filename)):
+                os.mkdir(os.path.dirname(filename))
+            np.savez(filename, features=features, cellids=cellids)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    @patch('cpa.profiling.cache.make_progress_bar')
+    def test_load_matches_per_image_files(self, make_progress_bar):
+        make_progress_bar.return_value = lambda x: x
+        image_keys = [(1, 3), (1, 4), (1, 1), (1, 2)]
+        expected = self.c.load(image_keys)
+        self.c._create_cache_consolidated()
+        assert self.c._has_consolidated('p1')
+        assert self.c._has_consolidated('p2')
+        features, colnames, cellids = self.c.load(image_keys)
+        self.assertTrue(np.array_equal(features, expected[0]))
+        self.assertEqual(colnames, ['a', 'b'])
+        self.assertTrue(np.array_equal(cellids, expected[2]))
+
+    def test_load_consolidated_merges_adjacent_images(self):
+        self.c._create_cache_consolidated_plate('p1', [(1, 1), (1, 2), (1, 3)])
+        index = self.c._consolidated('p1')[2]
+        self.assertEqual(index, {(1, 1): (0, 2), (1, 2): (2, 2), (1, 3): (2, 5)})
+        features, cellids = self.c._load_consolidated('p1', [(1, 2), (1, 3), (1, 1)])
+        self.assertEqual(features.dtype, float)
+        self.assertTrue(np.array_equal(cellids, [1, 2, 3, 1, 2]))
+        self.assertTrue(np.array_equal(features[:3], [[5, 6], [7, 8], [9, 10]]))
+
+    def test_load_reads_images_missing_from_consolidated(self):
+        self.c._create_cache_consolidated_plate('p1', [(1, 1), (1, 2)])
+        features, colnames, cellids = self.c.load([(1, 3), (1, 1)])
+        self.assertTrue(np.array_equal(features, [[5, 6], [7, 8], [9, 10], [1, 2]]))
+        self.assertTrue(np.array_equal(cellids, [1, 2, 3, 1]))
+
+    @patch('cpa.dbconnect.GetWhereClauseForImages')
+    @patch('cpa.db')
+    def test_create_image_removes_consolidated(self, db, where_clause):
+        self.c._create_cache_consolidated_plate('p1', [(1, 1), (1, 2), (1, 3)])
+        self.c._consolidated('p1')
+        db.execute_as_array.side_effect = [np.array([[13., 14.]]), np.array([[4]])]
+        self.c._create_cache_image('p1', (1, 3))
+        self.assertFalse(self.c._has_consolidated('p1'))
+        for filename in self.c._consolidated_filenames('p1'):
+            self.assertFalse(os.path.exists(filename))
+        self.assertFalse(self.c._consolidated_filenames('p1')[2] in cache._consolidated_stores)
+        features, colnames, cellids = self.c.load([(1, 3)])
+        self.assertTrue(np.array_equal(features, [[13, 14]]))
+        self.assertTrue(np.array_equal(cellids, 4))
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import shutil
+import unittest
+import numpy as np
+from mock import patch
+from cpa.profiling import normalization
+
+
+class LoadParamsTestCase(unittest.TestCase):
+    def setUp(self):
+        normalization.clear_params_cache()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        normalization.clear_params_cache()
+        shutil.rmtree(self.dir)
+
+    def save(self, name, a, mtime=None):
+        filename = os.path.join(self.dir, name)
+        np.save(filename, a)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_cached(self):
+        filename = self.save('p1.npy', np.arange(6.).reshape(2, 3))
+        first = normalization.load_params(filename)
+        with patch.object(normalization, 'np_load') as np_load:
+            second = normalization.load_params(filename)
+            self.assertFalse(np_load.called)
+        self.assertTrue(first is second)
+        self.assertFalse(first.flags.writeable)
+
+    def test_invalidated_by_mtime(self):
+        filename = self.save('p1.npy', np.zeros((2, 3)), mtime=1000)
+        normalization.load_params(filename)
+        self.save('p1.npy', np.ones((2, 3)), mtime=2000)
+        self.assertTrue(np.all(normalization.load_params(filename) == 1))
+
+    def test_memory_bound(self):
+        a = self.save('a.npy', np.zeros(100))
+        b = self.save('b.npy', np.zeros(100))
+        with patch.object(normalization, 'PARAMS_CACHE_BYTES', 1000):
+            normalization.load_params(a)
+            normalization.load_params(b)
+        self.assertEqual(normalization._params_cache.keys(), [b])
+        self.assertEqual(normalization._params_cache_nbytes[0], 800)
+
+    def test_normalize_uses_cache(self):
+        c = type('FakeCache', (object,), {'cache_dir': self.dir})()
+        n = normalization.StdNormalization(c)
+        os.makedirs(os.path.join(n.dir, 'params'))
+        np.save(n._colmask_filename, np.array([True, False]))
+        np.save(n._params_filename('p1'), np.array([[1., 0.], [2., 1.]]))
+        normalization.preload_params(self.dir, 'StdNormalization')
+        self.assertEqual(len(normalization._params_cache), 2)
+        with patch.object(normalization, 'np_load') as np_load:
+            data = normalization.StdNormalization(c).normalize('p1', np.array([[3., 5.]]))
+            self.assertFalse(np_load.called)
+        self.assertTrue(np.array_equal(data, [[1.]]))
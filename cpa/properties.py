@@ -29,6 +29,9 @@ string_vars = ['db_type',
                'db_name', 
                'db_user', 
                'db_passwd',
+               'db_connection_pool_size',
+               'db_query_cache_size',
+               'db_slow_query_time',
                'image_table', 
                'object_table',
                'image_csv_file', 
@@ -43,7 +46,12 @@ string_vars = ['db_type',
                'image_url_prepend',
                'image_tile_size', 
                'image_buffer_size',
+               'image_cache_size',
+               'image_cache_spill_dir',
+               'image_cache_spill_size',
                'tile_buffer_size',
+               'tile_loader_threads',
+               'scoring_processes',
                'area_scoring_column',
                'training_set',
                'class_table',
@@ -51,6 +59,7 @@ string_vars = ['db_type',
                'check_tables',
                'db_sql_file',
                'db_sqlite_file',
+               'db_sqlite_incremental',
                'use_larger_image_scale', 
                'rescale_object_coords',
                'well_format',
@@ -83,6 +92,9 @@ optional_vars = ['db_port',
                  'db_name', 
                  'db_user', 
                  'db_passwd',
+                 'db_connection_pool_size',
+                 'db_query_cache_size',
+                 'db_slow_query_time',
                  'table_id', 
                  'image_url_prepend', 
                  'image_csv_file',
@@ -95,7 +107,12 @@ optional_vars = ['db_port',
                  'training_set',
                  'class_table',
                  'image_buffer_size', 
+                 'image_cache_size',
+                 'image_cache_spill_dir',
+                 'image_cache_spill_size',
                  'tile_buffer_size',
+                 'tile_loader_threads',
+                 'scoring_processes',
                  'plate_id', 
                  'well_id', 
                  'plate_type',
@@ -104,6 +121,7 @@ optional_vars = ['db_port',
                  'check_tables',
                  'db_sql_file',
                  'db_sqlite_file',
+                 'db_sqlite_incremental',
                  'object_table', 
                  'object_id',
                  'cell_x_loc', 
@@ -590,6 +608,10 @@ class Properties(Singleton):
             logging.info('PROPERTIES: Using default tile_buffer_size=1')
             self.tile_buffer_size = '1'
             
+        if not self.field_defined('tile_loader_threads'):
+            logging.info('PROPERTIES: Using default tile_loader_threads=4')
+            self.tile_loader_threads = '4'
+            
         if not self.field_defined('object_name'):
             logging.warn('PROPERTIES WARNING (object_name): No object name specified, will use default: "object_name=cell,cells"')
             self.object_name = ['cell', 'cells']
@@ -667,6 +689,16 @@ class Properties(Singleton):
             logging.warn('PROPERTIES WARNING (use_larger_image_scale): Field value "%s" is invalid. Replacing with "false".'%(self.use_larger_image_scale))
             self.use_larger_image_scale = False
             
+        if self.db_sqlite_incremental in [True, False]:
+            pass
+        elif not self.field_defined('db_sqlite_incremental') or self.db_sqlite_incremental.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.db_sqlite_incremental = False
+        elif self.field_defined('db_sqlite_incremental') and self.db_sqlite_incremental.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.db_sqlite_incremental = True
+        else:
+            logging.warn('PROPERTIES WARNING (db_sqlite_incremental): Field value "%s" is invalid. Replacing with "false".'%(self.db_sqlite_incremental))
+            self.db_sqlite_incremental = False
+            
         if self.rescale_object_coords in [True, False]:
             pass
         elif not self.field_defined('rescale_object_coords') or self.rescale_object_coords.lower() in ['false', 'no', 'off', 'f', 'n']:
@@ -0,0 +1,135 @@
+'''
+A thread-safe, byte-bounded LRU cache of query results, used by
+DBConnect.execute. Results are keyed by the normalized SQL text (plus any
+query arguments) and a data version, so that a change to the database
+made outside CPA makes the old entries unreachable. Writes made through
+CPA invalidate the entries that mention the written table.
+'''
+
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+# Statements whose results may be cached
+_READ_RE = re.compile(r'^\s*(select|show|describe|pragma\s+table_info)\b', re.I)
+# Results that differ from call to call or connection to connection
+_VOLATILE_RE = re.compile(r'\b(rand|random|last_insert_id|last_insert_rowid|now|'
+                          r'current_time|current_date|current_timestamp|'
+                          r'found_rows|connection_id)\b|\btemp\.', re.I)
+# Statements that change the rows of a table, and the table they change
+_WRITE_RE = re.compile(r'^\s*(?:insert(?:\s+or\s+\w+)?(?:\s+ignore)?\s+into|replace\s+into|'
+                       r'update(?:\s+or\s+\w+)?|delete\s+from|truncate(?:\s+table)?)'
+                       r'\s+[`"\[]?([\w.]+)', re.I)
+# Statements that change the database
+_MODIFYING_RE = re.compile(r'^\s*(insert|replace|update|delete|create|drop|alter|'
+                           r'truncate|load|rename|attach|detach|vacuum)\b', re.I)
+
+
+def normalize_sql(query):
+    '''Collapses whitespace and strips trailing semicolons.'''
+    return ' '.join(query.split()).rstrip(';').rstrip()
+
+
+def is_cacheable(query):
+    '''Returns whether the results of a query may be cached.'''
+    return bool(_READ_RE.match(query)) and not _VOLATILE_RE.search(query)
+
+
+def written_table(query):
+    '''
+    Returns None if the query does not modify the database, the name of the
+    table if it only changes the rows of one table, and '' if it modifies
+    the database in some other way (eg: changes the schema).
+    '''
+    if not _MODIFYING_RE.match(query):
+        return None
+    m = _WRITE_RE.match(query)
+    if m is None:
+        return ''
+    return m.group(1).split('.')[-1]
+
+
+def result_nbytes(rows):
+    '''Estimates the memory used by a list of result rows.'''
+    nbytes = sys.getsizeof(rows)
+    for row in rows:
+        nbytes += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+    return nbytes
+
+
+class QueryCache(object):
+    '''
+    max_bytes: upper bound on the estimated total size of the cached
+        results. Results larger than this are not cached, and 0 disables
+        the cache.
+    '''
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._results = OrderedDict()    # key -> (rows, nbytes), oldest first
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, query, args, version):
+        return (normalize_sql(query), repr(args), version)
+
+    def get(self, key):
+        '''Returns a copy of the cached rows for key or None.'''
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._results[key] = entry
+            self.hits += 1
+            return list(entry[0])
+
+    def put(self, key, rows):
+        '''Adds a copy of rows to the cache, evicting the least recently
+        used results until the cache fits in max_bytes.'''
+        nbytes = result_nbytes(rows)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._results.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._results[key] = (tuple(rows), nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                k, (r, n) = self._results.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+
+    def invalidate(self, table=None):
+        '''Drops the results of queries that mention the given table, or
+        all results if no table is given.'''
+        with self._lock:
+            if not table:
+                self.invalidations += len(self._results)
+                self._results.clear()
+                self.nbytes = 0
+                return
+            word = re.compile(r'\b%s\b'%re.escape(table), re.I)
+            for key in [k for k in self._results if word.search(k[0])]:
+                self.nbytes -= self._results.pop(key)[1]
+                self.invalidations += 1
+
+    def stats(self):
+        '''Returns a dict of the cache counters and sizes.'''
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        invalidations=self.invalidations,
+                        results=len(self._results), nbytes=self.nbytes)
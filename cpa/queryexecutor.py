@@ -0,0 +1,293 @@
+'''
+Runs queries for the GUI on worker threads, each with its own database
+connection from the DBConnect pool, so that long queries don't block the
+main thread and can be cancelled.
+
+    executor = QueryExecutor.getInstance()
+    executor.submit('SELECT ...', key=self, window=self)
+    self.Bind(EVT_QUERY_RESULT, self.on_query_result)
+
+Results are delivered on the main thread, either as a QueryResultEvent
+posted to a window or by calling a callback with the job. Tools that redraw
+themselves with the results of a query use redraw:
+
+    executor.redraw(self, 'SELECT ...', self.show_points)
+
+Submitting a job with the same key as an earlier one that hasn't finished
+cancels the earlier one, so that a tool that is updated repeatedly only
+waits for its latest query. A running query is interrupted with KILL QUERY on MySQL, and
+through a progress handler on SQLite.
+'''
+
+import logging
+import threading
+import Queue
+from dbconnect import DBConnect
+from properties import Properties
+from singleton import Singleton
+
+p = Properties.getInstance()
+
+try:
+    import wx
+    import wx.lib.newevent
+    QueryResultEvent, EVT_QUERY_RESULT = wx.lib.newevent.NewEvent()
+except ImportError:
+    wx = None
+    QueryResultEvent = EVT_QUERY_RESULT = None
+
+# Job states
+PENDING, RUNNING, FINISHED, FAILED, CANCELLED = 'pending', 'running', 'finished', 'failed', 'cancelled'
+
+# Number of SQLite virtual machine instructions between checks for
+# cancellation
+SQLITE_PROGRESS_STEPS = 10000
+
+# Number of queries that may run at once
+NWORKERS = 2
+
+
+class QueryJob(object):
+    '''
+    A query (or function making queries) submitted to a QueryExecutor.
+    When it is delivered, state is FINISHED with the result in result,
+    or FAILED with the exception in error. Cancelled jobs are not
+    delivered.
+    '''
+    def __init__(self, work, key=None, callback=None, window=None):
+        self.work = work
+        self.key = key
+        self.callback = callback
+        self.window = window
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        # How to interrupt the job while it runs, set by the worker
+        self._interrupt = None
+        # Thread sending KILL QUERY for the job on MySQL
+        self._killer = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    def cancel(self):
+        '''Cancels the job if it hasn't finished. Safe to call from any
+        thread.'''
+        with self._lock:
+            if self.state not in (PENDING, RUNNING):
+                return
+            running = self.state == RUNNING
+            self.state = CANCELLED
+            if running and self._interrupt is not None:
+                try:
+                    self._interrupt()
+                except Exception, e:
+                    logging.debug('Could not interrupt query: %s'%(e))
+        if not running:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        '''Blocks until the job has finished, failed or been cancelled.
+        Returns whether it has.'''
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class QueryExecutor(Singleton):
+    '''
+    Runs submitted queries on NWORKERS threads. Results are handed to
+    the main thread with the deliver attribute, a function(fn, *args) that
+    calls fn on the main thread, by default wx.CallAfter.
+    '''
+    def __init__(self):
+        self.db = DBConnect.getInstance()
+        self.deliver = wx and wx.CallAfter
+        self._queue = Queue.Queue()
+        self._latest = {}    # key -> last job submitted with that key
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(NWORKERS):
+            t = threading.Thread(target=self._work, name='QueryExecutor-%d'%(i))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, work, key=None, callback=None, window=None):
+        '''
+        Queues a query and returns its QueryJob.
+        work -- an SQL string, run with DBConnect.execute, or a function
+                that takes no arguments and makes its queries through
+                DBConnect, eg: lambda: db.histogram(...)
+        key -- if given, an earlier job with the same key is cancelled
+        callback -- called with the job on the main thread when it has
+                    finished or failed
+        window -- a QueryResultEvent with the job as its "job" attribute is
+                  posted to this window when it has finished or failed
+        '''
+        job = QueryJob(work, key, callback, window)
+        if key is not None:
+            with self._lock:
+                previous = self._latest.get(key)
+                self._latest[key] = job
+            if previous is not None:
+                previous.cancel()
+        self._queue.put(job)
+        return job
+
+    def redraw(self, window, work, show, wait=False):
+        '''
+        Calls show with the result of work (see submit) on the main thread,
+        unless the window has been closed or redraw has been called again
+        for it in the meantime. Errors are logged.
+        wait -- run work now, in the calling thread. A job submitted earlier
+                for the window is cancelled so that it can't overwrite what
+                is shown.
+        Returns the QueryJob, or None if wait is true.
+        '''
+        if wait:
+            self.cancel(window)
+            if isinstance(work, basestring):
+                show(self.db.execute(work))
+            else:
+                show(work())
+            return None
+        def deliver(job):
+            if not window:
+                # wx windows are false once they have been destroyed
+                return
+            if job.error is not None:
+                logging.error('Could not update %s: %s'%(window.__class__.__name__, job.error))
+                return
+            show(job.result)
+        return self.submit(work, key=window, callback=deliver)
+
+    def cancel(self, key):
+        '''Cancels the latest job submitted with the given key.'''
+        with self._lock:
+            job = self._latest.pop(key, None)
+        if job is not None:
+            job.cancel()
+
+    def shutdown(self):
+        '''Cancels all jobs and stops the workers.'''
+        with self._lock:
+            jobs = self._latest.values()
+            self._latest = {}
+        for job in jobs:
+            job.cancel()
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self._run(job)
+            except Exception, e:
+                # eg: no connection could be made
+                logging.error('Background query failed: %s'%(e))
+                with job._lock:
+                    job.state = FAILED
+                    job.error = e
+                self._deliver(job)
+                job._done.set()
+            finally:
+                if threading.currentThread().getName() in self.db.connections:
+                    self.db.CloseConnection()
+
+    def _run(self, job):
+        if job.state != PENDING:
+            # cancelled while it was queued
+            return
+        if threading.currentThread().getName() not in self.db.connections:
+            self.db.connect()
+        conn = self.db.connections[threading.currentThread().getName()]
+        with job._lock:
+            if job.state != PENDING:
+                return
+            job.state = RUNNING
+            job._interrupt = self._interrupter(job, conn)
+        try:
+            if isinstance(job.work, basestring):
+                result = self.db.execute(job.work)
+            else:
+                result = job.work()
+        except Exception, e:
+            with job._lock:
+                if job.state == CANCELLED:
+                    logging.debug('Cancelled query: %s'%(job.work))
+                else:
+                    job.state = FAILED
+                    job.error = e
+                    logging.error('Background query failed: %s'%(e))
+        else:
+            with job._lock:
+                if job.state != CANCELLED:
+                    job.state = FINISHED
+                    job.result = result
+        finally:
+            with job._lock:
+                job._interrupt = None
+                killer = job._killer
+            if killer is not None:
+                # KILL QUERY interrupts whatever the connection is running,
+                # so it must be done before the next job gets the connection
+                killer.join()
+            if p.db_type.lower() == 'sqlite':
+                conn.set_progress_handler(None, 0)
+        if job.state in (FINISHED, FAILED):
+            self._deliver(job)
+        job._done.set()
+
+    def _interrupter(self, job, conn):
+        '''Prepares the connection so the job can be interrupted, and
+        returns a function that interrupts it.'''
+        if p.db_type.lower() == 'sqlite':
+            # The handler is called during long statements, which fail with
+            # "interrupted" if it returns true.
+            conn.set_progress_handler(lambda: job.state == CANCELLED, SQLITE_PROGRESS_STEPS)
+            return lambda: None
+        thread_id = conn.thread_id()
+        def send_kill():
+            # KILL has to be sent on a different connection
+            try:
+                other = self.db.checkout_connection()
+                try:
+                    cursor = other.cursor()
+                    cursor.execute('KILL QUERY %d'%(thread_id))
+                    cursor.close()
+                finally:
+                    self.db.checkin_connection(other)
+            except Exception, e:
+                logging.debug('Could not interrupt query: %s'%(e))
+        def kill():
+            # Jobs are usually cancelled from the main thread, which must not
+            # wait for a free connection or for the server.
+            job._killer = threading.Thread(target=send_kill, name='QueryExecutor-kill')
+            job._killer.daemon = True
+            job._killer.start()
+        return kill
+
+    def _deliver(self, job):
+        def deliver():
+            # The job may have been superseded while waiting to be delivered
+            with self._lock:
+                if job.key is not None:
+                    if self._latest.get(job.key) is not job:
+                        return
+                    del self._latest[job.key]
+            if job.cancelled:
+                return
+            if job.window is not None:
+                wx.PostEvent(job.window, QueryResultEvent(job=job))
+            if job.callback is not None:
+                job.callback(job)
+        self.deliver(deliver)
@@ -0,0 +1,121 @@
+'''
+Timings of the queries made through DBConnect, aggregated by the code that
+made them, and a log of slow queries with their query plans. See
+DBConnect.query_stats.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+# Rows looked at to estimate the size of a result
+SAMPLE_ROWS = 100
+
+
+def estimate_nbytes(rows):
+    '''Estimates the memory used by a list of result rows from a sample.'''
+    if len(rows) == 0:
+        return 0
+    step = max(len(rows) // SAMPLE_ROWS, 1)
+    sample = rows[::step]
+    nbytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in sample)
+    return int(nbytes * len(rows) / float(len(sample)))
+
+
+def find_caller(skip_files):
+    '''Returns "file:function" of the innermost caller on the stack whose
+    code is not in one of the given files.'''
+    f = sys._getframe(1)
+    while f is not None and f.f_code.co_filename in skip_files:
+        f = f.f_back
+    if f is None:
+        return '?'
+    return '%s:%s'%(os.path.basename(f.f_code.co_filename), f.f_code.co_name)
+
+
+class CallerStats(object):
+    '''Totals of the queries made by one caller.'''
+    def __init__(self):
+        self.queries = 0
+        self.cache_hits = 0
+        self.wall_time = 0.0
+        self.fetch_time = 0.0
+        self.max_wall_time = 0.0
+        self.slowest_query = None
+        self.rows = 0
+        self.nbytes = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class QueryStats(object):
+    '''
+    slow_query_time: queries that take at least this many seconds are
+        logged and kept with their query plan, or None to not log them.
+    max_slow_queries: the number of slow queries kept.
+    '''
+    def __init__(self, slow_query_time=None, max_slow_queries=100):
+        self.slow_query_time = slow_query_time
+        self.callers = {}    # caller -> CallerStats
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def is_slow(self, wall_time):
+        return self.slow_query_time is not None and wall_time >= self.slow_query_time
+
+    def record(self, caller, query, wall_time, fetch_time=0.0, rows=0, nbytes=0,
+               cache_hit=False):
+        '''Adds one query to the totals of its caller.'''
+        with self._lock:
+            stats = self.callers.get(caller)
+            if stats is None:
+                stats = self.callers[caller] = CallerStats()
+            stats.queries += 1
+            stats.cache_hits += cache_hit
+            stats.wall_time += wall_time
+            stats.fetch_time += fetch_time
+            stats.rows += rows
+            stats.nbytes += nbytes
+            if wall_time > stats.max_wall_time:
+                stats.max_wall_time = wall_time
+                stats.slowest_query = query
+
+    def record_slow(self, caller, query, wall_time, rows, plan):
+        '''Logs a slow query with its query plan (a list of rows).'''
+        entry = dict(time=time.time(), caller=caller, query=query,
+                     wall_time=wall_time, rows=rows, plan=plan)
+        with self._lock:
+            self.slow_queries.append(entry)
+        logging.warn('Slow query (%.3fs, %d rows) from %s:\n%s\nQuery plan:\n%s'
+                     %(wall_time, rows, caller, query,
+                       '\n'.join(['  ' + ' | '.join([str(v) for v in row]) for row in plan or []])))
+
+    def summary(self):
+        '''Returns a list of (caller, CallerStats) with the callers that
+        spent the most time in queries first.'''
+        with self._lock:
+            return sorted(self.callers.items(), key=lambda (c, s): -s.wall_time)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(started=self.started, now=time.time(),
+                        slow_query_time=self.slow_query_time,
+                        callers=dict((c, s.as_dict()) for c, s in self.callers.items()),
+                        slow_queries=list(self.slow_queries))
+
+    def dump(self, filename):
+        '''Writes the statistics to a JSON file.'''
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, default=str)
+
+    def reset(self):
+        with self._lock:
+            self.callers = {}
+            self.slow_queries.clear()
+            self.started = time.time()
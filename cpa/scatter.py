@@ -1,10 +1,11 @@
 # TODO: add hooks to change point size, alpha, numsides etc.
 from cpatool import CPATool
 import tableviewer
-from dbconnect import DBConnect, UniqueImageClause, UniqueObjectClause, GetWhereClauseForImages, GetWhereClauseForObjects, image_key_columns, object_key_columns
+from dbconnect import DBConnect, UniqueImageClause, UniqueObjectClause, GetWhereClauseForImages, GetWhereClauseForObjects, image_key_columns, object_key_columns, rows_to_float_array
 import sqltools as sql
 import multiclasssql
 from properties import Properties
+from queryexecutor import QueryExecutor
 from wx.combo import OwnerDrawnComboBox as ComboBox
 import guiutils as ui
 from gating import GatingHelper
@@ -242,22 +243,30 @@ class ScatterControlPanel(wx.Panel):
                 or (self.y_column.table != p.image_table and db.adjacent(p.object_table, self.y_column.table))
                 )
         
-    def update_figpanel(self, evt=None):
+    def update_figpanel(self, evt=None, wait=False):
+        '''Replots the points once their query has run in the background,
+        or right away if wait is true.'''
         self.gate_choice.set_gatable_columns([self.x_column, self.y_column])
-        keys_and_points = self._load_points()
         col_types = self.get_selected_column_types()
-                
-        # Convert keys and points into a np array
-        # NOTE: We must set dtype "object" on creation or values like 0.34567e-9
-        #       may be truncated to 0.34567e (error) or 0.345 (no error) when
-        #       the array contains strings.
-        kps = np.array(keys_and_points, dtype='object')
+        QueryExecutor.getInstance().redraw(
+            self, str(self._points_query()),
+            lambda keys_and_points: self._show_points(keys_and_points, col_types), wait)
+
+    def _show_points(self, keys_and_points, col_types):
         # Strip out keys
         if self._plotting_per_object_data():
             key_indices = list(xrange(len(object_key_columns())))
         else:
             key_indices = list(xrange(len(image_key_columns())))
-        print len(kps)
+        if col_types[0] in [float, int, long] and col_types[1] in [float, int, long]:
+            # All numeric: convert straight to a float array
+            kps = rows_to_float_array(keys_and_points, len(key_indices) + 2)
+        else:
+            # Convert keys and points into a np array
+            # NOTE: We must set dtype "object" on creation or values like 0.34567e-9
+            #       may be truncated to 0.34567e (error) or 0.345 (no error) when
+            #       the array contains strings.
+            kps = np.array(keys_and_points, dtype='object')
         keys = kps[:,key_indices].astype(int) 
         # Strip out x coords
         if col_types[0] in [float, int, long]:
@@ -281,7 +290,7 @@ class ScatterControlPanel(wx.Panel):
         self.figpanel.redraw()
         self.figpanel.draw()
         
-    def _load_points(self):
+    def _points_query(self):
         q = sql.QueryBuilder()
         select = []
         #
@@ -299,8 +308,7 @@ class ScatterControlPanel(wx.Panel):
             q.add_filter(self.filter)
         q.add_where(sql.Expression(self.x_column, 'IS NOT NULL'))
         q.add_where(sql.Expression(self.y_column, 'IS NOT NULL'))
-        print "x_column:", self.x_column
-        return db.execute(str(q))
+        return q
     
     def get_selected_column_types(self):
         ''' Returns a tuple containing the x and y column types. '''
@@ -353,7 +361,7 @@ class ScatterControlPanel(wx.Panel):
             self.y_scale_choice.SetStringSelection(settings['y-scale'])
         if 'filter' in settings:
             self.filter_choice.SetStringSelection(settings['filter'])
-        self.update_figpanel()
+        self.update_figpanel(wait=True)
         if 'x-lim' in settings:
             self.figpanel.subplot.set_xlim(eval(settings['x-lim']))
         if 'y-lim' in settings:
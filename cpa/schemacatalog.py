@@ -0,0 +1,140 @@
+'''
+The column names and types of the tables in the database, and summary
+statistics of their columns, looked up once and kept by DBConnect (see
+DBConnect.schema) until CPA changes the database.
+'''
+
+import logging
+import threading
+from properties import Properties
+
+p = Properties.getInstance()
+
+# Most columns summarized by one query. Each column takes 5 result columns,
+# and SQLite allows 2000 by default.
+STATS_COLUMNS_PER_QUERY = 250
+
+
+class ColumnStats(object):
+    '''Summary of the non-NULL values of a column.'''
+    def __init__(self, min, max, nulls, mean, variance):
+        self.min = min
+        self.max = max
+        self.nulls = nulls
+        self.mean = mean
+        self.variance = variance
+
+    def is_constant(self):
+        '''Whether all non-NULL values are the same.'''
+        return self.min is not None and self.min == self.max
+
+    def __repr__(self):
+        return ('ColumnStats(min=%r, max=%r, nulls=%r, mean=%r, variance=%r)'
+                %(self.min, self.max, self.nulls, self.mean, self.variance))
+
+
+class SchemaCatalog(object):
+    '''
+    db: the DBConnect used to run the queries. The catalog of all tables
+        (and views) is loaded with one query the first time it is needed.
+        Tables it does not list, eg: temporary tables, are looked up
+        individually.
+    '''
+    def __init__(self, db):
+        self.db = db
+        self._columns = None    # table -> [(name, type string), ...]
+        self._stats = {}        # table -> {column: ColumnStats}
+        self._lock = threading.RLock()
+
+    def _key(self, table):
+        if p.db_type.lower() == 'sqlite':
+            # SQLite table names are case insensitive
+            return table.lower()
+        return table
+
+    def _load(self):
+        columns = {}
+        if p.db_type.lower() == 'sqlite':
+            try:
+                rows = self.db.execute(
+                    "SELECT m.name, c.name, c.type FROM sqlite_master m, "
+                    "pragma_table_info(m.name) c WHERE m.type IN ('table', 'view') "
+                    "ORDER BY m.name, c.cid", silent=True, cache=False)
+            except Exception:
+                # pragma_table_info is only available since SQLite 3.16
+                rows = []
+                for (table,) in self.db.execute("SELECT name FROM sqlite_master WHERE "
+                                                "type IN ('table', 'view')", cache=False):
+                    rows += [(table, r[1], r[2]) for r in
+                             self.db.execute('PRAGMA table_info(%s)'%(table), cache=False)]
+        else:
+            rows = self.db.execute(
+                'SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE FROM INFORMATION_SCHEMA.COLUMNS '
+                'WHERE TABLE_SCHEMA=DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION',
+                silent=True, cache=False)
+        for table, name, type in rows:
+            columns.setdefault(self._key(table), []).append((name, type))
+        logging.debug('Loaded the columns of %d tables'%(len(columns)))
+        return columns
+
+    def _lookup(self, table):
+        # The table may not be listed (eg: it is temporary), so ask for it
+        self.db.execute('SELECT * FROM %s LIMIT 1'%(table), cache=False)
+        names = self.db.GetResultColumnNames()
+        if p.db_type.lower() == 'sqlite':
+            types = [r[2] for r in self.db.execute('PRAGMA table_info(%s)'%(table), cache=False)]
+        else:
+            types = [r[1] for r in self.db.execute('SHOW COLUMNS FROM %s'%(table), cache=False)]
+        return zip(names, types)
+
+    def columns(self, table):
+        '''Returns a list of (column name, SQL type string) for a table.'''
+        with self._lock:
+            if self._columns is None:
+                self._columns = self._load()
+            key = self._key(table)
+            if key not in self._columns:
+                self._columns[key] = self._lookup(table)
+            return list(self._columns[key])
+
+    def column_names(self, table):
+        return [name for name, type in self.columns(table)]
+
+    def column_types(self, table):
+        return [type for name, type in self.columns(table)]
+
+    def column_stats(self, table, columns):
+        '''
+        Returns a dict mapping each of the given numeric columns to its
+        ColumnStats. Columns that have not been summarized before are
+        summarized together, in as few scans of the table as possible.
+        '''
+        with self._lock:
+            stats = self._stats.setdefault(self._key(table), {})
+            missing = [col for col in columns if col not in stats]
+            for i in range(0, len(missing), STATS_COLUMNS_PER_QUERY):
+                chunk = missing[i:i + STATS_COLUMNS_PER_QUERY]
+                exprs = ['MIN(%s), MAX(%s), COUNT(*)-COUNT(%s), AVG(%s), AVG(%s*%s)'
+                         %(col, col, col, col, col, col) for col in chunk]
+                res = self.db.execute('SELECT %s FROM %s'%(', '.join(exprs), table),
+                                      cache=False)[0]
+                for j, col in enumerate(chunk):
+                    lo, hi, nulls, mean, mean_sq = res[5*j : 5*j+5]
+                    variance = None
+                    if mean is not None:
+                        # population variance, clipped at 0 for rounding errors
+                        variance = 0.0 if lo == hi else max(float(mean_sq) - float(mean) ** 2, 0.0)
+                    stats[col] = ColumnStats(lo, hi, nulls, mean, variance)
+            return dict((col, stats[col]) for col in columns)
+
+    def invalidate(self, table=None):
+        '''
+        Forgets the column statistics of the given table, or everything if
+        no table is given.
+        '''
+        with self._lock:
+            if table:
+                self._stats.pop(self._key(table), None)
+            else:
+                self._columns = None
+                self._stats = {}
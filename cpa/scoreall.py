@@ -115,6 +115,11 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     # CONSTRUCT ARRAY OF TABLE DATA
     logging.info('Computing enrichment scores for each group...')
     t0 = time()
+    if p.area_scoring_column is not None:
+        scoredCounts = groupedKeysAndCounts[:, -nClasses:]
+    else:
+        scoredCounts = groupedKeysAndCounts[:, nKeyCols:nKeyCols+nClasses]
+    allScores = dirichletintegrate.score_all(alpha, np.array(scoredCounts.tolist(), dtype=int))
     tableData = []
     for i, row in enumerate(groupedKeysAndCounts):
         # Start this row with the group key: 
@@ -134,7 +139,7 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
             
         # Append the scores:
         #   compute enrichment probabilities of each class for this image OR group
-        scores = np.array( dirichletintegrate.score(alpha, np.array(countsRow)) )
+        scores = allScores[i].copy()
         #   clamp to [0,1] to 
         scores[scores>1.] = 1.
         scores[scores<0.] = 0.
@@ -4,6 +4,7 @@ from imagetile import ImageTile
 from imagetilesizer import ImageTileSizer
 from imagecontrolpanel import ImageControlPanel
 from properties import Properties
+import imagepanel
 import imagetools
 import cPickle
 import wx
@@ -49,14 +50,18 @@ class CellMontageFrame(wx.Frame):
     # required by ImageControlPanel
     #
     def SetBrightness(self, brightness):
-        [t.SetBrightness(brightness) for t in self.sb.tiles]
+        for t in self.sb.tiles:
+            t.brightness = brightness
+        imagepanel.UpdateBitmaps(self.sb.tiles)
 
     def SetScale(self, scale):
         [t.SetScale(scale) for t in self.sb.tiles]
         self.sb.UpdateSizer()
 
     def SetContrastMode(self, mode):
-        [t.SetContrastMode(mode) for t in self.sb.tiles]
+        for t in self.sb.tiles:
+            t.contrast = mode
+        imagepanel.UpdateBitmaps(self.sb.tiles)
 
 class SortBinDropTarget(wx.DropTarget):
     def __init__(self, bin):
@@ -0,0 +1,160 @@
+'''
+Aggregate functions registered with SQLite connections by DBConnect
+(see DBConnect._setup_sqlite_connection):
+
+    median(x)          exact median
+    stddev(x)          population standard deviation
+    percentile(x, q)   approximate q-th percentile, 0 <= q <= 100
+    mad(x)             approximate median absolute deviation
+
+NULLs and NaNs are ignored, and each returns NULL if there are no other
+values. SQLite calls step() once per row, so the values are collected in a
+small NumPy buffer and handed on a block at a time. stddev uses constant
+memory and the approximate aggregates keep a bounded random sample, which
+makes them exact for groups of up to SAMPLE_SIZE values.
+'''
+
+import numpy as np
+
+# Number of values collected before they are handed to consume()
+BLOCK_SIZE = 4096
+# Number of values kept by the approximate aggregates
+SAMPLE_SIZE = 20000
+
+
+class _BufferedAggregate(object):
+    def __init__(self):
+        self._block = np.empty(BLOCK_SIZE, np.float64)
+        self._nblock = 0
+
+    def step(self, value):
+        if value is None:
+            return
+        self._block[self._nblock] = value
+        self._nblock += 1
+        if self._nblock == BLOCK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        values = self._block[:self._nblock]
+        values = values[~np.isnan(values)]
+        self._nblock = 0
+        if len(values) > 0:
+            self.consume(values)
+
+    def finalize(self):
+        self._flush()
+        result = self.result()
+        return None if result is None else float(result)
+
+    def consume(self, values):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class StdDev(_BufferedAggregate):
+    '''Population standard deviation, combining the mean and sum of
+    squared deviations of each block with those so far (Welford/Chan).'''
+    def __init__(self):
+        _BufferedAggregate.__init__(self)
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def consume(self, values):
+        n = len(values)
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.n + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+    def result(self):
+        if self.n == 0:
+            return None
+        return np.sqrt(self.m2 / self.n)
+
+
+class Median(_BufferedAggregate):
+    '''Exact median. The values are kept in a growing float64 array, which
+    takes a fraction of the memory of a list of Python floats.'''
+    def __init__(self):
+        _BufferedAggregate.__init__(self)
+        self.values = np.empty(0, np.float64)
+        self.n = 0
+
+    def consume(self, values):
+        if self.n + len(values) > len(self.values):
+            self.values = np.resize(self.values, max(2 * len(self.values), self.n + len(values)))
+        self.values[self.n:self.n + len(values)] = values
+        self.n += len(values)
+
+    def result(self):
+        if self.n == 0:
+            return None
+        return np.median(self.values[:self.n])
+
+
+class _Sampled(_BufferedAggregate):
+    '''Keeps a uniform random sample of at most SAMPLE_SIZE values
+    (reservoir sampling, applied a block at a time).'''
+    def __init__(self):
+        _BufferedAggregate.__init__(self)
+        self.sample = np.empty(0, np.float64)
+        self.n = 0
+        # Seeded, so that a query gives the same answer every time
+        self.random = np.random.RandomState(0)
+
+    def consume(self, values):
+        room = SAMPLE_SIZE - len(self.sample)
+        if room > 0:
+            self.sample = np.concatenate((self.sample, values[:room]))
+            self.n += len(values[:room])
+            values = values[room:]
+        if len(values) == 0:
+            return
+        # The i-th value overall replaces a random member of the sample
+        # with probability SAMPLE_SIZE / i.
+        seen = self.n + np.arange(1, len(values) + 1)
+        slots = (self.random.random_sample(len(values)) * seen).astype(np.int64)
+        keep = slots < SAMPLE_SIZE
+        self.sample[slots[keep]] = values[keep]
+        self.n += len(values)
+
+
+class Percentile(_Sampled):
+    '''percentile(x, q): the q-th percentile of x, interpolated linearly.
+    q is taken from the first row.'''
+    def __init__(self):
+        _Sampled.__init__(self)
+        self.q = None
+
+    def step(self, value, q):
+        if self.q is None and q is not None:
+            self.q = float(q)
+        _Sampled.step(self, value)
+
+    def result(self):
+        if self.n == 0 or self.q is None:
+            return None
+        return np.percentile(self.sample, self.q)
+
+
+class MAD(_Sampled):
+    '''The median of the absolute deviations from the median.'''
+    def result(self):
+        if self.n == 0:
+            return None
+        return np.median(np.abs(self.sample - np.median(self.sample)))
+
+
+def register(connection):
+    '''Registers the aggregates with an sqlite3 connection.'''
+    connection.create_aggregate('median', 1, Median)
+    connection.create_aggregate('stddev', 1, StdDev)
+    connection.create_aggregate('percentile', 2, Percentile)
+    connection.create_aggregate('mad', 1, MAD)
@@ -0,0 +1,145 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from cpa import csvimport
+
+
+class CSVImportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.text_factory = str
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.dir)
+
+    def write_csv(self, name, lines):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'wb') as f:
+            f.write('\r\n'.join(lines) + '\r\n')
+        return filename
+
+    def test_split_csv(self):
+        filename = self.write_csv('a.csv', ['a,b'] + ['%d,%d' % (i, i * i) for i in range(100)])
+        ranges = csvimport.split_csv(filename, chunk_bytes=50)
+        self.assertTrue(len(ranges) > 1)
+        self.assertEqual(ranges[0][0], len('a,b\r\n'))
+        self.assertEqual(ranges[-1][1], os.path.getsize(filename))
+        rows = sum([csvimport.parse_range((filename, start, stop, ['INT', 'INT']))
+                    for start, stop in ranges], [])
+        self.assertEqual(rows, [(i, i * i) for i in range(100)])
+        # without a header, the first line is data
+        self.assertEqual(csvimport.split_csv(filename, chunk_bytes=50, header=False)[0][0], 0)
+
+    def test_converters(self):
+        self.assertEqual(csvimport.column_converter('INTEGER')('3'), 3)
+        self.assertEqual(csvimport.column_converter('INT')('3.0'), 3)
+        self.assertEqual(csvimport.column_converter('INT')('3.5'), 3.5)
+        self.assertEqual(csvimport.column_converter('FLOAT')('1e3'), 1000.)
+        self.assertEqual(csvimport.column_converter('FLOAT')('nan'), 'nan')
+        self.assertEqual(csvimport.column_converter('FLOAT')(''), '')
+        self.assertEqual(csvimport.column_converter('VARCHAR(10)')('007'), '007')
+
+    def test_infer_column_types(self):
+        filename = self.write_csv('a.csv', ['i,f,s,e'] + ['%d,%d,x%d,' % (i, i, i) for i in range(50)]
+                                  + ['7,0.5,longer string,'])
+        importer = csvimport.CSVImporter(self.connection, processes=1, chunk_bytes=40)
+        self.assertEqual(importer.infer_column_types(filename),
+                         ['INT', 'FLOAT', 'VARCHAR(13)', 'VARCHAR(0)'])
+
+    def test_defer_primary_key(self):
+        statement, table, key = csvimport.defer_primary_key(
+            'CREATE TABLE Per_Object (\nImageNumber INTEGER,\nObjectNumber INTEGER,\n'
+            'x FLOAT,\nPRIMARY KEY (ImageNumber, ObjectNumber)\n);')
+        self.assertEqual(table, 'Per_Object')
+        self.assertEqual(key, ['ImageNumber', 'ObjectNumber'])
+        self.assertFalse('PRIMARY' in statement)
+        self.connection.execute(statement)
+
+    def test_load(self):
+        self.connection.execute('CREATE TABLE t (id INTEGER, x FLOAT, name VARCHAR(10))')
+        files = [self.write_csv('%d.csv' % n, ['id,x,name'] +
+                                ['%d,%s,"n,%d"' % (n * 1000 + i, i / 4.0, i) for i in range(300)])
+                 for n in range(2)]
+        progress = []
+        with csvimport.CSVImporter(self.connection, processes=2, chunk_bytes=500,
+                                   cb=progress.append, bulk=True) as importer:
+            self.assertEqual(importer.load('t', files), 600)
+            self.assertNotEqual(importer.pool, None)
+        self.assertEqual(progress[-1], sum(os.path.getsize(f) - len('id,x,name\r\n') for f in files))
+        rows = self.connection.execute('SELECT id, x, name, typeof(x) FROM t').fetchall()
+        self.assertEqual(len(rows), 600)
+        self.assertEqual(rows[301], (1001, 0.25, 'n,1', 'real'))
+        # the load settings are put back afterwards
+        self.assertNotEqual(self.connection.execute('PRAGMA synchronous').fetchone()[0], 0)
+
+    def test_pool_started_lazily(self):
+        with csvimport.CSVImporter(self.connection, processes=2) as importer:
+            self.assertFalse(importer.has_file_records())
+            self.assertEqual(importer.pool, None)
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.text_factory = str
+        self.connection.execute('CREATE TABLE t (plate INTEGER, x FLOAT)')
+        self.files = [self.write_csv(plate) for plate in range(3)]
+        with csvimport.CSVImporter(self.connection, processes=1, chunk_bytes=30) as importer:
+            importer.load('t', self.files)
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.dir)
+
+    def write_csv(self, plate, nrows=10, value=0.5):
+        filename = os.path.join(self.dir, 'plate%d.csv' % plate)
+        with open(filename, 'wb') as f:
+            f.write('plate,x\n' + ''.join(['%d,%s\n' % (plate, value)] * nrows))
+        return filename
+
+    def sync(self, files, cb=None):
+        with csvimport.CSVImporter(self.connection, processes=1, chunk_bytes=30,
+                                   cb=cb) as importer:
+            return importer.sync('t', files)
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT plate, COUNT(*) FROM t GROUP BY plate'))
+
+    def test_unchanged(self):
+        self.assertEqual(self.sync(self.files), 0)
+        self.assertEqual(self.counts(), {0: 10, 1: 10, 2: 10})
+
+    def test_touched(self):
+        os.utime(self.files[1], (0, 12345))
+        self.assertEqual(self.sync(self.files), 0)
+        # the new modification time is recorded
+        self.assertEqual(self.sync(self.files), 0)
+
+    def test_new_changed_and_removed(self):
+        self.write_csv(1, nrows=4, value=2.5)
+        os.utime(self.files[1], (0, 12345))
+        new_file = self.write_csv(3, nrows=5)
+        self.assertEqual(self.sync([self.files[1], self.files[2], new_file]), 3)
+        self.assertEqual(self.counts(), {1: 4, 2: 10, 3: 5})
+        self.assertEqual(self.connection.execute('SELECT DISTINCT x FROM t WHERE plate=1').fetchall(),
+                         [(2.5,)])
+        self.assertEqual(self.sync([self.files[1], self.files[2], new_file]), 0)
+
+    def test_aborted_sync(self):
+        new_file = self.write_csv(3, nrows=40)
+        def cancel(bytes_done):
+            raise Exception('cancelled load')
+        self.assertRaises(Exception, self.sync, self.files + [new_file], cancel)
+        # none of the new rows are kept, and the file is loaded once later
+        self.assertEqual(self.counts(), {0: 10, 1: 10, 2: 10})
+        self.assertEqual(self.sync(self.files + [new_file]), 1)
+        self.assertEqual(self.counts(), {0: 10, 1: 10, 2: 10, 3: 40})
+
+
+if __name__ == "__main__":
+    unittest.main()
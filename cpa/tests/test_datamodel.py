@@ -78,3 +78,46 @@ class GetWellPositionFromName(unittest.TestCase):
 
     def test_reverse_absent(self):
         self.assertRaises(KeyError, lambda: self.dm.get_well_name_from_position((1, 0)))
+
+
+class RandomObjectsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dm = cpa.datamodel.DataModel.getInstance()
+        self.old = (self.dm.data, self.dm.keylist, self.dm.revGroupMaps)
+        self.dm.data = {(1,): 3, (2,): 0, (3,): 1}
+        self.dm.keylist = [(1,), (2,), (3,)]
+        self.dm.revGroupMaps = {'Well': {('A01',): [(1,), (2,)], ('A02',): [(3,)]}}
+
+    def tearDown(self):
+        self.dm.data, self.dm.keylist, self.dm.revGroupMaps = self.old
+
+    def resolve(self, imKeys, indices):
+        return [imKey + (index,) for imKey, index in zip(imKeys, indices)]
+
+    @patch('cpa.datamodel.db')
+    def test_sample(self, db):
+        db.GetObjectIDsAtIndices.side_effect = self.resolve
+        obKeys = self.dm.GetRandomObjects(200)
+        self.assertEqual(len(obKeys), 200)
+        self.assertEqual(db.GetObjectIDsAtIndices.call_count, 1)
+        self.assertTrue(set(obKeys) <= set([(1, 1), (1, 2), (1, 3), (3, 1)]))
+
+    @patch('cpa.datamodel.db')
+    def test_no_objects(self, db):
+        db.GetObjectIDsAtIndices.side_effect = self.resolve
+        self.assertEqual(self.dm.GetRandomObjects(5, [(2,)]), [])
+        self.assertEqual(self.dm.GetRandomObjects(5, []), [])
+
+    @patch('cpa.datamodel.db')
+    def test_stratified(self, db):
+        db.GetObjectIDsAtIndices.side_effect = self.resolve
+        obKeys = self.dm.GetStratifiedRandomObjects(10, 'Well')
+        self.assertEqual(len([k for k in obKeys if k[0] == 3]), 5)
+        self.assertEqual(len([k for k in obKeys if k[0] == 1]), 5)
+
+    @patch('cpa.datamodel.db')
+    def test_stratified_filter(self, db):
+        db.GetObjectIDsAtIndices.side_effect = self.resolve
+        db.GetFilteredImages.return_value = [(3,)]
+        obKeys = self.dm.GetStratifiedRandomObjects(4, 'Well', 'MyFilter')
+        self.assertEqual(obKeys, [(3, 1)] * 4)
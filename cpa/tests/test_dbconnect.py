@@ -1,6 +1,8 @@
 import threading
+import os
 from mock import patch, Mock
 import unittest
+import numpy as np
 import cpa.dbconnect
 
 
@@ -92,3 +94,770 @@ class UpdateWellsTestCase(unittest.TestCase):
 
 
 
+
+
+class RowsToFloatArrayTestCase(unittest.TestCase):
+    def test_numbers(self):
+        res = cpa.dbconnect.rows_to_float_array([(1, 2.5), (3L, None)])
+        self.assertEqual(res.dtype, np.float64)
+        self.assertEqual(res.shape, (2, 2))
+        self.assertTrue(res.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(res, [[1, 2.5], [3, np.nan]])
+
+    def test_strings(self):
+        res = cpa.dbconnect.rows_to_float_array([('1.5', 'abc'), (None, '2')], dtype=np.float32)
+        self.assertEqual(res.dtype, np.float32)
+        np.testing.assert_array_equal(res, [[1.5, np.nan], [np.nan, 2]])
+
+    def test_empty(self):
+        self.assertEqual(cpa.dbconnect.rows_to_float_array([], 3).shape, (0, 3))
+
+
+class GetObjectIDsAtIndicesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.p = cpa.dbconnect.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+
+    def test_contiguous_and_gapped(self):
+        def execute(query):
+            if 'COUNT(*)' in query:
+                # image 1 has objects 1..3, image 2 has objects 2, 5
+                return [(1, 1, 3, 3), (2, 2, 5, 2)]
+            self.assertTrue('ImageNumber IN (2)' in query)
+            return [(2, 2), (2, 5)]
+        with patch.object(self.db, 'execute') as mock_execute:
+            mock_execute.side_effect = execute
+            res = self.db.GetObjectIDsAtIndices([(2,), (1,), (2,), (4,)], [2, 3, 1, 1])
+            self.assertEqual(res, [(2, 5), (1, 3), (2, 2), None])
+            self.assertEqual(mock_execute.call_count, 2)
+
+
+class BulkObjectFetchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.p = cpa.dbconnect.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.cell_x_loc = 'X'
+        self.p.cell_y_loc = 'Y'
+
+    def test_where_clause_by_image(self):
+        clause = cpa.dbconnect.GetWhereClauseForObjectsByImage([(2, 4), (1, 3), (1, 5)])
+        self.assertEqual(clause, '(ImageNumber=1 AND ObjectNumber IN (3,5)) OR '
+                                 '(ImageNumber=2 AND ObjectNumber IN (4))')
+
+    def test_objects_coords(self):
+        with patch.object(self.db, 'execute') as mock_execute:
+            mock_execute.return_value = [(1, 3, 10, 20), (1, 5, 11, 21), (2, 4, 12, 22)]
+            coords = self.db.GetObjectsCoords([(1, 3), (2, 4), (1, 5)])
+            self.assertEqual(mock_execute.call_count, 1)
+        self.assertEqual(coords, {(1, 3): (10, 20), (1, 5): (11, 21), (2, 4): (12, 22)})
+
+    def test_objects_coords_missing(self):
+        with patch.object(self.db, 'execute') as mock_execute:
+            mock_execute.return_value = [(1, 3, 10, None)]
+            self.assertRaises(Exception, self.db.GetObjectsCoords, [(1, 3)])
+
+    def test_cell_data_for_objects_in_chunks(self):
+        def execute(query, silent=False):
+            if 'ImageNumber=1' in query:
+                return [(1, 3, 1, 3, 0.5, None)]
+            return [(2, 4, 2, 4, 1.5, 7)]
+        callback = Mock()
+        with patch.object(self.db, 'execute') as mock_execute:
+            mock_execute.side_effect = execute
+            data = self.db.GetCellDataForObjects([(1, 3), (2, 4)], chunk_size=1, cb=callback)
+            self.assertEqual(mock_execute.call_count, 2)
+            self.assertTrue('Per_Object.*' in mock_execute.call_args[0][0])
+        self.assertEqual(sorted(data.keys()), [(1, 3), (2, 4)])
+        np.testing.assert_array_equal(data[(1, 3)], [1, 3, 0.5, 0])
+        np.testing.assert_array_equal(data[(2, 4)], [2, 4, 1.5, 7])
+        self.assertEqual(callback.call_args_list[-1][0][0], 1.0)
+
+
+class NumpyResultsTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        connID = threading.currentThread().getName()
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.text_factory = str
+        self.db.connections[connID] = self.connection
+        self.db.cursors[connID] = self.connection.cursor()
+        self.connection.execute('CREATE TABLE t (id INTEGER, x REAL, name TEXT, n INTEGER)')
+        self.connection.executemany('INSERT INTO t VALUES (?, ?, ?, ?)',
+                                    [(i, i / 2.0, 'row%d' % i, None if i == 4 else i)
+                                     for i in range(7)])
+
+    def tearDown(self):
+        connID = threading.currentThread().getName()
+        del self.db.connections[connID]
+        del self.db.cursors[connID]
+        self.connection.close()
+
+    def test_array(self):
+        res = self.db.execute_as_array('SELECT id, x, n FROM t ORDER BY id', chunk_size=3)
+        self.assertEqual(res.shape, (7, 3))
+        self.assertEqual(res.dtype, np.float64)
+        np.testing.assert_array_equal(res[:, 1], np.arange(7) / 2.0)
+        self.assertTrue(np.isnan(res[4, 2]))
+
+    def test_int_array(self):
+        res = self.db.execute_as_array('SELECT id FROM t ORDER BY id', dtype=np.int32, chunk_size=2)
+        self.assertEqual(res.dtype, np.int32)
+        np.testing.assert_array_equal(res[:, 0], np.arange(7))
+
+    def test_empty_array(self):
+        res = self.db.execute_as_array('SELECT id, x FROM t WHERE id > 10')
+        self.assertEqual(res.shape, (0, 2))
+
+    def test_structured_array(self):
+        res = self.db.execute_as_structured_array('SELECT id, x, name, n FROM t ORDER BY id',
+                                                  chunk_size=3)
+        self.assertEqual(res.dtype.names, ('id', 'x', 'name', 'n'))
+        self.assertEqual(res['id'].dtype, np.int64)
+        self.assertEqual(res['x'].dtype, np.float64)
+        np.testing.assert_array_equal(res['id'], np.arange(7))
+        self.assertEqual(res['name'][6], 'row6')
+        # The NULL only shows up in the second chunk, which widens the column
+        self.assertEqual(res['n'].dtype, np.float64)
+        self.assertTrue(np.isnan(res['n'][4]))
+        self.assertEqual(res['n'][5], 5)
+
+    def test_structured_array_widened_by_later_chunks(self):
+        self.connection.execute('CREATE TABLE u (v, w)')
+        self.connection.executemany('INSERT INTO u VALUES (?, ?)',
+                                    [(1, 1), (2, 2), (3, 3), (4.5, 'four')])
+        res = self.db.execute_as_structured_array('SELECT v, w FROM u ORDER BY rowid',
+                                                  chunk_size=2)
+        self.assertEqual(res['v'].dtype, np.float64)
+        np.testing.assert_array_equal(res['v'], [1, 2, 3, 4.5])
+        self.assertEqual(res['w'].dtype, np.object_)
+        self.assertEqual(res['w'].tolist(), [1, 2, 3, 'four'])
+
+    def test_structured_array_dtype(self):
+        res = self.db.execute_as_structured_array('SELECT id, x FROM t ORDER BY id',
+                                                  dtype=[('id', 'i4'), ('x', 'f4')])
+        self.assertEqual(res.dtype, np.dtype([('id', 'i4'), ('x', 'f4')]))
+        self.assertEqual(len(res), 7)
+
+    def test_iter_batches(self):
+        with self.db.iter_batches('SELECT id, x FROM t ORDER BY id', batch_size=3) as batches:
+            self.assertEqual(batches.columns, ['id', 'x'])
+            res = list(batches)
+        self.assertEqual([len(b) for b in res], [3, 3, 1])
+        np.testing.assert_array_equal(np.vstack(res)[:, 1], np.arange(7) / 2.0)
+        self.assertEqual(batches.nrows, 7)
+
+    def test_iter_structured_batches(self):
+        batches = self.db.iter_batches('SELECT id, n FROM t ORDER BY id', batch_size=4,
+                                       dtype='structured')
+        first, second = list(batches)
+        self.assertEqual(first['n'].dtype, np.int64)
+        self.assertEqual(second['n'].dtype, np.float64)
+        self.assertEqual(second['id'].tolist(), [4, 5, 6])
+
+    def test_iter_batches_cancel(self):
+        batches = self.db.iter_batches('SELECT id FROM t', batch_size=2)
+        seen = 0
+        for batch in batches:
+            seen += len(batch)
+            batches.cancel()
+        self.assertEqual(seen, 2)
+        self.assertTrue(batches.cancelled)
+        # the cursor has been released
+        self.assertRaises(Exception, batches.cursor.fetchone)
+        # other queries on the connection are unaffected
+        self.assertEqual(self.db.execute('SELECT COUNT(*) FROM t'), [(7,)])
+
+    def test_iter_batches_close_early(self):
+        with self.db.iter_batches('SELECT id FROM t', batch_size=2) as batches:
+            batches.next()
+        self.assertRaises(Exception, batches.cursor.fetchone)
+        self.assertRaises(StopIteration, batches.next)
+
+    def test_iter_batches_bad_query(self):
+        self.assertRaises(cpa.dbconnect.DBException,
+                          self.db.iter_batches, 'SELECT nothing FROM nowhere')
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        def open_connection():
+            conn = Mock()
+            self.opened.append(conn)
+            return conn
+        self.alive = lambda conn: True
+        self.pool = cpa.dbconnect.ConnectionPool(open_connection, max_size=2,
+                                                 is_alive=lambda conn: self.alive(conn))
+
+    def test_reuse(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.assertTrue(self.pool.checkout() is conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_bounded(self):
+        a = self.pool.checkout()
+        b = self.pool.checkout()
+        self.assertEqual(len(self.pool), 2)
+        self.assertRaises(cpa.dbconnect.DBException, self.pool.checkout, 0.05)
+        # a connection handed back by another thread unblocks the wait
+        threading.Timer(0.05, self.pool.checkin, [a]).start()
+        self.assertTrue(self.pool.checkout(5) is a)
+
+    def test_health_check(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.alive = lambda c: c is not conn
+        new = self.pool.checkout()
+        self.assertTrue(new is not conn)
+        self.assertTrue(conn.close.called)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_failed_open_frees_slot(self):
+        self.pool.open_connection = Mock(side_effect=IOError)
+        self.assertRaises(IOError, self.pool.checkout)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_close_all(self):
+        conns = [self.pool.checkout(), self.pool.checkout()]
+        for conn in conns:
+            self.pool.checkin(conn)
+        self.pool.close_all()
+        self.assertEqual(len(self.pool), 0)
+        self.assertTrue(all(conn.close.called for conn in conns))
+
+
+class PooledConnectionsTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.classification_type = None
+        self.dir = tempfile.mkdtemp()
+        self.p.db_sqlite_file = os.path.join(self.dir, 'test.db')
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.Disconnect()
+        self.hook = Mock()
+        self.db.connection_setup_hooks = [self.hook]
+
+    def tearDown(self):
+        import shutil
+        self.db.Disconnect()
+        self.db.connection_setup_hooks = []
+        self.p.db_sqlite_file = None
+        shutil.rmtree(self.dir)
+
+    def connect_in_thread(self):
+        def run():
+            self.db.connect(empty_sqlite_db=True)
+            self.db.execute('SELECT median(1)')
+        t = threading.Thread(target=run)
+        t.start()
+        t.join()
+
+    def test_threads_share_connections(self):
+        self.connect_in_thread()
+        self.connect_in_thread()
+        self.connect_in_thread()
+        # The dead threads' connections are handed back and reused
+        self.db.connect(empty_sqlite_db=True)
+        self.assertEqual(self.db.connections.keys(), [threading.currentThread().getName()])
+        self.assertEqual(len(self.db.pool), 1)
+        self.assertEqual(self.hook.call_count, 1)
+
+    def test_checkout_timeout(self):
+        self.p.db_connection_pool_size = 1
+        try:
+            self.db.connect(empty_sqlite_db=True)
+            self.assertRaises(cpa.dbconnect.DBException, self.db.checkout_connection, timeout=0)
+            # explain doesn't wait for a connection either
+            with patch.object(self.db, 'pool_timeout', 60):
+                with patch.object(self.p, 'db_type', 'MySQL'):
+                    with patch.object(self.db, 'pool_key', ('mysql',) + self.db.pool_key[1:]):
+                        self.assertEqual(self.db.explain('SELECT 1'), None)
+        finally:
+            self.p.db_connection_pool_size = None
+
+    def test_close_returns_to_pool(self):
+        self.db.connect(empty_sqlite_db=True)
+        self.db.CloseConnection()
+        self.assertEqual(self.db.pool.nidle, 1)
+        self.db.connect(empty_sqlite_db=True)
+        self.assertEqual(self.db.pool.nidle, 0)
+        self.assertEqual(len(self.db.pool), 1)
+
+    def test_connection_from_replaced_pool_is_closed(self):
+        import sqlite3
+        self.db.connect(empty_sqlite_db=True)
+        conn = self.db.checkout_connection()
+        # eg: the properties changed while conn was checked out
+        self.db.Disconnect()
+        self.db.connect(empty_sqlite_db=True)
+        self.db.checkin_connection(conn)
+        self.assertEqual((len(self.db.pool), self.db.pool.nidle), (1, 0))
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, 'SELECT 1')
+
+    def test_create_sqlite_db(self):
+        self.p.image_table = 'Per_Image'
+        self.p.object_table = 'Per_Object'
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.image_csv_file = os.path.join(self.dir, 'image.csv')
+        self.p.object_csv_file = os.path.join(self.dir, 'object.csv')
+        with open(self.p.image_csv_file, 'w') as f:
+            f.write('ImageNumber,Path\n1,/a\n2,/b\n')
+        with open(self.p.object_csv_file, 'w') as f:
+            f.write('ImageNumber,ObjectNumber,Area\n1,1,10.5\n1,2,3\n2,1,7\n')
+        try:
+            self.db.connect(empty_sqlite_db=True)
+            self.db.CreateSQLiteDB()
+            self.assertEqual(self.db.GetColumnTypeStrings('Per_Object'), ['INT', 'INT', 'FLOAT'])
+            self.assertEqual(self.db.execute('SELECT * FROM Per_Object'),
+                             [(1, 1, 10.5), (1, 2, 3.), (2, 1, 7.)])
+            self.assertEqual(self.db.execute('SELECT Path FROM Per_Image'), [('/a',), ('/b',)])
+            indexes = self.db.execute("SELECT name FROM sqlite_master WHERE type='index' "
+                                      "AND name LIKE 'pk_%'")
+            self.assertEqual(sorted(indexes), [('pk_Per_Image',), ('pk_Per_Object',)])
+        finally:
+            self.p.image_csv_file = self.p.object_csv_file = None
+
+    def test_failed_create_sqlite_db_is_removed(self):
+        self.p.image_csv_file = os.path.join(self.dir, 'image.csv')
+        self.p.object_csv_file = os.path.join(self.dir, 'object.csv')
+        def create():
+            self.db.execute('CREATE TABLE Per_Image (ImageNumber INT)')
+            self.db.Commit()
+            raise ValueError('bad CSV')
+        try:
+            with patch.object(self.db, 'CreateSQLiteDB', create):
+                self.assertRaises(ValueError, self.db.connect)
+        finally:
+            self.p.image_csv_file = self.p.object_csv_file = None
+        self.assertFalse(os.path.exists(self.p.db_sqlite_file))
+        self.assertEqual(self.db.connections, {})
+        self.assertEqual(len(self.db.pool), 0)
+
+    def test_create_sqlite_db_from_csvs(self):
+        self.p.image_table = 'Per_Image'
+        self.p.object_table = 'Per_Object'
+        self.p.db_sql_file = os.path.join(self.dir, 'SQL_SETUP.SQL')
+        with open(self.p.db_sql_file, 'w') as f:
+            f.write('CREATE TABLE Per_Image (ImageNumber INTEGER, Path TEXT, '
+                    'PRIMARY KEY (ImageNumber));\n'
+                    'CREATE TABLE Per_Object (ImageNumber INTEGER, ObjectNumber INTEGER, '
+                    'Area FLOAT, PRIMARY KEY (ImageNumber, ObjectNumber));\n'
+                    "LOAD DATA LOCAL INFILE 'Exp_Image.csv' REPLACE INTO TABLE Per_Image;\n"
+                    "LOAD DATA LOCAL INFILE 'Exp_Object.csv' REPLACE INTO TABLE Per_Object;\n")
+        # ExportToDatabase writes its CSVs without header lines
+        with open(os.path.join(self.dir, 'Exp_Image.csv'), 'w') as f:
+            f.write('1,/a\n2,/b\n3,/c\n')
+        with open(os.path.join(self.dir, 'Exp_Object.csv'), 'w') as f:
+            f.write('1,1,10.5\n1,2,3\n2,1,7\n')
+        try:
+            self.db.connect(empty_sqlite_db=True)
+            self.db.CreateSQLiteDBFromCSVs()
+            self.assertEqual(self.db.execute('SELECT * FROM Per_Image'),
+                             [(1, '/a'), (2, '/b'), (3, '/c')])
+            self.assertEqual(self.db.execute('SELECT * FROM Per_Object'),
+                             [(1, 1, 10.5), (1, 2, 3.), (2, 1, 7.)])
+        finally:
+            self.p.db_sql_file = None
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.classification_type = None
+        self.dir = tempfile.mkdtemp()
+        self.p.db_sqlite_file = os.path.join(self.dir, 'test.db')
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.Disconnect()
+        self.p.db_query_cache_size = 1
+        self.p.object_table = 'Per_Object'
+        self.db.connect(empty_sqlite_db=True)
+        self.db.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT)')
+        self.db.execute('CREATE TABLE Per_Image (ImageNumber INT)')
+        self.db.execute('INSERT INTO Per_Object VALUES (1, 1)')
+        self.db.execute('INSERT INTO Per_Image VALUES (1)')
+
+    def tearDown(self):
+        self.p.db_query_cache_size = None
+        self.p.object_table = None
+        import shutil
+        self.db.Disconnect()
+        self.p.db_sqlite_file = None
+        shutil.rmtree(self.dir)
+
+    def test_repeated_queries_are_cached(self):
+        query = 'SELECT COUNT(*) FROM Per_Object'
+        self.assertEqual(self.db.execute(query), [(1,)])
+        self.assertEqual(self.db.execute('  SELECT COUNT(*)\n FROM Per_Object;'), [(1,)])
+        self.assertEqual(self.db.query_cache.stats()['hits'], 1)
+        # without the cache, a stale result would be returned
+        self.db.connections.values()[0].execute('INSERT INTO Per_Object VALUES (1, 2)')
+        self.assertEqual(self.db.execute(query), [(1,)])
+        self.assertEqual(self.db.execute(query, cache=False), [(2,)])
+
+    def test_writes_invalidate(self):
+        self.db.execute('SELECT COUNT(*) FROM Per_Object')
+        self.db.execute('SELECT COUNT(*) FROM Per_Image')
+        self.db.execute('INSERT INTO Per_Object VALUES (1, 2)')
+        self.assertEqual(len(self.db.query_cache), 1)
+        self.assertEqual(self.db.execute('SELECT COUNT(*) FROM Per_Object'), [(2,)])
+        self.db.execute('ALTER TABLE Per_Image ADD COLUMN Count INT')
+        self.assertEqual(len(self.db.query_cache), 0)
+
+    def test_disabled(self):
+        self.p.db_query_cache_size = None
+        self.db.execute('SELECT COUNT(*) FROM Per_Object')
+        self.assertEqual(len(self.db.query_cache), 0)
+
+
+class SchemaCatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.classification_type = None
+        self.dir = tempfile.mkdtemp()
+        self.p.db_sqlite_file = os.path.join(self.dir, 'test.db')
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.Disconnect()
+        self.db.connect(empty_sqlite_db=True)
+        self.db.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT, '
+                        'Area FLOAT, Constant FLOAT, Label TEXT)')
+        self.db.execute_many('INSERT INTO Per_Object VALUES (%s, %s, %s, %s, %s)',
+                             [(1, 1, 1., 5., 'a'), (1, 2, 3., 5., 'b'), (1, 3, None, None, 'c')])
+
+    def tearDown(self):
+        import shutil
+        self.db.Disconnect()
+        self.p.db_sqlite_file = None
+        shutil.rmtree(self.dir)
+
+    def test_columns_are_loaded_once(self):
+        with patch.object(self.db, 'execute', wraps=self.db.execute) as execute:
+            self.assertEqual(self.db.GetColumnNames('Per_Object'),
+                             ['ImageNumber', 'ObjectNumber', 'Area', 'Constant', 'Label'])
+            self.assertEqual(self.db.GetColumnTypeStrings('per_object'),
+                             ['INT', 'INT', 'FLOAT', 'FLOAT', 'TEXT'])
+            self.assertEqual(self.db.GetColumnType('Per_Object', 'Label'), str)
+            self.assertEqual(execute.call_count, 1)
+        self.db.execute('ALTER TABLE Per_Object ADD COLUMN User_Class TEXT')
+        self.assertEqual(self.db.GetColumnNames('Per_Object')[-1], 'User_Class')
+
+    def test_temporary_table(self):
+        self.db.GetColumnNames('Per_Object')
+        self.db.execute('CREATE TEMPORARY TABLE _scores (a INT, b FLOAT)')
+        self.assertEqual(self.db.GetColumnTypeStrings('_scores'), ['INT', 'FLOAT'])
+
+    def test_column_stats(self):
+        stats = self.db.schema.column_stats('Per_Object', ['Area', 'Constant'])
+        self.assertEqual((stats['Area'].min, stats['Area'].max, stats['Area'].nulls), (1, 3, 1))
+        self.assertAlmostEqual(stats['Area'].variance, 1.0)
+        self.assertTrue(stats['Constant'].is_constant())
+        self.assertFalse(stats['Area'].is_constant())
+        with patch.object(self.db, 'execute') as execute:
+            self.db.schema.column_stats('Per_Object', ['Area'])
+            self.assertEqual(execute.call_count, 0)
+        self.db.execute('UPDATE Per_Object SET Constant=6 WHERE ObjectNumber=1')
+        stats = self.db.schema.column_stats('Per_Object', ['Constant'])
+        self.assertFalse(stats['Constant'].is_constant())
+
+    def test_classifier_columns_without_variance(self):
+        self.p.object_table = 'Per_Object'
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.table_id = None
+        self.p.classifier_ignore_columns = None
+        try:
+            self.assertEqual(self.db.GetColnamesForClassifier(True, force=True), ['Area'])
+        finally:
+            self.p.object_table = None
+            self.db.classifierColNames = None
+
+
+class InsertRowsTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.classification_type = None
+        self.dir = tempfile.mkdtemp()
+        self.p.db_sqlite_file = os.path.join(self.dir, 'test.db')
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.Disconnect()
+        self.db.connect(empty_sqlite_db=True)
+
+    def tearDown(self):
+        import shutil
+        self.db.Disconnect()
+        self.p.db_sqlite_file = None
+        shutil.rmtree(self.dir)
+
+    def test_rows_to_sql_params(self):
+        rows = [['A01', np.int64(1), 1.], ['A02', 2.0, -np.inf], [None, None, np.nan], ['A03', 3, '4.5']]
+        params = cpa.dbconnect.rows_to_sql_params(rows, ['VARCHAR(3)', 'INT', 'FLOAT'])
+        self.assertEqual(params, [('A01', 1, 1.), ('A02', 2, None), (None, None, None), ('A03', 3, 4.5)])
+        self.assertEqual([type(v) for v in params[0]], [str, int, float])
+
+    def test_batched_insert(self):
+        self.db.create_empty_table('t', ['well', 'plate', 'vals'], ['VARCHAR(3)', 'INT', 'FLOAT'])
+        data = np.empty((2500, 3), dtype=object)
+        data[:, 0] = 'A01'
+        data[:, 1] = np.arange(2500)
+        data[:, 2] = np.arange(2500) / 2.
+        data[::2, 2] = np.nan
+        cb = Mock()
+        with patch.object(self.db, 'execute_many', wraps=self.db.execute_many) as execute_many:
+            self.db.insert_rows_into_table('t', ['well', 'plate', 'vals'],
+                                           ['VARCHAR(3)', 'INT', 'FLOAT'], data,
+                                           batch_size=1000, cb=cb)
+            self.assertEqual(execute_many.call_count, 3)
+        self.assertEqual(cb.call_args_list[-1][0][0], 1.0)
+        self.assertEqual(self.db.execute('SELECT COUNT(*), COUNT(vals), SUM(plate) FROM t'),
+                         [(2500, 1250, 2500 * 2499 / 2)])
+        self.assertEqual(self.db.execute('SELECT * FROM t WHERE plate < 2'),
+                         [('A01', 0, None), ('A01', 1, 0.5)])
+
+    def test_create_table_from_data(self):
+        self.p.object_table = 'Per_Object'
+        self.p.table_id = self.p.well_id = self.p.plate_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        data = [['A01', 1, 1.], ['A02', 1, -np.inf], ['A04', 1, np.nan], ['A04', 1, 100]]
+        self.db.CreateTempTableFromData(data, ['well', 'plate', 'vals'], '__test_table')
+        self.assertEqual(self.db.execute('SELECT * FROM __test_table'),
+                         [('A01', 1, 1.0), ('A02', 1, None), ('A04', 1, None), ('A04', 1, 100.0)])
+
+
+class KeyTableTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.classification_type = None
+        self.p.object_table = 'Per_Object'
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.dir = tempfile.mkdtemp()
+        self.p.db_sqlite_file = os.path.join(self.dir, 'test.db')
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.Disconnect()
+        self.db.connect(empty_sqlite_db=True)
+        self.db.execute('CREATE TABLE Per_Object (ImageNumber INT, ObjectNumber INT)')
+        self.db.execute_many('INSERT INTO Per_Object VALUES (%s, %s)',
+                             [(i, j) for i in range(1, 21) for j in range(1, 101)])
+        self.db.key_table_threshold = 10
+
+    def tearDown(self):
+        import shutil
+        self.db.key_table_threshold = 1000
+        self.db.Disconnect()
+        self.p.db_sqlite_file = None
+        shutil.rmtree(self.dir)
+
+    def count(self, clause):
+        return self.db.execute('SELECT COUNT(*) FROM Per_Object WHERE %s'%(clause))[0][0]
+
+    def test_small_key_sets_are_inlined(self):
+        clause = cpa.dbconnect.GetWhereClauseForObjects([(1, 3), (2, 4)])
+        self.assertFalse('_cpa_keys_' in clause)
+        self.assertEqual(self.count(clause), 2)
+
+    def test_large_key_sets_use_a_table(self):
+        obkeys = [(i, j) for i in range(1, 21) for j in range(1, 101, 7)] + [(30, 1)]
+        clause = cpa.dbconnect.GetWhereClauseForObjects(obkeys, 'Per_Object')
+        self.assertTrue('(Per_Object.ImageNumber, Per_Object.ObjectNumber) IN' in clause)
+        self.assertEqual(self.count(clause), len(obkeys) - 1)
+        # The same keys reuse the table
+        self.assertEqual(cpa.dbconnect.GetWhereClauseForObjectsByImage(list(reversed(obkeys)), 'Per_Object'),
+                         clause)
+        imkeys = [(np.int64(i),) for i in range(5, 20)]
+        clause = cpa.dbconnect.GetWhereClauseForImages(imkeys)
+        self.assertTrue(clause.startswith('ImageNumber IN (SELECT k0 FROM _cpa_keys_'))
+        self.assertEqual(self.count(clause), 1500)
+
+    def test_old_tables_are_dropped(self):
+        self.db.max_key_tables = 2
+        try:
+            names = [cpa.dbconnect.GetWhereClauseForImages([(i,) for i in range(n)]).split()[-1][:-1]
+                     for n in [10, 11, 12]]
+        finally:
+            self.db.max_key_tables = 8
+        tables = [r[0] for r in self.db.execute("SELECT name FROM sqlite_temp_master WHERE type='table'")]
+        self.assertEqual(sorted(tables), sorted(names[1:]))
+
+    def test_dropped_tables_are_reloaded(self):
+        self.db.max_key_tables = 1
+        try:
+            first = cpa.dbconnect.GetWhereClauseForImages([(i,) for i in range(1, 11)])
+            second = cpa.dbconnect.GetWhereClauseForImages([(i,) for i in range(1, 12)])
+            # the first clause's table was dropped, and comes back when used
+            self.assertEqual(self.count(first), 1000)
+            self.assertEqual(self.count(second), 1100)
+        finally:
+            self.db.max_key_tables = 8
+
+    def test_falls_back_to_inline_clause(self):
+        def fail(conn, names):
+            raise cpa.dbconnect.DBException('CREATE command denied')
+        with patch.object(self.db, '_load_key_tables', fail):
+            clause = cpa.dbconnect.GetWhereClauseForImages([(i,) for i in range(1, 11)])
+        self.assertFalse('_cpa_keys_' in clause)
+        self.assertEqual(self.count(clause), 1000)
+
+    def test_closed_connections_forget_their_tables(self):
+        imkeys = [(i,) for i in range(10)]
+        cpa.dbconnect.GetWhereClauseForImages(imkeys)
+        conn = self.db.connections[threading.currentThread().getName()]
+        self.assertTrue(conn in self.db._key_tables)
+        self.db.CloseConnection()
+        # The pool finds the idle connection lost and replaces it
+        with patch.object(self.db.pool, 'is_alive', return_value=False):
+            self.db.connect(empty_sqlite_db=True)
+        self.assertFalse(conn in self.db._key_tables)
+        self.assertEqual(self.count(cpa.dbconnect.GetWhereClauseForImages(imkeys)), 900)
+
+
+class HistogramTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.conn = sqlite3.connect(':memory:')
+        self.db._setup_sqlite_connection(self.conn)
+        connID = threading.currentThread().getName()
+        self.db.connections[connID] = self.conn
+        self.db.cursors[connID] = self.conn.cursor()
+        self.random = np.random.RandomState(0)
+        self.a = self.random.normal(0, 1, 1000)
+        self.b = self.random.uniform(-5, 20, 1000)
+        self.b[::10] = np.nan
+        self.g = self.random.randint(0, 3, 1000)
+        self.conn.execute('CREATE TABLE t (g INT, a FLOAT, b FLOAT)')
+        self.conn.executemany('INSERT INTO t VALUES (?, ?, ?)',
+                              [(int(g), a, None if np.isnan(b) else b)
+                               for g, a, b in zip(self.g, self.a, self.b)])
+
+    def tearDown(self):
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID)
+        self.db.cursors.pop(connID)
+        self.conn.close()
+
+    def test_histogram(self):
+        hist, edges = self.db.histogram('a', 't', 20)
+        expected, expected_edges = np.histogram(self.a, 20)
+        np.testing.assert_array_equal(hist, expected)
+        np.testing.assert_allclose(edges, expected_edges)
+        # on a subquery, with a range
+        hist, edges = self.db.histogram('a', 'SELECT a FROM t WHERE g = 1', 10, (-1, 1))
+        np.testing.assert_array_equal(hist, np.histogram(self.a[self.g == 1], 10, (-1, 1))[0])
+
+    def test_several_columns_in_one_scan(self):
+        with patch.object(self.db, 'execute', wraps=self.db.execute) as execute:
+            hists, edges = self.db.histograms(['a', 'b'], 't', 15)
+            self.assertEqual(execute.call_count, 2)
+        b = self.b[~np.isnan(self.b)]
+        np.testing.assert_array_equal(hists[0], np.histogram(self.a, 15)[0])
+        np.testing.assert_array_equal(hists[1], np.histogram(b, 15)[0])
+        np.testing.assert_allclose(edges[1], np.histogram(b, 15)[1])
+
+    def test_groups(self):
+        hists, edges = self.db.histograms(['a', 'b'], 't', 8, ranges=[(-2, 2), (0, 10)],
+                                          group_by=['g'])
+        self.assertEqual(sorted(hists.keys()), [(0,), (1,), (2,)])
+        for g in range(3):
+            b = self.b[(self.g == g) & ~np.isnan(self.b)]
+            np.testing.assert_array_equal(hists[(g,)][0], np.histogram(self.a[self.g == g], 8, (-2, 2))[0])
+            np.testing.assert_array_equal(hists[(g,)][1], np.histogram(b, 8, (0, 10))[0])
+
+    def test_empty_and_constant(self):
+        hist, edges = self.db.histogram('a', 'SELECT a FROM t WHERE g = 5', 4)
+        np.testing.assert_array_equal(hist, [0, 0, 0, 0])
+        hist, edges = self.db.histogram('g', 'SELECT g FROM t WHERE g = 2', 4)
+        np.testing.assert_array_equal(hist, np.histogram(self.g[self.g == 2], 4)[0])
+
+    def test_nan(self):
+        # CSV imports keep "nan" as text in numeric columns
+        self.conn.execute('CREATE TABLE n (x FLOAT)')
+        self.conn.executemany('INSERT INTO n VALUES (?)',
+                              [(1.0,), (2.0,), (3.0,), ('nan',), (float('inf'),)])
+        hist, edges = self.db.histogram('x', 'n', 2)
+        np.testing.assert_array_equal(hist, [1, 2])
+        np.testing.assert_allclose(edges, [1, 2, 3])
+        self.assertRaises(ValueError, self.db.histogram, 'x', 'n', 2, (0, float('nan')))
+
+
+class QueryStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.conn = sqlite3.connect(':memory:')
+        connID = threading.currentThread().getName()
+        self.db.connections[connID] = self.conn
+        self.db.cursors[connID] = self.conn.cursor()
+        self.conn.execute('CREATE TABLE t (a INT)')
+        self.conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(100)])
+        self.db.query_stats.reset()
+
+    def tearDown(self):
+        self.p.db_slow_query_time = None
+        connID = threading.currentThread().getName()
+        self.db.connections.pop(connID)
+        self.db.cursors.pop(connID)
+        self.conn.close()
+
+    def test_queries_are_timed_by_caller(self):
+        self.db.execute('SELECT * FROM t')
+        self.db.execute('SELECT * FROM t WHERE a < 10')
+        with self.db.iter_batches('SELECT * FROM t', batch_size=30) as batches:
+            self.assertEqual(sum(len(b) for b in batches), 100)
+        stats = dict(self.db.query_stats.summary())
+        caller = stats['test_dbconnect.py:test_queries_are_timed_by_caller']
+        self.assertEqual((caller.queries, caller.rows), (3, 210))
+        self.assertTrue(caller.nbytes > 0)
+        self.assertEqual(len(self.db.query_stats.slow_queries), 0)
+
+    def test_slow_query_log(self):
+        self.p.db_slow_query_time = '0'
+        rows = self.db.execute('SELECT * FROM t WHERE a < 10')
+        self.assertEqual(len(rows), 10)
+        slow = self.db.query_stats.slow_queries[-1]
+        self.assertEqual(slow['query'], 'SELECT * FROM t WHERE a < 10')
+        self.assertTrue('SCAN' in ' '.join(str(v) for v in slow['plan'][0]))
+        # Explaining doesn't disturb the results of the last query
+        self.db.execute('SELECT a FROM t WHERE a = 5', return_result=False)
+        self.assertEqual(self.db.GetNextResult(), (5,))
+        # and the query is recorded once the next one is run
+        self.db.execute('SELECT 1')
+        self.assertEqual(self.db.query_stats.slow_queries[-2]['query'],
+                         'SELECT a FROM t WHERE a = 5')
+
+    def test_streamed_results_are_recorded_once_read(self):
+        self.p.db_slow_query_time = '0'
+        a = self.db.execute_as_array('SELECT a FROM t', chunk_size=30)
+        self.assertEqual(len(a), 100)
+        stats = dict(self.db.query_stats.summary())
+        caller = stats['test_dbconnect.py:test_streamed_results_are_recorded_once_read']
+        self.assertEqual((caller.queries, caller.rows), (1, 100))
+        self.assertEqual(self.db.query_stats.slow_queries[-1]['rows'], 100)
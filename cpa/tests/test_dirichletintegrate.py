@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+from cpa import dirichletintegrate
+
+
+class ScoreAllTestCase(unittest.TestCase):
+    def check(self, prior, counts):
+        expected = np.array([dirichletintegrate.score(prior, row.astype(float))
+                             for row in counts])
+        actual = dirichletintegrate.score_all(prior, counts)
+        self.assertEqual(actual.shape, counts.shape)
+        np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-12)
+
+    def test_matches_score(self):
+        rs = np.random.RandomState(0)
+        # Small and large priors take different recursions in hyper3F2aZ1
+        for prior in [np.array([0.5, 2.0]), np.array([3.2, 1.7, 8.4]),
+                      np.array([1.1, 0.3, 0.7, 2.2]), np.array([120., 45.])]:
+            counts = rs.poisson(rs.choice([2, 20, 200], size=(60, 1)),
+                                size=(60, len(prior)))
+            self.check(prior, counts)
+
+    def test_repeated_counts(self):
+        prior = np.array([3.2, 1.7, 8.4])
+        counts = np.array([[1, 0, 3], [5, 5, 5], [1, 0, 3], [0, 0, 0], [5, 5, 5]])
+        self.check(prior, counts)
+        scores = dirichletintegrate.score_all(prior, counts)
+        self.assertTrue(np.array_equal(scores[0], scores[2]))
+        self.assertTrue(np.array_equal(scores[1], scores[4]))
+
+    def test_empty(self):
+        scores = dirichletintegrate.score_all(np.array([1., 2.]), np.zeros((0, 2)))
+        self.assertEqual(scores.shape, (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
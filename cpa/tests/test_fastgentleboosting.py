@@ -0,0 +1,59 @@
+import unittest
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from cpa import fastgentleboostingworkermulticlass as worker
+
+
+class FindBestWeakLearnerTestCase(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        n, self.ncols, c = 200, 70, 3
+        # Rounding gives many tied values, which exercises the sort order
+        self.values = np.round(rs.randn(n, self.ncols), 1).astype(np.float32)
+        self.labels = -np.ones((n, c), np.int32)
+        self.labels[np.arange(n), rs.randint(0, c, n)] = 1
+        self.weights = rs.rand(n, c).astype(np.float32)
+
+    def serial(self):
+        best_error = float(np.Infinity)
+        for column in range(self.ncols):
+            thresh, err, a, b = worker.train_weak_learner(self.labels, self.weights, 
+                                                          self.values[:, column])
+            if err < best_error:
+                best_error = err
+                bestvals = (err, column, thresh, a, b)
+        return bestvals
+
+    def assertSameLearner(self, expected, actual):
+        self.assertEqual(expected[:3], actual[:3])
+        self.assertTrue(np.array_equal(expected[3], actual[3]))
+        self.assertTrue(np.array_equal(expected[4], actual[4]))
+
+    def test_presort(self):
+        orders = worker.presort(self.values)
+        for column in range(self.ncols):
+            self.assertTrue(np.array_equal(orders[:, column], 
+                                           np.argsort(self.values[:, column])))
+
+    def test_matches_serial_search(self):
+        orders = worker.presort(self.values)
+        self.assertSameLearner(self.serial(), 
+                               worker.find_best_weak_learner(self.labels, self.weights, 
+                                                             self.values, orders))
+
+    def test_matches_serial_search_in_parallel(self):
+        orders = worker.presort(self.values)
+        pool = ThreadPool(3)
+        try:
+            result = worker.find_best_weak_learner(self.labels, self.weights, self.values,
+                                                   orders, pool, chunk_size=8)
+        finally:
+            pool.close()
+        self.assertSameLearner(self.serial(), result)
+
+    def test_ties_go_to_lowest_column(self):
+        values = np.hstack([self.values[:, :1]] * 5)
+        orders = worker.presort(values)
+        result = worker.find_best_weak_learner(self.labels, self.weights, values, orders, 
+                                               chunk_size=2)
+        self.assertEqual(result[1], 0)
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from cpa.imagecache import ImageCache
+
+
+def image(value, n=100):
+    return [np.ones(n) * value, np.ones(n) * value]    # 1600 bytes
+
+
+class ImageCacheTestCase(unittest.TestCase):
+    def test_hit_and_miss(self):
+        c = ImageCache(10000)
+        self.assertEqual(c.get('a'), None)
+        imgs = image(1)
+        c.put('a', imgs)
+        self.assertTrue(c.get('a') is imgs)
+        stats = c.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['nbytes'], 1600)
+
+    def test_lru_eviction_by_bytes(self):
+        c = ImageCache(3500)
+        c.put('a', image(1))
+        c.put('b', image(2))
+        c.get('a')
+        c.put('c', image(3))
+        self.assertTrue('a' in c)
+        self.assertFalse('b' in c)
+        self.assertTrue('c' in c)
+        self.assertEqual(c.evictions, 1)
+        self.assertEqual(c.nbytes, 3200)
+
+    def test_keeps_one_oversized_image(self):
+        c = ImageCache(100)
+        c.put('a', image(1))
+        self.assertEqual(len(c), 1)
+        c.put('b', image(2))
+        self.assertEqual(len(c), 1)
+        self.assertTrue('b' in c)
+
+    def test_replace_same_key(self):
+        c = ImageCache(10000)
+        c.put('a', image(1))
+        c.put('a', image(2, 50))
+        self.assertEqual(c.nbytes, 800)
+        self.assertEqual(len(c), 1)
+
+
+class ImageCacheSpillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_spilled_image_is_read_back(self):
+        c = ImageCache(2000, spill_dir=self.dir, spill_max_bytes=10000)
+        c.put((1, 2), image(1))
+        c.put((1, 3), image(2))
+        self.assertFalse((1, 2) in c)
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        imgs = c.get((1, 2))
+        self.assertEqual(len(imgs), 2)
+        self.assertTrue(np.all(imgs[1] == 1))
+        self.assertEqual(c.spill_hits, 1)
+        self.assertEqual(c.misses, 0)
+
+    def test_spill_is_bounded(self):
+        c = ImageCache(1000, spill_dir=self.dir, spill_max_bytes=3500)
+        for i in range(5):
+            c.put(i, image(i))
+        self.assertEqual(c.stats()['spilled_images'], 2)
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        self.assertEqual(c.get(0), None)
+        self.assertTrue(np.all(c.get(3)[0] == 3))
+
+    def test_clear_removes_spilled_files(self):
+        c = ImageCache(1000, spill_dir=self.dir, spill_max_bytes=10000)
+        c.put('a', image(1))
+        c.put('b', image(2))
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(os.listdir(self.dir), [])
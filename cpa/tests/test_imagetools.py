@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+from mock import patch
+import cpa.imagetools as imagetools
+
+
+def reference_merge(imgs, chMap, brightness=1.0, contrast=None):
+    # The float64 path MergeToBitmap took before MergeChannelsToRGB, with
+    # wx's AdjustChannels for the brightness.
+    if contrast == 'Log':
+        imgs = [imagetools.log_transform(im) for im in imgs]
+    elif contrast == 'Linear':
+        imgs = [imagetools.auto_contrast(im) for im in imgs]
+    imData = imagetools.MergeChannels(imgs, chMap) * 255.0
+    imData[imData > 255] = 255
+    imData = imData.astype('uint8')
+    return np.minimum(imData * brightness, 255).astype('uint8')
+
+
+class MergeChannelsToRGBTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = imagetools.p
+        self.saved = (self.p.channels_per_image, self.p.image_channel_blend_modes)
+        self.random = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.p.channels_per_image, self.p.image_channel_blend_modes = self.saved
+
+    def channels(self, chMap, blending, shape=(2, 12, 16)):
+        self.p.channels_per_image = ['1'] * len(chMap)
+        self.p.image_channel_blend_modes = blending
+        imgs = [self.random.rand(*shape).astype(np.float32) for c in chMap]
+        for im in imgs:
+            # some dark pixels for the log transform
+            im[..., :2, :2] = 0
+        for i, mode in enumerate(blending):
+            if mode == 'solid':
+                imgs[i] = (imgs[i] > 0.8).astype(np.float32)
+        return imgs
+
+    def assertMatchesReference(self, imgs, chMap, brightness=1.0, contrast=None):
+        rgb = imagetools.MergeChannelsToRGB(imgs, chMap, brightness, contrast)
+        self.assertEqual(rgb.dtype, np.uint8)
+        self.assertEqual(rgb.shape, imgs[0].shape + (3,))
+        # each tile of the stack matches compositing it on its own
+        for n in range(imgs[0].shape[0]):
+            expected = reference_merge([im[n] for im in imgs], chMap, brightness, contrast)
+            diff = np.abs(rgb[n].astype(int) - expected.astype(int))
+            self.assertTrue(diff.max() <= 1, 'tile %d differs by %d' % (n, diff.max()))
+
+    def test_add(self):
+        chMap = ['red', 'green', 'blue']
+        self.assertMatchesReference(self.channels(chMap, ['add'] * 3), chMap)
+
+    def test_add_linear(self):
+        chMap = ['gray', 'red']
+        self.assertMatchesReference(self.channels(chMap, ['add', 'add']), chMap,
+                                    contrast='Linear')
+
+    def test_subtract_log(self):
+        chMap = ['cyan', 'blue', 'red']
+        self.assertMatchesReference(self.channels(chMap, ['add', 'subtract', 'add']), chMap,
+                                    contrast='Log')
+
+    def test_solid_and_none(self):
+        chMap = ['green', 'none', 'magenta']
+        self.assertMatchesReference(self.channels(chMap, ['add', 'add', 'solid']), chMap)
+
+    def test_brightness(self):
+        chMap = ['red', 'green']
+        self.assertMatchesReference(self.channels(chMap, ['add', 'add']), chMap,
+                                    brightness=0.5)
+
+
+class MergeTilesToBitmapsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = imagetools.p
+        self.saved = (self.p.channels_per_image, self.p.image_channel_blend_modes)
+        self.p.channels_per_image = ['1', '1']
+        self.p.image_channel_blend_modes = None
+
+    def tearDown(self):
+        self.p.channels_per_image, self.p.image_channel_blend_modes = self.saved
+
+    @patch('cpa.imagetools._RGBToBitmap')
+    def test_tiles_of_different_sizes(self, RGBToBitmap):
+        RGBToBitmap.side_effect = lambda imData, scale, display_whole_image: imData
+        random = np.random.RandomState(1)
+        shapes = [(8, 8), (6, 10), (8, 8)]
+        tiles = [[random.rand(*shape).astype(np.float32) for c in range(2)]
+                 for shape in shapes]
+        chMap = ['red', 'yellow']
+        bitmaps = imagetools.MergeTilesToBitmaps(tiles, chMap, contrast='Linear')
+        self.assertEqual([b.shape[:2] for b in bitmaps], shapes)
+        for tile, bitmap in zip(tiles, bitmaps):
+            expected = reference_merge(tile, chMap, contrast='Linear')
+            self.assertTrue(np.abs(bitmap.astype(int) - expected.astype(int)).max() <= 1)
@@ -1,8 +1,15 @@
 import mock
+import numpy as np
 from nose.tools import eq_
 from unittest import TestCase
 import cpa.multiclasssql
 
+
+class FirstColumnClassifier(object):
+    # picklable, so that it can be sent to worker processes
+    def Predict(self, data):
+        return data[:, 0]
+
 class WhereClausesTestCase(TestCase):
     def _where_clauses(self, imkeys):
         p = mock.Mock()
@@ -23,3 +30,117 @@ class WhereClausesTestCase(TestCase):
         eq_(result, ['(Per_Object.ImageNumber <= 5)'])
 
 
+
+
+class CountPredictionsTestCase(TestCase):
+    def setUp(self):
+        self.classifier = mock.Mock()
+        self.classifier.Predict = lambda data: data[:, 0]
+
+    def test_counts(self):
+        cell_data = np.array([[1., 0.], [2., 0.], [1., 0.], [1., 0.]])
+        image_keys = np.array([[1], [1], [2], [1]])
+        result = cpa.multiclasssql._count_predictions(self.classifier, cell_data, image_keys)
+        eq_(sorted(result.keys()), [(1, 1), (1, 2), (2, 1)])
+        eq_(result[(1, 1)].tolist(), [2])
+        eq_(result[(1, 2)].tolist(), [1])
+        eq_(result[(2, 1)].tolist(), [1])
+
+    def test_areas(self):
+        cell_data = np.array([[1.], [1.], [2.]])
+        image_keys = np.array([[0, 3], [0, 3], [0, 3]])
+        areas = np.array([10., 5., 7.])
+        result = cpa.multiclasssql._count_predictions(self.classifier, cell_data, image_keys, areas)
+        eq_(result[(0, 3, 1)].tolist(), [2, 15.])
+        eq_(result[(0, 3, 2)].tolist(), [1, 7.])
+
+    def test_empty(self):
+        eq_(cpa.multiclasssql._count_predictions(self.classifier, np.zeros((0, 2)), np.zeros((0, 1))), {})
+
+
+class ScoreBlocksTestCase(TestCase):
+    @mock.patch('cpa.multiclasssql.processData')
+    @mock.patch('cpa.multiclasssql.db')
+    def test_single_process(self, db, processData):
+        blocks = {'q1': [(1, 1.)], 'q2': [(2, 2.), (2, 1.)]}
+        db.execute = lambda query, silent=False: blocks[query]
+        processData.side_effect = lambda data: (np.array([row[1:] for row in data]),
+                                                np.array([row[:1] for row in data]))
+        classifier = mock.Mock()
+        classifier.Predict = lambda data: data[:, 0]
+        progress = []
+        result = cpa.multiclasssql._score_blocks(classifier, ['q1', 'q2'], processes=1,
+                                                 cb=progress.append)
+        eq_(dict((k, v.tolist()) for k, v in result.items()),
+            {(1, 1): [1], (2, 1): [1], (2, 2): [1]})
+        eq_(progress, [0.5, 1])
+
+    @mock.patch('cpa.multiclasssql.processData')
+    @mock.patch('cpa.multiclasssql.db')
+    def test_processes_match_serial(self, db, processData):
+        blocks = dict(('q%d'%(i), [(i % 3, float(i % 2 + 1)), (i % 5, 1.), (1, 2.)])
+                      for i in range(8))
+        db.execute = lambda query, silent=False: blocks[query]
+        processData.side_effect = lambda data: (np.array([row[1:] for row in data]),
+                                                np.array([row[:1] for row in data]))
+        queries = sorted(blocks)
+        serial = cpa.multiclasssql._score_blocks(FirstColumnClassifier(), queries, processes=1)
+        parallel = cpa.multiclasssql._score_blocks(FirstColumnClassifier(), queries, processes=2)
+        eq_(dict((k, v.tolist()) for k, v in parallel.items()),
+            dict((k, v.tolist()) for k, v in serial.items()))
+
+
+class ProcessDataTestCase(TestCase):
+    @mock.patch('cpa.multiclasssql.db')
+    def test_split(self, db):
+        db.GetColnamesForClassifier.return_value = ['a', 'b']
+        cell_data, object_keys = cpa.multiclasssql.processData([(1, 2, 0.5, None), (1, 3, 'x', 4)])
+        eq_(object_keys.tolist(), [[1, 2], [1, 3]])
+        eq_(cell_data.tolist(), [[0.5, 0.], [0., 4.]])
+        self.assertTrue(cell_data.flags['C_CONTIGUOUS'])
+
+
+class CreatePerObjectClassTableTestCase(TestCase):
+    @mock.patch('cpa.multiclasssql.object_key_defs')
+    @mock.patch('cpa.multiclasssql.object_key_columns')
+    @mock.patch('cpa.multiclasssql.UniqueObjectClause')
+    @mock.patch('cpa.multiclasssql.p')
+    @mock.patch('cpa.multiclasssql.db')
+    def test_batches(self, db, p, UniqueObjectClause, object_key_columns,
+                     object_key_defs):
+        p.class_table = 'Per_Class'
+        p.object_table = 'Per_Object'
+        UniqueObjectClause.return_value = 'ImageNumber,ObjectNumber'
+        object_key_columns.return_value = ('ImageNumber', 'ObjectNumber')
+        object_key_defs.return_value = 'ImageNumber INT, ObjectNumber INT'
+        db.GetColnamesForClassifier.return_value = ['a']
+        batches = mock.MagicMock()
+        batches.__enter__.return_value = [np.array([[1, 1, 0.], [1, 2, 1.]]),
+                                          np.array([[2, 1, 1.]])]
+        db.iter_batches.return_value = batches
+        classifier = mock.Mock()
+        classifier.Predict = lambda data: data[:, 0].astype(int) + 1
+        classifier.PredictProba = lambda data: np.column_stack((1 - data[:, 0], data[:, 0]))
+        classifier.classifier.classes_ = np.array([1, 2])
+
+        cpa.multiclasssql.create_perobject_class_table(classifier, ['neg', 'pos'], batch_size=2)
+
+        eq_(db.iter_batches.call_args[0][0], 'SELECT ImageNumber,ObjectNumber, a FROM Per_Object')
+        self.assertTrue(batches.__exit__.called)
+        eq_(db.execute_many.call_count, 2)
+        query = db.execute_many.call_args_list[0][0][0]
+        eq_(query, 'INSERT INTO Per_Class (ImageNumber, ObjectNumber, class, class_number, '
+                   'prob_neg, prob_pos) VALUES (%s, %s, %s, %s, %s, %s)')
+        rows = sum([c[0][1] for c in db.execute_many.call_args_list], [])
+        eq_(rows, [[1, 1, 'neg', 1, 1., 0.], [1, 2, 'pos', 2, 0., 1.], [2, 1, 'pos', 2, 0., 1.]])
+        # the index is created after the rows are loaded
+        eq_(db.execute.call_args_list[-1][0][0],
+            'CREATE INDEX idx_Per_Class ON Per_Class (ImageNumber,ObjectNumber)')
+
+    def test_probability_classes(self):
+        classifier = mock.Mock()
+        classifier.classifier.classes_ = np.array([1, 3])
+        eq_(cpa.multiclasssql._probability_classes(classifier), [1, 3])
+        # eg: an SVC not trained for probabilities
+        classifier.classifier = mock.Mock(spec=['predict', 'classes_'])
+        eq_(cpa.multiclasssql._probability_classes(classifier), None)
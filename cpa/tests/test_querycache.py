@@ -0,0 +1,50 @@
+import unittest
+from cpa import querycache
+from cpa.querycache import QueryCache
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def test_classify_queries(self):
+        self.assertTrue(querycache.is_cacheable('select * from t'))
+        self.assertTrue(querycache.is_cacheable('PRAGMA table_info(t)'))
+        self.assertFalse(querycache.is_cacheable('SELECT * FROM t ORDER BY RAND()'))
+        self.assertFalse(querycache.is_cacheable('SELECT last_insert_rowid()'))
+        self.assertFalse(querycache.is_cacheable('INSERT INTO t VALUES (1)'))
+        self.assertEqual(querycache.written_table('SELECT * FROM t'), None)
+        self.assertEqual(querycache.written_table('INSERT OR REPLACE INTO `t` VALUES (1)'), 't')
+        self.assertEqual(querycache.written_table('update db.t set a=1'), 't')
+        self.assertEqual(querycache.written_table('DROP TABLE t'), '')
+
+    def test_lru_eviction_by_bytes(self):
+        rows = [(1, 2.0)]
+        n = querycache.result_nbytes(rows)
+        c = QueryCache(2 * n)
+        c.put('a', rows)
+        c.put('b', rows)
+        c.get('a')
+        c.put('c', rows)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('a'), rows)
+        self.assertEqual(c.stats()['evictions'], 1)
+        # results larger than the cache are not kept
+        c.put('d', rows * 10)
+        self.assertEqual(c.get('d'), None)
+
+    def test_copies_are_returned(self):
+        c = QueryCache(10000)
+        c.put('a', [(1,)])
+        c.get('a').append((2,))
+        self.assertEqual(c.get('a'), [(1,)])
+
+    def test_invalidate_table(self):
+        c = QueryCache(10000)
+        for table in ['Per_Image', 'Per_Object', 'Per_Object_Extra']:
+            c.put(c.key('SELECT * FROM %s'%table, None, 1), [(1,)])
+        c.invalidate('per_object')
+        self.assertEqual(len(c), 2)
+        c.invalidate()
+        self.assertEqual((len(c), c.nbytes), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import Mock, patch
+import cpa.dbconnect
+from cpa import queryexecutor
+from cpa.queryexecutor import QueryExecutor
+
+# Counts to a billion, which takes far longer than the tests wait
+LONG_QUERY = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c '
+              'WHERE x < 1000000000) SELECT COUNT(*) FROM c')
+
+
+class QueryExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = cpa.dbconnect.p
+        self.p.db_type = 'sqlite'
+        self.p.classification_type = None
+        self.dir = tempfile.mkdtemp()
+        self.p.db_sqlite_file = os.path.join(self.dir, 'test.db')
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.Disconnect()
+        self.db.connect(empty_sqlite_db=True)
+        self.db.execute('CREATE TABLE t (a INT)')
+        self.db.execute_many('INSERT INTO t VALUES (%s)', [(i,) for i in range(10)])
+        self.db.Commit()
+        self.executor = QueryExecutor.getInstance()
+        self.executor.deliver = lambda fn: fn()
+        self.delivered = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.db.Disconnect()
+        self.p.db_sqlite_file = None
+        shutil.rmtree(self.dir)
+
+    def callback(self, job):
+        with self.lock:
+            self.delivered.append(job)
+
+    def test_query(self):
+        job = self.executor.submit('SELECT SUM(a) FROM t', callback=self.callback)
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.state, queryexecutor.FINISHED)
+        self.assertEqual(job.result, [(45,)])
+        self.assertEqual(self.delivered, [job])
+
+    def test_function_and_failure(self):
+        job = self.executor.submit(lambda: self.db.histogram('a', 't', 5), callback=self.callback)
+        bad = self.executor.submit('SELECT * FROM missing', callback=self.callback)
+        self.assertTrue(job.wait(10) and bad.wait(10))
+        self.assertEqual(list(job.result[0]), [2, 2, 2, 2, 2])
+        self.assertEqual(bad.state, queryexecutor.FAILED)
+        self.assertTrue(isinstance(bad.error, cpa.dbconnect.DBException))
+        self.assertEqual(len(self.delivered), 2)
+
+    def test_cancel_running_query(self):
+        job = self.executor.submit(LONG_QUERY, callback=self.callback)
+        while job.state == queryexecutor.PENDING:
+            job.wait(0.01)
+        job.cancel()
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.state, queryexecutor.CANCELLED)
+        self.assertEqual(self.delivered, [])
+
+    def test_superseded_queries_are_cancelled(self):
+        first = self.executor.submit(LONG_QUERY, key='tool', callback=self.callback)
+        second = self.executor.submit('SELECT COUNT(*) FROM t', key='tool', callback=self.callback)
+        self.assertTrue(first.wait(10) and second.wait(10))
+        self.assertEqual(first.state, queryexecutor.CANCELLED)
+        self.assertEqual(second.result, [(10,)])
+        self.assertEqual(self.delivered, [second])
+
+    def test_redraw(self):
+        shown = []
+        window = Mock()
+        job = self.executor.redraw(window, LONG_QUERY, shown.append)
+        while job.state == queryexecutor.PENDING:
+            job.wait(0.01)
+        # drawing right away cancels the query that is still running, so it
+        # can't overwrite what is shown
+        self.executor.redraw(window, 'SELECT COUNT(*) FROM t', shown.append, wait=True)
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.state, queryexecutor.CANCELLED)
+        self.assertEqual(shown, [[(10,)]])
+
+    def test_mysql_kill_does_not_block(self):
+        conn = Mock()
+        conn.thread_id.return_value = 7
+        other = Mock()
+        released = threading.Event()
+        def checkout():
+            # eg: every connection is in use
+            released.wait(10)
+            return other
+        job = queryexecutor.QueryJob('SELECT 1')
+        self.p.db_type = 'mysql'
+        try:
+            with patch.object(self.db, 'checkout_connection', checkout), \
+                    patch.object(self.db, 'checkin_connection') as checkin:
+                kill = self.executor._interrupter(job, conn)
+                t0 = time.time()
+                kill()
+                self.assertTrue(time.time() - t0 < 1)
+                released.set()
+                job._killer.join(10)
+                other.cursor().execute.assert_called_with('KILL QUERY 7')
+                checkin.assert_called_with(other)
+        finally:
+            self.p.db_type = 'sqlite'
+
+
+if __name__ == '__main__':
+    unittest.main()
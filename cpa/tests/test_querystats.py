@@ -0,0 +1,54 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from cpa import querystats
+from cpa.querystats import QueryStats
+
+
+class QueryStatsTestCase(unittest.TestCase):
+    def test_estimate_nbytes(self):
+        rows = [(1, 'abc')] * 1000
+        exact = sum(querystats.sys.getsizeof(r) + sum(querystats.sys.getsizeof(v) for v in r)
+                    for r in rows)
+        self.assertEqual(querystats.estimate_nbytes(rows), exact)
+        self.assertEqual(querystats.estimate_nbytes([]), 0)
+
+    def test_find_caller(self):
+        def inner():
+            return querystats.find_caller(set([inner.func_code.co_filename + 'x']))
+        self.assertEqual(inner(), 'test_querystats.py:inner')
+        def skipped():
+            return querystats.find_caller(set([skipped.func_code.co_filename]))
+        self.assertNotEqual(skipped().split(':')[0], 'test_querystats.py')
+
+    def test_aggregates_and_dump(self):
+        stats = QueryStats(slow_query_time=1.0)
+        stats.record('a', 'SELECT 1', 0.5, 0.1, 10, 100)
+        stats.record('a', 'SELECT 2', 2.0, 0.2, 5, 50)
+        stats.record('b', 'SELECT 3', 0.0, 0.0, 5, 0, cache_hit=True)
+        self.assertTrue(stats.is_slow(2.0))
+        self.assertFalse(stats.is_slow(0.5))
+        stats.record_slow('a', 'SELECT 2', 2.0, 5, [(0, 0, 0, 'SCAN t')])
+        (caller, a), (_, b) = stats.summary()
+        self.assertEqual(caller, 'a')
+        self.assertEqual((a.queries, a.rows, a.nbytes, a.slowest_query), (2, 15, 150, 'SELECT 2'))
+        self.assertAlmostEqual(a.wall_time, 2.5)
+        self.assertEqual(b.cache_hits, 1)
+        d = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(d, 'stats.json')
+            stats.dump(filename)
+            with open(filename) as f:
+                dumped = json.load(f)
+        finally:
+            shutil.rmtree(d)
+        self.assertEqual(dumped['callers']['a']['queries'], 2)
+        self.assertEqual(dumped['slow_queries'][0]['plan'], [[0, 0, 0, 'SCAN t']])
+        stats.reset()
+        self.assertEqual(stats.summary(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
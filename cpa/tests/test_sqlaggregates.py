@@ -0,0 +1,67 @@
+import sqlite3
+import unittest
+import numpy as np
+from cpa import sqlaggregates
+
+
+class SQLAggregatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        sqlaggregates.register(self.conn)
+        self.conn.execute('CREATE TABLE t (g INTEGER, x REAL)')
+        self.random = np.random.RandomState(1)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def fill(self, values, g=0):
+        self.conn.executemany('INSERT INTO t VALUES (?, ?)',
+                              [(g, None if v is None else float(v)) for v in values])
+
+    def query(self, expr, g=0):
+        return self.conn.execute('SELECT %s FROM t WHERE g=?'%expr, (g,)).fetchone()[0]
+
+    def test_exact_aggregates(self):
+        values = list(self.random.normal(5, 2, 3 * sqlaggregates.BLOCK_SIZE + 17))
+        self.fill(values + [None, float('nan')])
+        self.assertAlmostEqual(self.query('median(x)'), np.median(values))
+        self.assertAlmostEqual(self.query('stddev(x)'), np.std(values))
+
+    def test_even_median(self):
+        self.fill([4, 1, 3, 2])
+        self.assertEqual(self.query('median(x)'), 2.5)
+
+    def test_empty(self):
+        self.fill([None, float('nan')])
+        for expr in ['median(x)', 'stddev(x)', 'percentile(x, 50)', 'mad(x)']:
+            self.assertEqual(self.query(expr), None)
+            self.assertEqual(self.query(expr, g=1), None)
+
+    def test_grouped(self):
+        self.fill([1, 2, 3], g=0)
+        self.fill([10, 30], g=1)
+        rows = self.conn.execute('SELECT g, median(x), percentile(x, 100) '
+                                 'FROM t GROUP BY g ORDER BY g').fetchall()
+        self.assertEqual(rows, [(0, 2.0, 3.0), (1, 20.0, 30.0)])
+
+    def test_small_groups_are_exact(self):
+        values = self.random.exponential(1, 1000)
+        self.fill(values)
+        for q in [0, 10, 50, 95]:
+            self.assertAlmostEqual(self.query('percentile(x, %d)'%q),
+                                   np.percentile(values, q))
+        self.assertAlmostEqual(self.query('mad(x)'),
+                               np.median(np.abs(values - np.median(values))))
+
+    def test_large_groups_are_close(self):
+        values = self.random.uniform(0, 1, 5 * sqlaggregates.SAMPLE_SIZE)
+        self.fill(values)
+        for q in [5, 50, 90]:
+            self.assertAlmostEqual(self.query('percentile(x, %d)'%q), q / 100., places=2)
+        self.assertAlmostEqual(self.query('mad(x)'), 0.25, places=2)
+        # The sample is seeded, so repeated queries agree
+        self.assertEqual(self.query('mad(x)'), self.query('mad(x)'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,7 @@ from __future__ import with_statement
 from dbconnect import DBConnect
 from properties import Properties
 from singleton import Singleton
-from heapq import heappush, heappop
+from heapq import heappush, heappop, heapify
 from weakref import WeakValueDictionary
 import imagetools
 import logging
@@ -35,7 +35,7 @@ class TileCollection(Singleton):
         self.imagePlaceholder = List([numpy.zeros((int(p.image_tile_size),
                                                    int(p.image_tile_size)))+0.1
                                       for i in range(sum(map(int,p.channels_per_image)))])
-        self.loader = TileLoader(self, None)
+        self.loader = TileLoaderPool(self, None, int(p.tile_loader_threads or 1))
 
     def GetTileData(self, obKey, notify_window, priority=1):
         return self.GetTiles([obKey], notify_window, priority)[0]
@@ -68,7 +68,9 @@ class TileCollection(Singleton):
                         temp[order] = List(self.imagePlaceholder)
                     self.tileData[obKey] = temp[order]
             tiles = [self.tileData[obKey] for obKey in obKeys]
-            self.cv.notify()
+            # The tiles may come from several images, which the loaders
+            # read concurrently
+            self.cv.notify_all()
         return tiles
 
 
@@ -94,73 +96,126 @@ class TileUpdatedEvent(wx.PyEvent):
         self.data = data
 
 
+class TileLoaderPool(object):
+    '''
+    A fixed-size pool of TileLoader threads owned by the TileCollection
+    singleton. Each loader takes the most urgent tile from the load queue
+    together with every other pending tile from the same image, so each
+    image is read once per batch no matter how many of its tiles were
+    requested. Loaders read images concurrently and only hold the
+    TileCollection's load_lock while writing tiles back, so holding
+    load_lock still pauses updates to tileData.
+    '''
+    def __init__(self, tc, notify_window, nthreads=1):
+        self.notify_window = notify_window
+        self.tile_collection = tc
+        self.loaders = [TileLoader(tc, self) for i in range(max(1, nthreads))]
+
+    def abort(self):
+        for loader in self.loaders:
+            loader.abort()
+
+
+def pop_image_group(loadq):
+    '''
+    Pops the most urgent request from the heap LOADQ along with all other
+    queued requests for tiles from the same image (and with the same
+    display_whole_image flag). Returns the object keys in priority order
+    and the display_whole_image flag. LOADQ is modified in place.
+    '''
+    first = heappop(loadq)
+    obKey, display_whole_image = first[1], first[2]
+    imKey = obKey[:-1]
+    group = [first]
+    rest = []
+    for item in loadq:
+        if item[1][:-1] == imKey and item[2] == display_whole_image:
+            group.append(item)
+        else:
+            rest.append(item)
+    if len(group) > 1:
+        heapify(rest)
+        loadq[:] = rest
+        group.sort()
+    return [item[1] for item in group], display_whole_image
+
+
 class TileLoader(threading.Thread):
     '''
-    This thread is owned by the TileCollection singleton and is kept
-    running for the duration of the app execution.  Whenever
-    TileCollection has obKeys in its load queue (loadq), this thread
-    will remove them from the queue and fetch the tile data for
+    These threads are owned by the TileLoaderPool and are kept running for
+    the duration of the app execution.  Whenever TileCollection has obKeys
+    in its load queue (loadq), a thread will remove the most urgent one
+    along with any others from the same image and fetch the tile data for
     them. The tile data is then written back into TileCollection's
     tileData dict over the existing placeholder. Finally an event is
     posted to the svn to tell it to refresh the tiles.
     '''
-    def __init__(self, tc, notify_window):
+    def __init__(self, tc, pool):
         threading.Thread.__init__(self)
         self.setName('TileLoader_%s'%(self.getName()))
-        self.notify_window = notify_window
+        self.pool = pool
         self.tile_collection = tc
         self._want_abort = False
         self.start()
 
+    @property
+    def notify_window(self):
+        return self.pool.notify_window
+
     def run(self):
         javabridge.attach()
         try:
             while 1:
-                self.tile_collection.cv.acquire()
-                # If there are no objects in the queue then wait
-                while not self.tile_collection.loadq:
-                    self.tile_collection.cv.wait()
-
-                if self._want_abort:
-                    self.tile_collection.cv.release()
-                    logging.info('%s aborted'%self.getName())
-                    return
-
-                data = heappop(self.tile_collection.loadq)
-                obKey = data[1]
-                display_whole_image = data[2] #display whole image instead of object image
-
-                self.tile_collection.cv.release()
+                with self.tile_collection.cv:
+                    # If there are no objects in the queue then wait
+                    while not self.tile_collection.loadq and not self._want_abort:
+                        self.tile_collection.cv.wait()
+
+                    if self._want_abort:
+                        logging.info('%s aborted'%self.getName())
+                        return
+
+                    obKeys, display_whole_image = pop_image_group(self.tile_collection.loadq)
+                    if self.tile_collection.loadq:
+                        # hand the other images to another loader
+                        self.tile_collection.cv.notify()
+
+                # Make sure tiles haven't been deleted outside this thread
+                obKeys = [obKey for obKey in obKeys 
+                          if self.tile_collection.tileData.get(obKey, None)]
+                if not obKeys:
+                    continue
+
+                # Get the tiles, reading their image only once
+                try:
+                    new_tiles = imagetools.FetchTiles(obKeys, display_whole_image=display_whole_image)
+                except Exception:
+                    #if fetching fails, leave the tiles blank
+                    logging.exception('%s failed to load tiles'%self.getName())
+                    continue
 
                 # wait until loading has completed before continuing
                 with self.tile_collection.load_lock:
-                    # Make sure tile hasn't been deleted outside this thread
-                    if not self.tile_collection.tileData.get(obKey, None):
-                        continue
-
-                    # Get the tile
-                    new_data = imagetools.FetchTile(obKey, display_whole_image=display_whole_image)
-                    if new_data is None:
-                        #if fetching fails, leave the tile blank
-                        continue
-
-                    tile_data = self.tile_collection.tileData.get(obKey, None)
-
-                    # Make sure tile hasn't been deleted outside this thread
-                    if tile_data is not None:
-                        # copy each channel
-                        for i in range(len(tile_data)):
-                            tile_data[i] = new_data[i]
-                        wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
+                    for obKey, new_data in zip(obKeys, new_tiles):
+                        if new_data is None:
+                            #if fetching fails, leave the tile blank
+                            continue
+
+                        tile_data = self.tile_collection.tileData.get(obKey, None)
+
+                        # Make sure tile hasn't been deleted outside this thread
+                        if tile_data is not None:
+                            # copy each channel
+                            for i in range(len(tile_data)):
+                                tile_data[i] = new_data[i]
+                            wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
         finally:
             javabridge.detach()
 
     def abort(self):
         self._want_abort = True
-        self.tile_collection.cv.acquire()
-        heappush(self.tile_collection.loadq, ((0, 0, 0), '<ABORT>'))
-        self.tile_collection.cv.notify()
-        self.tile_collection.cv.release()
+        with self.tile_collection.cv:
+            self.tile_collection.cv.notify_all()
 
 
 
@@ -68,8 +68,12 @@ class TrainingSet:
         self.labels = numpy.array(labels)
         self.classifier_labels = 2 * numpy.eye(len(labels), dtype=numpy.int) - 1
         
-        num_to_fetch = sum([len(k) for k in keyLists])
-        num_fetched = [0] # use a list to get static scoping
+        # Fetch the coordinates and (uncached) measurements of all objects
+        # in a few queries grouped by image rather than one per object.
+        all_keys = [tuple(k) for keyList in keyLists for k in keyList]
+        coords = db.GetObjectsCoords(all_keys)
+        if not labels_only:
+            self.cache.prefetch(all_keys, callback)
 
         # Populate the label_matrix, entries, and values
         # NB: values that are nonnumeric or Null/None are made to be 0
@@ -80,16 +84,9 @@ class TrainingSet:
 
             if labels_only:
                 self.values += []
-                self.coordinates += [db.GetObjectCoords(k) for k in keyList]
             else:
-                def get_data(k):
-                    d = self.cache.get_object_data(k)
-                    if callback is not None:
-                        callback(num_fetched[0] / float(num_to_fetch))
-                    num_fetched[0] = num_fetched[0] + 1
-                    return d
-                self.values += [get_data(k) for k in keyList]
-                self.coordinates += [db.GetObjectCoords(k) for k in keyList]
+                self.values += [self.cache.get_object_data(k) for k in keyList]
+            self.coordinates += [coords[tuple(k)] for k in keyList]
 
         self.label_matrix = numpy.array(self.label_matrix)
         self.values = numpy.array(self.values, np.float64)
@@ -319,6 +316,12 @@ class CellCache(Singleton):
         output = (db.get_objects_modify_date(), self.colnames, temp)
         return base64.b64encode(zlib.compress(cPickle.dumps(output)))
 
+    def prefetch(self, keys, callback=None):
+        '''fetch the data of all keys that aren't cached yet, in bulk'''
+        missing = [k for k in keys if k not in self.data]
+        if missing:
+            self.data.update(db.GetCellDataForObjects(missing, cb=callback))
+
     def get_object_data(self, key):
         if key not in self.data:
             self.data[key] = db.GetCellData(key)